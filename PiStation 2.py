@@ -1,14 +1,39 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import RPi.GPIO as GPIO
 from time import sleep, time
 from datetime import datetime
+import heapq
+import math
+import fcntl
 import threading
-import subprocess
+import select
+import socket
+import struct
+import errno
+import signal
 import os
-import psutil
 import sys
+import mmap
+import zlib
+from collections import deque, namedtuple
+from stat import S_ISDIR
+# gzip, shutil, json, hashlib, sqlite3, multiprocessing, subprocess and ctypes are imported
+# where they are used. None of them is needed to get the fan and LED going, and together they
+# take longer to import than the rest of the daemon (python benchmark.py startup)
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2, wall clock time is the best we have
+    monotonic = time
+
+try:
+    import RPi.GPIO as GPIO
+except (ImportError, RuntimeError):
+    # Not running on a Pi (e.g. benchmark.py on a dev machine), only the
+    # classes that do not touch the GPIO pins can be used
+    GPIO = None
 
 if sys.version_info[0] < 3:
     from Queue import Queue, Empty
@@ -22,479 +47,5146 @@ fan_pin_high = 37
 fan_pin_low = 35
 # Using pin 8 for the front LEDs
 front_led_pin = 8
+# Seconds the button has to be held to shut down, a shorter press restarts
+shutdown_hold_time = 2
+# Prometheus metrics, ('0.0.0.0', 9102) to scrape from other machines, a path for a
+# Unix socket or None to turn the metrics server off
+metrics_address = ('127.0.0.1', 9102)
+# Seconds after startup before the ROM directory watcher, ROM index, history and metrics server
+# are set up and the log may be rotated, EmulationStation has the SD card to itself while it loads
+deferred_startup_delay = 30
+# Switch the CPU governor with what the Pi is doing (see CpuProfileManager), False to leave it alone
+manage_cpu_profiles = True
+# The governor and limits found before the first switch, kept until they are put back so a daemon
+# restarted after a crash does not take its own profile for them (/run is emptied at boot, as is
+# the governor)
+cpu_settings_path = '/run/pistation2/cpu-settings.json'
+# Send the log to journald as structured records as well (see JournalSink), when it is running
+log_to_journal = True
+# Time the hot paths and sample the stack of every thread (see Profiler). kill -USR1 the daemon to
+# dump the numbers to profile_path.txt and the stacks, for a flame graph, to profile_path.folded
+profile_daemon = False
+profile_path = os.path.dirname(os.path.realpath(__file__)) + '/PiStation 2.profile'
+# Switch the fan for the temperature predicted lookahead seconds ahead (see FanMonitor), False for
+# the plain thresholds. The hourly fan tuning report compares the time spent throttled under each,
+# kept across restarts in tuning_path, run a few days with each to compare them
+predictive_fan = True
+tuning_path = os.path.dirname(os.path.realpath(__file__)) + '/PiStation 2.tuning.json'
+# Sensor trace for replay.py (about 170KB a day), None to not record one
+trace_path = None # os.path.dirname(os.path.realpath(__file__)) + '/PiStation 2.trace'
 
 FAN_OFF = 0
 FAN_LOW = 1
 FAN_HIGH = 2
 
-GPIO.setmode(GPIO.BOARD)
-GPIO.setwarnings(False)
+# Run once the daemon has shut down for the power button
+POWER_COMMANDS = {'shutdown': 'shutdown -h now', 'restart': 'reboot now'}
+
+# Firmware throttle flags (vcgencmd get_throttled), bits 16-19 are the same flags since boot
+THROTTLE_UNDER_VOLTAGE = 0x1
+THROTTLE_FREQUENCY_CAPPED = 0x2
+THROTTLE_THROTTLED = 0x4
+THROTTLE_SOFT_TEMP_LIMIT = 0x8
+THROTTLE_FLAG_NAMES = ((THROTTLE_UNDER_VOLTAGE, 'under-voltage'), (THROTTLE_FREQUENCY_CAPPED, 'frequency capped'),
+                       (THROTTLE_THROTTLED, 'throttled'), (THROTTLE_SOFT_TEMP_LIMIT, 'soft temperature limit'))
+
+# Kernel proc connector (linux/connector.h, linux/cn_proc.h)
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+NLMSG_DONE = 3
+PROC_CN_MCAST_LISTEN = 1
+PROC_CN_MCAST_IGNORE = 2
+PROC_EVENT_NONE = 0x00000000
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_EXIT = 0x80000000
+# nlmsghdr (16 bytes) + cn_msg (20 bytes), proc_event starts after these
+PROC_EVENT_OFFSET = 36
+
+# inotify (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+INOTIFY_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+# The progress file is replaced (renamed over) while a copy runs and removed at the end
+PROGRESS_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE
+
+# I/O priority (linux/ioprio.h), the syscall has no libc wrapper
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_WHO_PROCESS = 1
+# Syscall numbers by the ABI of the process, see ioprio_abi()
+IOPRIO_SET_SYSCALLS = {'arm': 314, 'aarch64': 30, 'x86_64': 251, 'i386': 289}
+IOPRIO_GET_SYSCALLS = {'arm': 315, 'aarch64': 31, 'x86_64': 252, 'i386': 290}
+PRIO_PROCESS = 0
+
+# Emulators and the RetroPie launcher that runs them, runcommand.sh stays up for the whole game
+EMULATOR_PROCESSES = ['runcommand.sh', 'retroarch', 'mupen64plus', 'PPSSPPSDL', 'reicast', 'amiberry',
+                      'dosbox', 'scummvm', 'drastic', 'advmame', 'mame', 'fbzx']
+
+# cpufreq settings for an activity: the first governor the kernel has, and the minimum and
+# maximum frequency in kHz (None for the hardware limits)
+CpuProfile = namedtuple('CpuProfile', ['name', 'governors', 'min_freq', 'max_freq'])
+CPU_PROFILE_EMULATOR = CpuProfile('emulator', ('performance',), None, None)
+CPU_PROFILE_COPY = CpuProfile('copy', ('ondemand', 'schedutil', 'conservative'), None, None)
+CPU_PROFILE_IDLE = CpuProfile('idle', ('powersave',), None, None)
+
+
+# Log line time stamp, (second, '[%Y-%m-%d] [%H:%M:%S]'). Formatted once a second, not once a line
+log_time = (None, '')
+
+
+def log_timestamp(seconds=None):
+    global log_time
+    second = int(time() if seconds is None else seconds)
+    cached = log_time
+
+    if second != cached[0]:
+        cached = log_time = (second, datetime.fromtimestamp(second).strftime('[%Y-%m-%d] [%H:%M:%S]'))
+
+    return cached[1]
+
+
+# Writes a line time stamped by the clock of the log queue to the log queue and hands text to
+# the print queue (if any), which stamps it itself. fields ({name: value}) are kept as separate fields by a JournalSink
+def write_log(text, log_queue=None, print_queue=None, fields=None):
+    if log_queue:
+        log_queue.queue_add(log_timestamp(log_queue.clock.time()) + ' ' + text + '\r\n')
+
+    if print_queue:
+        print_queue.record(text, fields)
+
+
+# Scheduled Task class
+# A timed (once or every interval seconds) or fd driven callback run by the Scheduler
+class ScheduledTask:
+    def __init__(self, name, callback, interval=None, slack=0, fd=None):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.slack = slack
+        self.fd = fd
+        self.deadline = 0
+        self.cancelled = False
+
+
+# Scheduler class
+# Single thread that runs every timed and event driven task of the daemon (fan checks,
+# rsync watching, LED flashing, log draining). A timed task may run up to slack seconds
+# after its deadline, the scheduler sleeps until the first task runs out of slack and then
+# runs every task that is due, so tasks with close deadlines share one wakeup.
+# call_later, call_every, add_reader and cancel can be used from any thread.
+# With a VirtualClock the scheduler never sleeps, it moves the clock forward to the next
+# wakeup instead (see SimulatedBackend)
+class Scheduler:
+    def __init__(self, slack=0.05, log_queue=None, print_queue=None, clock=None):
+        self.slack = slack
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.logger = log_queue
+        self.printer = print_queue
+        self.wakeups = 0
+        # Task name: [runs, seconds spent running]
+        self.task_stats = {}
+        self.__timers = []
+        self.__readers = {}
+        self.__sequence = 0
+        self.__lock = threading.Lock()
+        self.__running = False
+        # stop() called before run() (a SIGTERM during startup), run() returns right away
+        self.__stop_requested = False
+        self.__thread = None
+        self.__wakeup_read, self.__wakeup_write = os.pipe()
+        self.__started = self.clock.monotonic()
+        self.__started_cpu = self.__cpu_seconds()
+
+        for fd in self.__wakeup_read, self.__wakeup_write:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    # Runs callback once, delay seconds from now
+    def call_later(self, delay, callback, name=None, slack=None):
+        task = ScheduledTask(name if name else self.__name(callback), callback,
+                             slack=self.slack if slack is None else slack)
+        self.__add_timer(task, self.clock.monotonic() + delay)
+        return task
+
+    # Runs callback every interval seconds, the first time after delay seconds (default interval)
+    def call_every(self, interval, callback, name=None, slack=None, delay=None):
+        task = ScheduledTask(name if name else self.__name(callback), callback, interval,
+                             self.slack if slack is None else slack)
+        self.__add_timer(task, self.clock.monotonic() + (interval if delay is None else delay))
+        return task
+
+    # Runs callback every time fd (or an object with fileno()) is readable
+    def add_reader(self, fd, callback, name=None):
+        fd = fd if isinstance(fd, int) else fd.fileno()
+        task = ScheduledTask(name if name else self.__name(callback), callback, fd=fd)
+
+        with self.__lock:
+            self.__readers[fd] = task
+
+        self.__wakeup()
+        return task
+
+    def cancel(self, task):
+        if not task:
+            return
+
+        task.cancelled = True
+
+        if task.fd is not None:
+            with self.__lock:
+                if self.__readers.get(task.fd) is task:
+                    del self.__readers[task.fd]
+
+            self.__wakeup()
+
+    # A signal wakes the scheduler up wherever the kernel delivered it, so its Python handler
+    # runs right away (main thread only, the handler runs on the main thread)
+    def wake_on_signals(self):
+        signal.set_wakeup_fd(self.__wakeup_write)
+
+    def in_scheduler_thread(self):
+        return self.__thread is threading.current_thread()
+
+    # Runs the tasks until stop() is called
+    def run(self):
+        self.__thread = threading.current_thread()
+        self.__running = not self.__stop_requested
+
+        while self.__running:
+            with self.__lock:
+                readers = list(self.__readers)
+                timeout = self.__timeout()
+
+            try:
+                readable = select.select(readers + [self.__wakeup_read], [], [],
+                                         0 if self.clock.virtual else timeout)[0]
+            except (select.error, OSError) as e:
+                # Python 2 does not retry select after a signal
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if self.clock.virtual and not readable:
+                # Nothing will ever be due
+                if timeout is None:
+                    return
+
+                self.clock.advance(timeout)
+
+            self.wakeups += 1
+
+            if self.__wakeup_read in readable:
+                self.__drain_wakeup()
+
+            for fd in readable:
+                task = self.__readers.get(fd)
+
+                if task and not task.cancelled:
+                    self.__run(task)
+
+            self.__run_due()
+
+    def stop(self):
+        self.__stop_requested = True
+        self.__running = False
+        self.__wakeup()
+
+    # Wakeups per second, CPU usage and per task run time since the scheduler was created
+    def report(self):
+        elapsed = max(self.clock.monotonic() - self.__started, 0.001)
+        cpu = self.__cpu_seconds() - self.__started_cpu
+        lines = ['Scheduler: {:.3f} wakeups/s | CPU Usage = {:.2f}% over {}s'
+                 .format(self.wakeups / elapsed, 100 * cpu / elapsed, int(elapsed))]
+
+        for name in sorted(self.task_stats):
+            runs, run_time = self.task_stats[name]
+            lines.append('  {}: {} runs | {:.3f}s total | {:.3f}ms average'
+                         .format(name, runs, run_time, 1000 * run_time / runs if runs else 0))
+
+        return '\r\n'.join(lines)
+
+    def __add_timer(self, task, deadline):
+        task.deadline = deadline
+
+        with self.__lock:
+            self.__sequence += 1
+            heapq.heappush(self.__timers, (deadline, self.__sequence, task))
+
+        if not self.in_scheduler_thread():
+            self.__wakeup()
+
+    # Seconds until the first timed task runs out of slack, None if there are none
+    def __timeout(self):
+        while self.__timers and self.__timers[0][2].cancelled:
+            heapq.heappop(self.__timers)
+
+        if not self.__timers:
+            return None
+
+        latest_start = min(deadline + task.slack for deadline, _, task in self.__timers if not task.cancelled)
+        return max(0, latest_start - self.clock.monotonic())
+
+    def __run_due(self):
+        now = self.clock.monotonic()
+
+        while True:
+            with self.__lock:
+                if not self.__timers or self.__timers[0][0] > now:
+                    return
+
+                deadline, _, task = heapq.heappop(self.__timers)
+
+            if task.cancelled:
+                continue
+
+            self.__run(task)
+
+            if task.interval and not task.cancelled:
+                # Keep the original cadence unless we fell more than one interval behind
+                self.__add_timer(task, max(deadline + task.interval, now))
+
+    def __run(self, task):
+        start = self.clock.monotonic()
+
+        try:
+            task.callback()
+        except Exception as e:
+            write_log('Scheduled task {} failed: {}'.format(task.name, e), self.logger, self.printer, {'PRIORITY': 3})
+
+            if not self.logger and not self.printer:
+                print('Scheduled task {} failed: {}'.format(task.name, e))
+
+        stats = self.task_stats.setdefault(task.name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += self.clock.monotonic() - start
+
+    def __wakeup(self):
+        try:
+            os.write(self.__wakeup_write, b'\0')
+        except OSError:
+            # Pipe is full, the scheduler is going to wake up anyway
+            pass
+
+    def __drain_wakeup(self):
+        try:
+            while os.read(self.__wakeup_read, 512):
+                pass
+        except OSError:
+            pass
+
+    @staticmethod
+    def __name(callback):
+        owner = getattr(callback, '__self__', None)
+        name = getattr(callback, '__name__', 'task')
+
+        return '{}.{}'.format(owner.__class__.__name__, name.lstrip('_')) if owner is not None else name
+
+    @staticmethod
+    def __cpu_seconds():
+        times = os.times()
+        return times[0] + times[1]
 
 
 class PrintQueue:
-    def __init__(self):
+    def __init__(self, scheduler=None):
         self.queue = Queue()
-        self.__printing = True
-        self.__stop_event = threading.Event()
+        self.scheduler = scheduler
+        self.__drain_pending = False
 
-        threading.Thread(name='PrintQueue', target=self.__printer).start()
+        # With a Scheduler the queue is drained by a scheduled task instead of a thread.
+        # The thread never keeps the process alive
+        if not scheduler:
+            thread = threading.Thread(name='PrintQueue', target=self.__printer)
+            thread.daemon = True
+            thread.start()
 
     def queue_add(self, text):
         self.queue.put_nowait(text)
 
-    def close(self):
-        self.queue.join()
-        self.__printing = False
+        if self.scheduler and not self.__drain_pending:
+            self.__drain_pending = True
+            self.scheduler.call_later(0.1, self.drain, 'PrintQueue.drain', 0.4)
 
-    def __printer(self):
-        while self.__printing:
+    # write_log, prints text time stamped. The fields are only for the journal
+    def record(self, text, fields=None):
+        self.queue_add(log_timestamp() + ' ' + text)
+
+    # Scheduled task, prints everything queued so far
+    def drain(self):
+        self.__drain_pending = False
+
+        while True:
             try:
-                text = self.queue.get()
-                print(text)
+                print(self.queue.get_nowait())
                 self.queue.task_done()
             except Empty:
-                pass
+                return
 
-            self.__stop_event.wait(0.1)
-        return
+    def close(self):
+        if self.scheduler:
+            self.drain()
+        else:
+            # Stop marker, everything queued before it is printed first
+            self.queue.put_nowait(None)
+            self.queue.join()
+
+    def __printer(self):
+        while True:
+            text = self.queue.get()
+
+            if text is not None:
+                print(text)
+
+            self.queue.task_done()
+
+            if text is None:
+                return
+
+
+# Journal field framing (systemd native protocol): NAME=value, or for a value with a newline
+# in it NAME, a newline, the value length (64 bit little endian), the value and a newline
+def journal_field(name, value):
+    if not isinstance(value, bytes):
+        value = (value if isinstance(value, str) else str(value)).encode('utf-8')
+
+    if b'\n' in value:
+        return name.encode('ascii') + b'\n' + struct.pack('<Q', len(value)) + value + b'\n'
+
+    return name.encode('ascii') + b'=' + value + b'\n'
+
+
+# Journal Sink class
+# Sends the log to journald over its native socket as structured records. The fields given to
+# write_log (EVENT, TEMP, FAN_STATE, CPU_PCT, ...) are journal fields next to MESSAGE, so
+#   journalctl SYSLOG_IDENTIFIER=pistation2 EVENT=fan_high -o verbose
+# finds them without parsing messages. journald takes one entry per datagram, the entries
+# queued since the last drain are sent together from one scheduled task and journald does the
+# syncing. The socket is non-blocking, when journald falls behind the rest of the queue waits
+# for the next drain. Past max_records the oldest entries are dropped
+class JournalSink:
+    SOCKET_PATH = '/run/systemd/journal/socket'
+    # journald drops datagrams larger than its receive buffer, longer messages are cut
+    MAX_MESSAGE = 32 * 1024
+
+    def __init__(self, scheduler=None, path=SOCKET_PATH, identifier='pistation2', max_records=1000):
+        self.scheduler = scheduler
+        self.path = path
+        self.sent = 0
+        self.dropped = 0
+        # (text, fields) waiting for the next drain
+        self.records = deque(maxlen=max_records)
+        self.__drain_pending = False
+        self.__closed = False
+        # Sent with every entry
+        self.__header = journal_field('SYSLOG_IDENTIFIER', identifier)
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.__socket.setblocking(False)
+
+    @staticmethod
+    def available(path=SOCKET_PATH):
+        return os.path.exists(path)
+
+    # write_log, queues text with fields ({name: value}) for the next drain. PRIORITY is 6
+    # (info) unless fields has one
+    def record(self, text, fields=None):
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+
+        self.records.append((text, fields))
+
+        if not self.scheduler:
+            self.drain()
+        elif not self.__drain_pending:
+            self.__drain_pending = True
+            self.scheduler.call_later(0.1, self.drain, 'JournalSink.drain', 0.4)
+
+    def encode(self, text, fields=None):
+        entry = [self.__header, journal_field('MESSAGE', text[:self.MAX_MESSAGE])]
+
+        if fields:
+            entry.extend(journal_field(name, value) for name, value in fields.items())
+
+        if not fields or 'PRIORITY' not in fields:
+            entry.append(b'PRIORITY=6\n')
+
+        return b''.join(entry)
+
+    # Scheduled task, sends everything queued so far
+    def drain(self):
+        self.__drain_pending = False
+        records = self.records
+
+        while records:
+            text, fields = records[0]
+
+            try:
+                self.__socket.sendto(self.encode(text, fields), self.path)
+                self.sent += 1
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    # journald is behind, what is left goes with the next drain
+                    if self.scheduler and not self.__closed and not self.__drain_pending:
+                        self.__drain_pending = True
+                        self.scheduler.call_later(1, self.drain, 'JournalSink.drain', 1)
+
+                    return
+
+                # journald is not running (ENOENT, ECONNREFUSED) or will not take the entry
+                self.dropped += 1
+
+            records.popleft()
+
+    def close(self):
+        self.__closed = True
+        self.drain()
+        self.__socket.close()
 
 
+# Log Queue class
+# Group commit log writer. Everything queued since the last write goes to the file in one
+# buffered write. The file is fsynced every fsync_interval seconds, every fsync_lines lines,
+# or (both 0) only when the queue is closed. The log is rotated once it is larger than
+# max_bytes or older than max_age seconds, keeping backups rotated files (gzipped if compress),
+# but not in the first rotate_delay seconds, a log that is due at boot is rotated after startup.
+# With a Scheduler the queue is drained by a scheduled task drain_delay seconds after a line
+# is added, otherwise by its own thread. The scheduler thread only does the buffered write, the
+# fsyncs and the rotation (compression included) run on a short lived worker thread, a slow SD
+# card cannot hold up the fan, the LEDs or the watchdog
 class LogQueue:
-    def __init__(self):
+    def __init__(self, path=None, fsync_interval=5, fsync_lines=0, max_bytes=0, max_age=0, backups=3,
+                 compress=False, scheduler=None, drain_delay=0.5, rotate_delay=0, clock=None):
         self.queue = Queue()
-        self.__logging = True
-        self.__stop_event = threading.Event()
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.path = path if path else os.path.dirname(os.path.realpath(__file__)) + '/PiStation 2.log'
+        self.fsync_interval = fsync_interval
+        self.fsync_lines = fsync_lines
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.compress = compress
+        self.scheduler = scheduler
+        self.drain_delay = drain_delay
+        self.rotate_delay = rotate_delay
+        self.lines_written = 0
+        self.writes = 0
+        self.fsyncs = 0
+        self.__closed = False
+        self.__log_file = None
+        self.__opened = 0
+        self.__created = self.clock.time()
+        self.__unsynced_lines = 0
+        self.__last_fsync = self.clock.time()
+        self.__lock = threading.Lock()
+        self.__drain_pending = False
+        self.__fsync_task = None
+        self.__thread = None
+        self.__worker = None
 
         try:
-            self.__log_file = open(os.path.dirname(os.path.realpath(__file__)) + '/PiStation 2.log', 'a')
+            self.__open()
         except:
             with open('/home/pi/PiStation 2 Error.txt', 'a') as txt:
-                txt.write(sys.exc_info()[0])
+                txt.write(str(sys.exc_info()[1]) + '\n')
 
-        threading.Thread(name='LogQueue', target=self.__logger).start()
+        if not scheduler:
+            # close() waits for it, the process never waits on it
+            self.__thread = threading.Thread(name='LogQueue', target=self.__logger)
+            self.__thread.daemon = True
+            self.__thread.start()
 
     def queue_add(self, text):
+        if self.__closed:
+            return
+
         self.queue.put_nowait(text)
 
-    def close(self):
-        self.queue.join()
-        self.__log_file.close()
-        self.__logging = False
+        if self.scheduler and not self.__drain_pending:
+            self.__drain_pending = True
+            self.scheduler.call_later(self.drain_delay, self.drain, 'LogQueue.drain', self.drain_delay)
+
+    # Scheduled task, writes everything queued so far
+    def drain(self):
+        self.__drain_pending = False
+        self.__write(self.__take_all([]))
+
+        if self.__unsynced_lines and self.fsync_interval and not self.__fsync_task:
+            self.__fsync_task = self.scheduler.call_later(self.__fsync_timeout(), self.__scheduled_fsync,
+                                                          'LogQueue.fsync', 1)
+
+    # Writes everything still queued in one write, fsyncs once and closes the file.
+    # Waits at most timeout seconds for the write, a stuck SD card cannot hold up a shutdown
+    def close(self, timeout=None):
+        if self.__closed:
+            return
+
+        self.__closed = True
+
+        if self.__thread:
+            # Stop marker, everything queued before it is written first
+            self.queue.put_nowait(None)
+            self.__thread.join(timeout)
+        else:
+            self.scheduler.cancel(self.__fsync_task)
+            writer = threading.Thread(name='LogQueue.close', target=self.__close_file)
+            writer.daemon = True
+            writer.start()
+            writer.join(timeout)
+
+    def __close_file(self):
+        if self.__worker:
+            self.__worker.join()
+
+        self.__write(self.__take_all([]))
+        self.__finish()
 
     def __logger(self):
-        while self.__logging:
+        while True:
             try:
-                text = self.queue.get()
-                self.__log_file.write(text)
-                self.__log_file.flush()
-                os.fsync(self.__log_file.fileno())
-                self.queue.task_done()
+                lines = [self.queue.get(timeout=self.__fsync_timeout())]
             except Empty:
-                pass
+                # Nothing new arrived before the fsync interval ran out
+                with self.__lock:
+                    self.__fsync()
+                continue
 
-            self.__stop_event.wait(0.1)
-        return
+            # Group commit: take everything else that is waiting
+            lines = self.__take_all(lines)
+            stopping = None in lines
 
+            if stopping:
+                lines = [line for line in lines if line is not None]
 
-# LED Controller class
-# Wrapper for toggling the LED(s)
-class LedController:
-    def __init__(self, led_pin, led_on=True):
-        self.led_pin = led_pin
-        self.led_on = led_on
+            self.__write(lines)
 
-        GPIO.setup(self.led_pin, GPIO.OUT)
-        self.set_state(led_on)
+            if stopping:
+                self.__finish()
+                return
 
-    def toggle_led(self):
-        self.led_on = not self.led_on
-        GPIO.output(self.led_pin, self.led_on)
+    def __take_all(self, lines):
+        while True:
+            try:
+                lines.append(self.queue.get_nowait())
+            except Empty:
+                return lines
 
-    def set_state(self, state):
-        self.led_on = state
-        GPIO.output(self.led_pin, self.led_on)
+    def __write(self, lines):
+        with self.__lock:
+            if not self.__log_file or not lines:
+                return
 
+            self.__log_file.write(''.join(lines))
+            self.__log_file.flush()
+            self.writes += 1
+            self.lines_written += len(lines)
+            self.__unsynced_lines += len(lines)
+            fsync_due = self.fsync_lines and self.__unsynced_lines >= self.fsync_lines or \
+                self.fsync_interval and self.clock.time() - self.__last_fsync >= self.fsync_interval
+            rotate_due = self.__should_rotate()
 
-# rsync Monitor class
-# Checks the process list to see if rsync is running
-class RsyncMonitor:
-    # LedController, delay between flashes
-    def __init__(self, led, delay=0.2, log_queue=None, print_queue=None):
-        # User can create the class using a pin number or supply
-        # a LedController
-        self.printer = print_queue
-        self.logger = log_queue
+            if not self.scheduler:
+                if fsync_due:
+                    self.__fsync()
 
-        if isinstance(led, int):
-            if 40 >= led >= 3:
-                led = LedController(led)
+                if rotate_due:
+                    self.__compress(self.__rotate())
 
-        if not isinstance(led, LedController):
-            log_text = datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]') + ' Invalid LedController'
-            if self.printer or self.logger:
-                if self.printer:
-                    self.printer.queue_add(log_text)
-                if self.logger:
-                    self.logger.queue_add(log_text + '\r\n')
-            else:
-                print(log_text)
+                return
 
-            raise ValueError
+        if fsync_due or rotate_due:
+            self.__start_worker()
 
-        if not (isinstance(delay, int) or isinstance(delay, float)):
-            log_text = datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]') + ' Delay must be int or float'
-            if self.printer or self.logger:
-                if self.printer:
-                    self.printer.queue_add(log_text)
-                if self.logger:
-                    self.logger.queue_add(log_text + '\r\n')
-            else:
-                print(log_text)
-            raise ValueError
+    def __finish(self):
+        with self.__lock:
+            self.__fsync()
 
-        self.led_controller = led
-        self.delay = delay
-        self.__flashing = None
-        self.__flash_stop = None
-        self.__rsync_pid = 0
+            if self.__log_file:
+                self.__log_file.close()
+                self.__log_file = None
 
-    # Returns true if rsync is running (copying)
-    def is_copying(self):
-        if self.__rsync_pid:
-            # Saved the last rsync PID, check to see if
-            # it still exists
-            try:
-                os.kill(self.__rsync_pid, 0)
-            except OSError:
-                # Last PID does not exist, continue
-                self.__rsync_pid = 0
-                pass
-            else:
-                # Last PID still exists, still running
-                return True
-        try:
-            # Check to see if rsync exists
-            subprocess.check_output(['pidof', 'rsync'])
-            # rsync exists, return true
-            return True
-        # When the process does not exist, subprocess raises a CalledProcessError
-        # rsync is not running, return False
-        except subprocess.CalledProcessError:
-            return False
+    # Seconds until unsynced lines are due to be fsynced, None to block until something is queued
+    def __fsync_timeout(self):
+        if not self.__unsynced_lines or not self.fsync_interval:
+            return None
 
-    # Monitor function, main loop for this class
-    def monitor(self, stop_event):
-        copy_timer = time()
+        return max(0, self.fsync_interval - (self.clock.time() - self.__last_fsync))
 
-        try:
-            while not stop_event.is_set():
-                # If rsync is running (copying)
-                if self.is_copying():
-                    # Not currently flashing the LED(s)
-                    if not self.__flashing:
-                        # Timer used to show how long the copying process lasted
-                        copy_timer = time()
+    def __scheduled_fsync(self):
+        self.__fsync_task = None
+        self.__start_worker()
 
-                        # Create the stop event, thread, and start it (start flashing)
-                        self.__flash_stop = threading.Event()
-                        self.__flashing = threading.Thread(target=self.__flash,
-                                                           args=(self.__flash_stop, self.led_controller, self.delay))
-                        self.__flashing.start()
+    # One worker at a time, a fsync or rotation that is due while one runs is left to it
+    def __start_worker(self):
+        if self.__worker and self.__worker.is_alive() or self.__closed:
+            return
 
-                        if self.printer or self.logger:
-                            log_string = datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]') + ' Copying started'
+        self.__worker = threading.Thread(name='LogQueue.sync', target=self.__sync)
+        self.__worker.daemon = True
+        self.__worker.start()
 
-                            if self.logger:
-                                self.logger.queue_add(log_string + '\r\n')
+    # Worker thread. The lock is not held while the SD card works, the scheduler keeps writing
+    # lines to the file meanwhile
+    def __sync(self):
+        with self.__lock:
+            log_file = self.__log_file
+            unsynced = self.__unsynced_lines
+            self.__unsynced_lines = 0
+            self.__last_fsync = self.clock.time()
 
-                            if self.printer:
-                                self.printer.queue_add(log_string)
-                # Currently flashing but rsync is no longer running
-                elif self.__flashing:
-                    # Stop the thread
-                    self.__flash_stop.set()
-                    # Clear it
-                    self.__flashing = self.__flash_stop = None
+        if log_file and unsynced:
+            os.fsync(log_file.fileno())
+            self.fsyncs += 1
 
-                    if self.printer or self.logger:
+        with self.__lock:
+            rotated = self.__rotate() if self.__log_file and self.__should_rotate() else None
 
-                        log_string = datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]') + \
-                                     ' Copying ended: ' + self.__timer_to_time(copy_timer)
+        self.__compress(rotated)
 
-                        if self.logger:
-                            self.logger.queue_add(log_string + '\r\n')
+    def __fsync(self):
+        if self.__log_file and self.__unsynced_lines:
+            os.fsync(self.__log_file.fileno())
+            self.fsyncs += 1
 
-                        if self.printer:
-                            self.printer.queue_add(log_string)
+        self.__unsynced_lines = 0
+        self.__last_fsync = self.clock.time()
 
-                            copy_timer = 0
+    # max_age counts from the first line of the log, a restart (every reboot) reopens the same log
+    def __open(self):
+        self.__log_file = open(self.path, 'a')
+        self.__opened = self.__first_line_time(self.path) or self.clock.time()
 
-                    # Slight delay while we wait for the thread to close
-                    stop_event.wait(0.1)
+    # Time stamp of the first line of the log, None if it is empty or does not start with one
+    @staticmethod
+    def __first_line_time(path):
+        from time import mktime
 
-                stop_event.wait(0.25)
-        # Some error happened, close out of this gracefully
-        except Exception as e:
-            if hasattr(e, 'message'):
-                print(e.message)
-            else:
-                print(e)
-            pass
+        try:
+            with open(path) as log_file:
+                return mktime(datetime.strptime(log_file.read(23), '[%Y-%m-%d] [%H:%M:%S]').timetuple())
+        except (IOError, OSError, ValueError, OverflowError):
+            return None
 
-        if self.__flashing:
-            self.__flash_stop.set()
-        return
+    def __should_rotate(self):
+        if self.rotate_delay and self.clock.time() - self.__created < self.rotate_delay:
+            return False
 
-    @staticmethod
-    def __timer_to_time(timer):
-        seconds = time() - timer
-        days = int(seconds / 86400)
-        seconds %= 86400
-        hours = int(seconds / 3600)
-        seconds %= 3600
-        return '{0:02d}d {1:02d}h {2:02d}m {3:02d}s'.format(days, hours, int(seconds / 60), int(seconds % 60))
+        if self.max_bytes and self.__log_file.tell() >= self.max_bytes:
+            return True
 
-    # Function used for flashing the LED(s)
-    # Not inside the main while loop, this is threaded so the flashing
-    # is never interrupted from the sleeps
-    @staticmethod
-    def __flash(stop_event, led, delay):
-        led_default_state = led.led_on
+        return self.max_age and self.clock.time() - self.__opened >= self.max_age
 
-        # While the stop event has not been set, keep flashing
-        while not stop_event.is_set():
-            led.toggle_led()
-            stop_event.wait(delay)
+    # PiStation 2.log -> PiStation 2.log.1(.gz) -> ... -> PiStation 2.log.<backups>(.gz)
+    # Returns the rotated log if it is still to be compressed (see __compress)
+    def __rotate(self):
+        self.__fsync()
+        self.__log_file.close()
+        suffix = '.gz' if self.compress else ''
+        rotated = None
 
-        # Put the LED back to the default state we found it in
-        led.set_state(led_default_state)
+        for backup in range(self.backups - 1, 0, -1):
+            source = '{}.{}{}'.format(self.path, backup, suffix)
 
+            if os.path.isfile(source):
+                os.rename(source, '{}.{}{}'.format(self.path, backup + 1, suffix))
 
-class FanMonitor:
-    def __init__(self, gpio_pin_low, gpio_pin_high, temp_fan_low=55, temp_fan_high=65, temp_fan_off=45,
-                 min_seconds_on=30, log_queue=None, print_queue=None):
-        self.rpi_cpu_freq = '/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq'
-        self.fan_state = FAN_OFF
-        self.fan_pin_low = gpio_pin_low
-        self.fan_pin_high = gpio_pin_high
-        self.last_temperature = 0
-        self.temp_fan_low = temp_fan_low
-        self.temp_fan_high = temp_fan_high
-        self.temp_fan_off = temp_fan_off
-        self.__fan_timer = 0
-        self.min_seconds_on = min_seconds_on
-        self.logger = log_queue
-        self.printer = print_queue
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
 
-        GPIO.setup(self.fan_pin_low, GPIO.OUT)
-        GPIO.setup(self.fan_pin_high, GPIO.OUT)
-        GPIO.output(self.fan_pin_low, False)
-        GPIO.output(self.fan_pin_high, False)
+            if self.compress:
+                rotated = self.path + '.1'
+        else:
+            os.remove(self.path)
 
-    @staticmethod
-    def cpu_temp():
-        return float(os.popen('vcgencmd measure_temp').readline().replace('temp=', '').replace('\'C\n', ''))
+        self.__open()
+        return rotated
 
+    # Level 1, a few times faster than the default 9 on a Pi Zero for a slightly larger file
     @staticmethod
-    def cpu_percent():
-        return float(psutil.cpu_percent(interval=1))
+    def __compress(rotated):
+        if not rotated:
+            return
 
-    def cpu_speed(self):
-        current_freq = str(subprocess.check_output('cat ' + self.rpi_cpu_freq, shell=True)).replace('0000\n', '')
+        import gzip
+        import shutil
 
-        return \
-            float('0.' + current_freq) \
-            if int(current_freq) < 100 else \
-            float('{}.{}'.format(current_freq[:1], current_freq[1:]))
+        with open(rotated, 'rb') as source:
+            with gzip.open(rotated + '.gz', 'wb', 1) as compressed:
+                shutil.copyfileobj(source, compressed)
 
-    def check_temp(self):
-        current_temp = self.cpu_temp()
+        os.remove(rotated)
 
-        if current_temp >= self.temp_fan_low:
-            if self.__fan_timer:
-                self.__fan_timer = 0
 
-                if self.logger or self.printer:
-                    log_write = datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]') + \
-                                ' Resetting timer: CPU Temperature = {}°C | CPU Usage = {}% | CPU Speed = {}GHz' \
-                                .format(current_temp, self.cpu_percent(), self.cpu_speed())
+# LED patterns
+# next(level) returns the next LED level (on/off, or a 0-100 duty cycle for PWM patterns)
+# and the seconds until the step after it, None to hold the level
+class LedSolid:
+    pwm = False
 
-                    if self.logger:
-                        self.logger.queue_add(log_write + '\r\n')
+    def __init__(self, state):
+        self.state = state
 
-                    if self.printer:
-                        self.printer.queue_add(log_write)
+    def next(self, level):
+        return self.state, None
 
-            if current_temp >= self.temp_fan_high:
-                if self.fan_state == FAN_HIGH:
-                    return
 
-                self.set_state(FAN_HIGH)
-                speed = 'high fan speed'
-                temp = self.temp_fan_high
-            else:
-                if self.fan_state == FAN_LOW:
-                    return
-                self.set_state(FAN_LOW)
-                speed = 'low fan speed'
-                temp = self.temp_fan_low
+# Toggles every interval seconds, the interval can be changed while it runs (e.g. with the transfer rate)
+class LedBlink:
+    pwm = False
 
-            if self.logger or self.printer:
-                log_write = datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]') + \
-                            ' Temperature reached for ' + speed + ' ({}°C): ' \
-                            'CPU Temperature = {}°C | CPU Usage = {}% | CPU Speed = {}GHz' \
-                            .format(temp, current_temp, self.cpu_percent(), self.cpu_speed())
+    def __init__(self, interval):
+        self.interval = interval
 
-                if self.logger:
-                    self.logger.queue_add(log_write + '\r\n')
+    def next(self, level):
+        return not level, self.interval
 
-                if self.printer:
-                    self.printer.queue_add(log_write)
 
-        elif current_temp <= self.temp_fan_off and self.fan_state:
-            if not self.__fan_timer:
-                self.__fan_timer = time()
+# Fades in and out over period seconds, from off, held on where there is no PWM. The power
+# button shows one for its hold countdown, fully lit as the long press action runs
+class LedBreathe:
+    pwm = True
 
-                if self.logger or self.printer:
-                    log_write = datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]') + \
-                                ' Min temp reached ({}°C), Initializing countdown ({}s): ' \
-                                'CPU Temperature = {}°C | CPU Usage = {}% | CPU Speed = {}GHz' \
-                                .format(self.temp_fan_off, self.min_seconds_on, current_temp, self.cpu_percent(),
-                                        self.cpu_speed())
+    def __init__(self, period=4, step=0.05):
+        self.period = period
+        self.step = step
+        self.__phase = 0.0
 
-                    if self.logger:
-                        self.logger.queue_add(log_write + '\r\n')
+    def next(self, level):
+        self.__phase = (self.__phase + self.step) % self.period
+        return 50 - 50 * math.cos(2 * math.pi * self.__phase / self.period), self.step
 
-                    if self.printer:
-                        self.printer.queue_add(log_write)
-                return
 
-            current_time = time()
+# LED Controller class
+# Owns the LED pin, nothing else writes to it. Patterns are shown by name with a priority,
+# the highest priority one drives the LED from a single timer on the scheduler and the LED
+# goes back to its default state when no pattern is left. show() and clear() can be called
+# from any thread, the pin is only ever written from the scheduler thread. Writes that would
+# not change the pin are skipped. Timer lateness (jitter) and writes are counted for report()
+class LedController:
+    def __init__(self, led_pin, led_on=True, pwm_frequency=200, gpio=None, clock=None):
+        self.led_pin = led_pin
+        self.led_on = led_on
+        self.default_state = led_on
+        self.pwm_frequency = pwm_frequency
+        self.gpio = gpio if gpio else GPIO
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.scheduler = None
+        # name: (priority, pattern)
+        self.patterns = {}
+        self.writes = 0
+        self.skipped_writes = 0
+        self.steps = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        self.__active = None
+        self.__task = None
+        self.__deadline = None
+        self.__pwm = None
+        self.__written = None
 
-            if self.logger or self.printer:
-                log_write = datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]') + \
-                            ' {}s left: CPU Temperature = {}°C | CPU Usage = {}% | CPU Speed = {}GHz' \
-                            .format(int(self.min_seconds_on - (current_time - self.__fan_timer)),
-                                    current_temp, self.cpu_percent(), self.cpu_speed())
-                if self.logger:
-                    self.logger.queue_add(log_write + '\r\n')
+        self.gpio.setup(self.led_pin, self.gpio.OUT)
+        self.set_state(led_on)
 
-                if self.printer:
-                    self.printer.queue_add(log_write)
+    # Patterns run on the scheduler, without one the LED only shows their first level
+    def start(self, scheduler):
+        self.scheduler = scheduler
 
-            if current_time - self.__fan_timer > self.min_seconds_on:
-                self.set_state(False)
-                self.__fan_timer = 0
-                if self.logger or self.printer:
-                    log_write = datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]') + \
-                                ' Min temp and time reached, turning fan off'
-                    if self.logger:
-                        self.logger.queue_add(log_write + '\r\n')
+    def show(self, name, pattern, priority=0):
+        self.__on_scheduler(self.__show, name, pattern, priority)
 
-                    if self.printer:
-                        self.printer.queue_add(log_write)
+    def clear(self, name):
+        self.__on_scheduler(self.__clear, name)
 
-    def toggle_fan(self):
-        return self.set_state(not self.fan_state)
+    # Stops every pattern and puts the LED in its default state, from any thread. For the
+    # shutdown, the pin must not be used after this
+    def stop(self):
+        if self.scheduler:
+            self.scheduler.cancel(self.__task)
+
+        self.patterns = {}
+        self.__active = self.__task = self.__deadline = None
+        self.__stop_pwm()
+        self.set_state(self.default_state)
+
+    # The default state is what the LED shows when no pattern is running
+    def set_default(self, state):
+        self.default_state = state
+        self.__on_scheduler(self.__select)
+
+    def toggle_led(self):
+        self.set_state(not self.led_on)
 
     def set_state(self, state):
-        if self.fan_state == FAN_HIGH:
-            GPIO.output(self.fan_pin_high, False)
-        elif self.fan_state == FAN_LOW:
-            GPIO.output(self.fan_pin_low, False)
+        self.led_on = state
 
-        if state == FAN_HIGH:
-            GPIO.output(self.fan_pin_high, True)
-        elif state == FAN_LOW:
-            GPIO.output(self.fan_pin_low, True)
+        if state == self.__written:
+            self.skipped_writes += 1
+            return
 
-        self.fan_state = state
-        return self.fan_state
+        self.gpio.output(self.led_pin, state)
+        self.__written = state
+        self.writes += 1
 
+    def report(self):
+        return 'LED: {} steps | {:.2f}ms average lateness | {:.2f}ms max lateness | {} writes | {} skipped' \
+            .format(self.steps, 1000 * self.total_lateness / self.steps if self.steps else 0,
+                    1000 * self.max_lateness, self.writes, self.skipped_writes)
 
-def button_pressed(pin):
-    if not GPIO.input(pin):
-        if logger or printer:
-            log_string = datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]') + ' Reset button pressed ....'
-            if logger:
-                logger.queue_add(log_string + '\r\n')
+    def __on_scheduler(self, function, *args):
+        if self.scheduler and not self.scheduler.in_scheduler_thread():
+            self.scheduler.call_later(0, lambda: function(*args), 'LedController.update', 0)
+        else:
+            function(*args)
 
-            if printer:
-                printer.queue_add(log_string)
-        timer = time()
+    def __show(self, name, pattern, priority):
+        self.patterns[name] = (priority, pattern)
+        self.__select()
 
-        rsync_stop.set()
+    def __clear(self, name):
+        if self.patterns.pop(name, None):
+            self.__select()
 
-        while not GPIO.input(pin):
-            if time() - timer >= 2:
-                if logger or printer:
-                    log_string = datetime.strftime(datetime.now(),
-                                                   '[%Y-%m-%d] [%H:%M:%S]') + ' Shutting down PiStation 2'
-                    if logger:
-                        logger.queue_add(log_string + '\r\n')
+    # Starts the highest priority pattern if it is not the one running
+    def __select(self):
+        active = max(self.patterns.items(), key=lambda item: item[1][0])[0] if self.patterns else None
 
-                    if printer:
-                        printer.queue_add(log_string)
-                close()
-                subprocess.call('shutdown -h now', shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                exit()
+        if active == self.__active and active is not None:
+            return
 
-            led_controller.toggle_led()
-            sleep(0.15)
+        self.__active = active
 
-        if logger or printer:
-            log_string = datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]') + ' Restarting PiStation 2'
-            if logger:
-                logger.queue_add(log_string + '\r\n')
+        if self.scheduler:
+            self.scheduler.cancel(self.__task)
 
-            if printer:
-                printer.queue_add(log_string)
+        self.__task = self.__deadline = None
 
-        close()
-        subprocess.call('reboot now', shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if active is None:
+            self.__stop_pwm()
+            self.set_state(self.default_state)
+        else:
+            self.__step()
 
+    def __step(self):
+        self.__task = None
 
-def close():
-    rsync_stop.set()
+        if self.__active is None:
+            return
 
-    try:
-        if logger:
-            logger.close()
-    except:
-        pass
+        if self.__deadline is not None:
+            lateness = max(0.0, self.clock.monotonic() - self.__deadline)
+            self.steps += 1
+            self.total_lateness += lateness
+            self.max_lateness = max(self.max_lateness, lateness)
 
+        pattern = self.patterns[self.__active][1]
+        level, delay = pattern.next(self.led_on)
+
+        if pattern.pwm and hasattr(GPIO, 'PWM'):
+            if not self.__pwm:
+                self.__pwm = self.gpio.PWM(self.led_pin, self.pwm_frequency)
+                self.__pwm.start(level)
+            else:
+                self.__pwm.ChangeDutyCycle(level)
+
+            self.writes += 1
+        else:
+            self.__stop_pwm()
+            self.set_state(bool(level) if not pattern.pwm else True)
+
+        if delay is not None and self.scheduler:
+            self.__deadline = self.clock.monotonic() + delay
+            self.__task = self.scheduler.call_later(delay, self.__step, 'LedController.step', 0)
+        else:
+            self.__deadline = None
+
+    def __stop_pwm(self):
+        if self.__pwm:
+            self.__pwm.stop()
+            self.__pwm = None
+            # The pin level after PWM is unknown, the next write must not be skipped
+            self.__written = None
+
+
+# Button Controller class
+# Debounced power button state machine. The GPIO callback only timestamps the edge and
+# hands it to the scheduler, it never waits. An edge counts once the pin has been stable
+# for debounce seconds, the press duration is measured between the first falling and rising
+# edge of each bounce burst. Holding the button for long_press seconds runs the long press
+# action while it is still held, short presses are counted and the action for the number of
+# presses runs once no other press follows within multi_press_window seconds (right away if
+# only single presses have an action). Actions are queued and run one after the other on an
+# action thread, so shutdown and reboot never block the GPIO callback or the scheduler
+class ButtonController:
+    def __init__(self, pin, scheduler, long_press=2, debounce=0.05, multi_press_window=0.4,
+                 led_controller=None, log_queue=None, print_queue=None, gpio=None):
+        self.pin = pin
+        self.scheduler = scheduler
+        self.gpio = gpio if gpio else GPIO
+        self.clock = scheduler.clock
+        self.long_press = long_press
+        self.debounce = debounce
+        self.multi_press_window = multi_press_window
+        self.led_controller = led_controller
+        self.logger = log_queue
+        self.printer = print_queue
+        self.pressed = False
+        # Number of presses: action
+        self.press_actions = {}
+        self.long_press_action = None
+        self.__burst_start = None
+        self.__settle_task = None
+        self.__press_time = 0
+        self.__hold_task = None
+        self.__held = False
+        self.__presses = 0
+        self.__presses_task = None
+        self.__actions = Queue()
+        self.__action_thread = None
+
+    def on_press(self, presses, action):
+        self.press_actions[presses] = action
+
+    def on_long_press(self, action):
+        self.long_press_action = action
+
+    # Enables the pull up resistor (pressing the button also turns a halted Pi back on)
+    # and starts listening to both edges
+    def start(self):
+        self.gpio.setup(self.pin, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+        self.pressed = not self.gpio.input(self.pin)
+        self.gpio.add_event_detect(self.pin, self.gpio.BOTH, callback=self.__edge_detected)
+
+    def stop(self):
+        self.gpio.remove_event_detect(self.pin)
+
+        for task in self.__settle_task, self.__hold_task, self.__presses_task:
+            self.scheduler.cancel(task)
+
+    # Runs action on the action thread after the actions queued before it
+    def defer(self, action):
+        self.__actions.put(action)
+
+        if not self.__action_thread:
+            self.__action_thread = threading.Thread(name='ButtonController', target=self.__run_actions)
+            self.__action_thread.daemon = True
+            self.__action_thread.start()
+
+    # RPi.GPIO callback thread
+    def __edge_detected(self, pin):
+        edge_time = self.clock.monotonic()
+        self.scheduler.call_later(0, lambda: self.__edge(edge_time), 'ButtonController.edge', 0)
+
+    def __edge(self, edge_time):
+        if self.__burst_start is None:
+            self.__burst_start = edge_time
+
+        # Wait for the contacts to stop bouncing
+        self.scheduler.cancel(self.__settle_task)
+        self.__settle_task = self.scheduler.call_later(self.debounce, self.__settle, 'ButtonController.settle', 0)
+
+    def __settle(self):
+        self.__settle_task = None
+        edge_time = self.__burst_start
+        self.__burst_start = None
+        pressed = not self.gpio.input(self.pin)
+
+        # Bounced back to where it was
+        if pressed == self.pressed:
+            return
+
+        self.pressed = pressed
+
+        if pressed:
+            self.__pressed(edge_time)
+        else:
+            self.__released(edge_time)
+
+    def __pressed(self, edge_time):
+        self.__press_time = edge_time
+        self.__held = False
+        self.scheduler.cancel(self.__presses_task)
+        self.__presses_task = None
+
+        if self.long_press_action:
+            self.__hold_task = self.scheduler.call_later(max(0, self.long_press - (self.clock.monotonic() - edge_time)),
+                                                         self.__long_press, 'ButtonController.hold', 0)
+
+        if self.led_controller:
+            # Brightens to fully lit over the hold, half a breath, as a countdown to the long press
+            self.led_controller.show('button', LedBreathe(2 * self.long_press) if self.long_press_action
+                                     else LedBlink(0.15), 10)
+
+        write_log('Reset button pressed ....', self.logger, self.printer)
+
+    def __released(self, edge_time):
+        self.scheduler.cancel(self.__hold_task)
+        self.__hold_task = None
+        duration = edge_time - self.__press_time
+
+        if self.__held:
+            return
+
+        if self.led_controller:
+            self.led_controller.clear('button')
+
+        self.__presses += 1
+        write_log('Reset button released after {:.2f}s'.format(duration), self.logger, self.printer)
+
+        if max(self.press_actions or [1]) > 1:
+            self.__presses_task = self.scheduler.call_later(self.multi_press_window, self.__presses_done,
+                                                            'ButtonController.presses', 0)
+        else:
+            self.__presses_done()
+
+    def __long_press(self):
+        self.__hold_task = None
+        self.__held = True
+        self.__presses = 0
+        write_log('Reset button held for {}s'.format(self.long_press), self.logger, self.printer)
+        self.defer(self.long_press_action)
+
+    def __presses_done(self):
+        self.__presses_task = None
+        presses = self.__presses
+        self.__presses = 0
+        action = self.press_actions.get(presses)
+
+        if action:
+            self.defer(action)
+        else:
+            write_log('Reset button pressed {} times, nothing to do'.format(presses), self.logger, self.printer)
+
+    def __run_actions(self):
+        while True:
+            action = self.__actions.get()
+
+            try:
+                action()
+            except Exception as e:
+                write_log('Button action failed: {}'.format(e), self.logger, self.printer)
+
+
+# Shutdown Coordinator class
+# Runs the shutdown phases once, in the order they were added, for whoever asks first, anyone
+# asking after that waits for it to finish. The daemon runs it on the main thread once the
+# scheduler has stopped (the power button, SIGTERM from systemd, a keyboard interrupt), so no
+# task runs while the phases tear down what the tasks use. The log is drained last, with one
+# write and one fsync in what is left of deadline seconds. How long each phase took is logged
+# and printed (journald)
+class ShutdownCoordinator:
+    def __init__(self, log_queue=None, print_queue=None, deadline=0.5, clock=None):
+        self.logger = log_queue
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.printer = print_queue
+        self.deadline = deadline
+        self.phases = []
+        # (phase, seconds)
+        self.timings = []
+        self.__lock = threading.Lock()
+        self.__started = False
+        self.__finished = threading.Event()
+
+    def add(self, name, callback):
+        self.phases.append((name, callback))
+
+    # Returns False if the shutdown had already been run
+    def run(self, reason):
+        with self.__lock:
+            started = self.__started
+            self.__started = True
+
+        if started:
+            self.__finished.wait(self.deadline)
+            return False
+
+        start = self.clock.monotonic()
+
+        for name, callback in self.phases:
+            phase_start = self.clock.monotonic()
+
+            try:
+                callback()
+            except Exception as e:
+                write_log('Shutdown phase {} failed: {}'.format(name, e), self.logger, self.printer, {'PRIORITY': 3})
+
+            self.timings.append((name, self.clock.monotonic() - phase_start))
+
+        write_log(self.__report(reason), self.logger, self.printer)
+        drain_start = self.clock.monotonic()
+
+        try:
+            if self.logger:
+                self.logger.close(max(0.1, self.deadline - (drain_start - start)))
+
+            if self.printer:
+                self.printer.close()
+        except Exception as e:
+            print('Log drain failed: {}'.format(e))
+
+        self.timings.append(('log drain', self.clock.monotonic() - drain_start))
+        print(self.__report(reason) + ' | total {:.0f}ms'.format(1000 * (self.clock.monotonic() - start)))
+        self.__finished.set()
+        return True
+
+    def __report(self, reason):
+        return 'Shutdown ({}): '.format(reason) + ' | '.join('{} {:.0f}ms'.format(name, 1000 * seconds)
+                                                               for name, seconds in self.timings)
+
+
+# Seconds since this process was started (exec), /proc has the start time in clock ticks
+# since boot so this is only good to 10ms
+def process_age():
+    with open('/proc/self/stat') as stat:
+        # The process name can have spaces in it, the fields after it cannot
+        start_ticks = int(stat.read().rsplit(')', 1)[1].split()[19])
+
+    with open('/proc/uptime') as uptime:
+        return float(uptime.read().split()[0]) - start_ticks / float(os.sysconf('SC_CLK_TCK'))
+
+
+# Startup Timer class
+# Time taken by each step of the startup. The first step is the interpreter starting and the
+# imports (the age of the process when the timer is created), ready() marks the point systemd
+# is told the daemon is up. Steps deferred until after that are timed from resume()
+class StartupTimer:
+    def __init__(self, clock=None):
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.phases = [('interpreter and imports', process_age())]
+        self.ready_after = None
+        self.__started = self.clock.monotonic() - self.phases[0][1]
+        self.__last = self.clock.monotonic()
+        self.__ready_phases = None
+
+    # Time since the last step (or resume())
+    def mark(self, name):
+        now = self.clock.monotonic()
+        self.phases.append((name, now - self.__last))
+        self.__last = now
+
+    def ready(self):
+        self.ready_after = self.clock.monotonic() - self.__started
+        self.__ready_phases = len(self.phases)
+
+    def resume(self):
+        self.__last = self.clock.monotonic()
+
+    def report(self):
+        ready_phases = self.__ready_phases if self.__ready_phases is not None else len(self.phases)
+        text = 'Startup: ' + ' | '.join('{} {:.0f}ms'.format(name, 1000 * seconds)
+                                        for name, seconds in self.phases[:ready_phases])
+
+        if self.ready_after is not None:
+            text += ' | ready after {:.0f}ms'.format(1000 * self.ready_after)
+
+        if self.phases[ready_phases:]:
+            text += '\r\nDeferred startup: ' + ' | '.join('{} {:.0f}ms'.format(name, 1000 * seconds)
+                                                        for name, seconds in self.phases[ready_phases:])
+
+        return text
+
+
+# systemd Notifier class
+# sd_notify(3) without libsystemd: readiness, status and watchdog messages are datagrams to
+# the Unix socket systemd passes in NOTIFY_SOCKET (Type=notify services). Nothing is sent when
+# the daemon was not started by systemd. The variables are taken out of the environment so
+# the processes the daemon starts (reboot, the hashing pool) cannot speak for it.
+# start_watchdog() pings systemd from the scheduler at half of WatchdogSec, systemd restarts
+# the daemon if the scheduler stops running its tasks
+class SystemdNotifier:
+    def __init__(self):
+        address = os.environ.pop('NOTIFY_SOCKET', None)
+        watchdog_usec = os.environ.pop('WATCHDOG_USEC', None)
+        watchdog_pid = os.environ.pop('WATCHDOG_PID', None)
+        self.watchdog_interval = None
+        self.messages = 0
+        self.__socket = None
+        self.__address = None
+        self.__scheduler = None
+        self.__watchdog_task = None
+
+        if address:
+            # '@' is a socket in the abstract namespace
+            self.__address = '\0' + address[1:] if address.startswith('@') else address
+            self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+        if watchdog_usec and (not watchdog_pid or int(watchdog_pid) == os.getpid()):
+            self.watchdog_interval = int(watchdog_usec) / 1000000.0
+
+    def enabled(self):
+        return self.__socket is not None
+
+    # Sends the fields (e.g. 'READY=1') in one message, returns False if it could not be sent
+    def notify(self, *fields):
+        if not self.__socket:
+            return False
+
+        try:
+            self.__socket.sendto('\n'.join(fields).encode('utf-8'), self.__address)
+        except (socket.error, OSError):
+            return False
+
+        self.messages += 1
+        return True
+
+    def ready(self, status=None):
+        return self.notify('READY=1', *(['STATUS=' + status] if status else []))
+
+    def status(self, status):
+        return self.notify('STATUS=' + status)
+
+    def stopping(self):
+        self.stop_watchdog()
+        return self.notify('STOPPING=1')
+
+    def start_watchdog(self, scheduler):
+        if self.__socket and self.watchdog_interval and not self.__watchdog_task:
+            self.__scheduler = scheduler
+            self.__watchdog_task = scheduler.call_every(self.watchdog_interval / 2, self.__ping,
+                                                        'SystemdNotifier.watchdog', self.watchdog_interval / 4)
+
+    def stop_watchdog(self):
+        if self.__watchdog_task:
+            self.__scheduler.cancel(self.__watchdog_task)
+            self.__watchdog_task = None
+
+    def close(self):
+        self.stop_watchdog()
+
+        if self.__socket:
+            self.__socket.close()
+            self.__socket = None
+
+    def __ping(self):
+        self.notify('WATCHDOG=1')
+
+
+# Profiler class
+# Call counts and latency histograms of the instrumented methods, subprocess spawns by program
+# and a stack sampler that records what every thread is running every interval seconds.
+# dump() writes the report to path.txt and the sampled stacks to path.folded, collapsed one
+# stack a line for flamegraph.pl or speedscope. Disabled, instrument() leaves the methods as
+# they are and no thread is started, the daemon runs exactly the code it runs without it
+class Profiler:
+    # Histogram bucket upper bounds in seconds, the last bucket has everything slower
+    BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1)
+    BUCKET_NAMES = ('<10us', '<100us', '<1ms', '<10ms', '<100ms', '>=100ms')
+
+    def __init__(self, enabled=False, interval=0.05):
+        import time as time_module
+
+        self.enabled = enabled
+        self.interval = interval
+        self.samples = 0
+        # name: [calls, seconds, max seconds, bucket counts...]
+        self.stats = {}
+        # program: spawns
+        self.spawns = {}
+        # 'thread;outermost frame;...;innermost frame': samples
+        self.stacks = {}
+        # Wall clock time even when the module runs on a VirtualClock (benchmark.py)
+        self.clock = getattr(time_module, 'perf_counter', time_module.time)
+        self.__started = self.clock()
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__labels = {}
+
+    # Replaces obj.attribute (a method or function) with one that times each call as name
+    # (class.attribute by default). Done before the callback is handed to the scheduler or
+    # anyone else, they keep the method they were given
+    def instrument(self, obj, attribute, name=None):
+        if not self.enabled:
+            return
+
+        function = getattr(obj, attribute)
+        stats = self.stats.setdefault(name or obj.__class__.__name__ + '.' + attribute.split('__')[-1],
+                                      [0, 0.0, 0.0] + [0] * len(self.BUCKET_NAMES))
+        clock = self.clock
+
+        def timed(*args, **kwargs):
+            start = clock()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.__add(stats, clock() - start)
+
+        setattr(obj, attribute, timed)
+
+    # Counts the programs started with subprocess, and starts the stack sampler
+    def start(self):
+        if not self.enabled or self.__thread:
+            return
+
+        import subprocess
+
+        profiler = self
+        popen = subprocess.Popen
+
+        class CountingPopen(popen):
+            def __init__(self, args, *more_args, **kwargs):
+                profiler.count_spawn(args)
+                popen.__init__(self, args, *more_args, **kwargs)
+
+        subprocess.Popen = CountingPopen
+        self.__thread = threading.Thread(name='Profiler', target=self.__sampler)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread:
+            self.__stop.set()
+            self.__thread.join()
+
+    def count_spawn(self, args):
+        program = os.path.basename((args.split() if isinstance(args, str) else list(args))[0])
+
+        with self.__lock:
+            self.spawns[program] = self.spawns.get(program, 0) + 1
+
+    # Takes one sample of every thread's stack but the sampler's own
+    def sample(self):
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        own = threading.current_thread().ident
+
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+
+            stack = []
+
+            while frame is not None:
+                stack.append(self.__label(frame.f_code))
+                frame = frame.f_back
+
+            stack.append(names.get(ident, 'thread {}'.format(ident)))
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+        self.samples += 1
+
+    def report(self):
+        if not self.enabled:
+            return 'Profiler: off (profile_daemon)'
+
+        with self.__lock:
+            stats = sorted((name, list(values)) for name, values in self.stats.items())
+            spawns = sorted(self.spawns.items())
+
+        lines = ['Profiler: {:.0f}s | {} stack samples every {:.0f}ms'
+                 .format(self.clock() - self.__started, self.samples, 1000 * self.interval)]
+
+        for name, values in stats:
+            calls, seconds, slowest = values[:3]
+            lines.append('  {}: {} calls | {:.3f}s total | {:.0f}us average | {:.0f}us max | {}'
+                         .format(name, calls, seconds, 1000000 * seconds / calls if calls else 0, 1000000 * slowest,
+                                 ' '.join('{} {}'.format(bucket, count)
+                                          for bucket, count in zip(self.BUCKET_NAMES, values[3:]))))
+
+        lines.append('Subprocess spawns: ' + (' | '.join('{} {}'.format(program, count) for program, count in spawns)
+                                              or 'none'))
+        return '\r\n'.join(lines)
+
+    # Writes the report, followed by more_report (if any), to path.txt and the sampled stacks
+    # to path.folded. Returns the report
+    def dump(self, path, more_report=None):
+        report = self.report() + ('\r\n' + more_report if more_report else '')
+
+        with open(path + '.txt', 'w') as report_file:
+            report_file.write(report.replace('\r\n', '\n') + '\n')
+
+        with open(path + '.folded', 'w') as folded_file:
+            for stack, samples in sorted(self.stacks.copy().items()):
+                folded_file.write('{} {}\n'.format(stack, samples))
+
+        return report
+
+    def __add(self, stats, seconds):
+        bucket = 3
+
+        for limit in self.BUCKETS:
+            if seconds < limit:
+                break
+
+            bucket += 1
+
+        with self.__lock:
+            stats[0] += 1
+            stats[1] += seconds
+            stats[bucket] += 1
+
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+    def __label(self, code):
+        label = self.__labels.get(code)
+
+        if label is None:
+            label = self.__labels[code] = '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                              code.co_firstlineno)
+
+        return label
+
+    def __sampler(self):
+        while not self.__stop.wait(self.interval):
+            self.sample()
+
+
+# Returns the process name (/proc/<pid>/comm) or None if the process is gone
+def read_comm(pid, proc_dir='/proc', dir_fd=None):
+    try:
+        if dir_fd is not None:
+            fd = os.open('{}/comm'.format(pid), os.O_RDONLY, dir_fd=dir_fd)
+        else:
+            fd = os.open('{}/{}/comm'.format(proc_dir, pid), os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        return os.read(fd, 64).decode('utf-8', 'replace').rstrip('\n')
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+# Returns True if the pid still exists
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+# Process scan watcher class
+# Fallback for when the proc connector is not available. Scans /proc through a directory
+# handle that stays open and only reads the name of processes it has not seen before.
+# While a watched process is running it does not scan at all, it waits for the process to
+# exit on a pidfd (Linux 5.3+, Python 3.9+) or checks it with os.kill(pid, 0)
+class ProcScanWatcher:
+    event_driven = False
+
+    def __init__(self, names, proc_dir='/proc', use_pidfds=True, clock=None):
+        self.names = set(names)
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.proc_dir = proc_dir
+        self.pids = set()
+        self.__comms = {}
+        self.__new_pids = set()
+        self.__pidfds = {}
+        self.__use_pidfds = use_pidfds and hasattr(os, 'pidfd_open')
+        self.__dir_fd = None
+
+        if sys.version_info >= (3, 3) and os.listdir in os.supports_fd:
+            self.__dir_fd = os.open(proc_dir, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+
+        self.scan()
+
+    def running(self):
+        return bool(self.pids)
+
+    def scan(self):
+        comms = {}
+        new_pids = set()
+
+        for entry in os.listdir(self.__dir_fd if self.__dir_fd is not None else self.proc_dir):
+            if not entry.isdigit():
+                continue
+
+            pid = int(entry)
+            comm = self.__comms.get(pid)
+
+            # A process seen for the first time on the last scan may have been a fork
+            # that had not called exec yet, read its name one more time
+            if comm is None or pid in self.__new_pids:
+                comm = read_comm(pid, self.proc_dir, self.__dir_fd)
+
+                if comm is None:
+                    continue
+
+                if pid not in self.__comms:
+                    new_pids.add(pid)
+
+            comms[pid] = comm
+
+        self.__comms = comms
+        self.__new_pids = new_pids
+
+        for pid in self.pids - set(comms):
+            self.__forget(pid)
+
+        for pid, comm in comms.items():
+            if comm in self.names and pid not in self.pids:
+                self.__track(pid)
+
+        return self.running()
+
+    # Waits up to timeout seconds, returns True if the running state changed
+    def wait(self, timeout, stop_event=None):
+        was_running = self.running()
+
+        if self.pids and self.__pidfds:
+            # Block until one of the processes exits
+            readable = select.select(list(self.__pidfds.values()), [], [], timeout)[0]
+
+            for pid, fd in list(self.__pidfds.items()):
+                if fd in readable:
+                    self.__forget(pid)
+        else:
+            if stop_event:
+                stop_event.wait(timeout)
+            else:
+                self.clock.sleep(timeout)
+
+            for pid in list(self.pids):
+                if not pid_exists(pid):
+                    self.__forget(pid)
+
+        # Nothing being tracked anymore, scan for new processes
+        if not self.pids:
+            self.scan()
+
+        return self.running() != was_running
+
+    def close(self):
+        for pid in list(self.pids):
+            self.__forget(pid)
+
+        if self.__dir_fd is not None:
+            os.close(self.__dir_fd)
+            self.__dir_fd = None
+
+    def __track(self, pid):
+        self.pids.add(pid)
+
+        if self.__use_pidfds:
+            try:
+                self.__pidfds[pid] = os.pidfd_open(pid)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    self.pids.discard(pid)
+                else:
+                    # Kernel does not support pidfds, use os.kill(pid, 0) instead
+                    self.__use_pidfds = False
+
+    def __forget(self, pid):
+        self.pids.discard(pid)
+        fd = self.__pidfds.pop(pid, None)
+
+        if fd is not None:
+            os.close(fd)
+
+
+# Proc connector watcher class
+# Subscribes to the fork, exec and exit events of the kernel proc connector (requires root)
+# so processes starting and exiting wake up the watcher, nothing is polled
+class ProcConnectorWatcher:
+    event_driven = True
+
+    def __init__(self, names, proc_dir='/proc'):
+        self.names = set(names)
+        self.proc_dir = proc_dir
+        self.pids = set()
+        self.__socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+
+        try:
+            self.__socket.bind((0, CN_IDX_PROC))
+            self.__send_op(PROC_CN_MCAST_LISTEN)
+            self.__wait_ack()
+            self.__socket.setblocking(False)
+        except:
+            self.__socket.close()
+            raise
+
+        self.__resync()
+
+    def fileno(self):
+        return self.__socket.fileno()
+
+    def running(self):
+        return bool(self.pids)
+
+    # Waits up to timeout seconds, returns True if the running state changed
+    def wait(self, timeout, stop_event=None):
+        was_running = self.running()
+
+        if select.select([self.__socket], [], [], timeout)[0]:
+            self.read_events()
+
+        return self.running() != was_running
+
+    def read_events(self):
+        while True:
+            try:
+                data = self.__socket.recv(4096)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.errno == errno.ENOBUFS:
+                    # Events were dropped, the only way to catch up is a full scan
+                    self.__resync()
+                    continue
+                raise
+
+            self.__handle(data)
+
+    def close(self):
+        try:
+            self.__send_op(PROC_CN_MCAST_IGNORE)
+        except socket.error:
+            pass
+
+        self.__socket.close()
+
+    def __resync(self):
+        scanner = ProcScanWatcher(self.names, self.proc_dir, use_pidfds=False)
+        self.pids = set(scanner.pids)
+        scanner.close()
+
+    def __send_op(self, op):
+        cn_msg = struct.pack('=IIIIHHI', CN_IDX_PROC, CN_VAL_PROC, 0, 0, 4, 0, op)
+        self.__socket.send(struct.pack('=IHHII', 16 + len(cn_msg), NLMSG_DONE, 0, 0, os.getpid()) + cn_msg)
+
+    # The kernel acknowledges the subscription, a non zero error means we are not allowed to listen
+    def __wait_ack(self):
+        if not select.select([self.__socket], [], [], 1)[0]:
+            return
+
+        data = self.__socket.recv(4096)
+
+        if len(data) >= PROC_EVENT_OFFSET + 20:
+            what, = struct.unpack_from('=I', data, PROC_EVENT_OFFSET)
+            err, = struct.unpack_from('=I', data, PROC_EVENT_OFFSET + 16)
+
+            if what == PROC_EVENT_NONE and err:
+                raise OSError(err, os.strerror(err))
+
+    def __handle(self, data):
+        offset = 0
+
+        while offset + PROC_EVENT_OFFSET + 16 <= len(data):
+            length, = struct.unpack_from('=I', data, offset)
+
+            if length < PROC_EVENT_OFFSET + 16:
+                return
+
+            # Each kind of event is only read if the message holds all of it (fork events are the
+            # longest, through event + 32), a truncated one is skipped
+            end = min(offset + length, len(data))
+            event = offset + PROC_EVENT_OFFSET
+            what, = struct.unpack_from('=I', data, event)
+
+            if what == PROC_EVENT_FORK and event + 32 <= end:
+                parent_tgid, child_pid, child_tgid = struct.unpack_from('=iii', data, event + 20)
+
+                # Children of a watched process (rsync forks its receiver) are watched too
+                if parent_tgid in self.pids and child_pid == child_tgid:
+                    self.pids.add(child_tgid)
+            elif what == PROC_EVENT_EXEC and event + 24 <= end:
+                pid, tgid = struct.unpack_from('=ii', data, event + 16)
+
+                if read_comm(tgid, self.proc_dir) in self.names:
+                    self.pids.add(tgid)
+                else:
+                    self.pids.discard(tgid)
+            elif what == PROC_EVENT_EXIT and event + 24 <= end:
+                pid, tgid = struct.unpack_from('=ii', data, event + 16)
+
+                if pid == tgid:
+                    self.pids.discard(tgid)
+
+            offset += (length + 3) & ~3
+
+
+# Returns the proc connector watcher when we are allowed to use it, the /proc scan otherwise
+def create_process_watcher(names):
+    try:
+        return ProcConnectorWatcher(names)
+    except (socket.error, OSError, AttributeError):
+        return ProcScanWatcher(names)
+
+
+# inotify Watcher class
+# Watches the RetroPie tree for files being written by any tool (cp, Samba, SFTP, rsync).
+# While files are being written it reports a transfer in progress, until idle_timeout
+# seconds after the last write. Bytes are measured from the size of the files being
+# written, events are read at most every read_interval seconds so a busy copy costs a
+# couple of wakeups per second and an idle tree costs none.
+#
+# inotify needs one watch per directory. Directories are added breadth first, so when the
+# watch budget (half of fs.inotify.max_user_watches unless max_watches is given) or the
+# kernel limit is hit, the top of the tree (e.g. every roms/<system> directory) is still
+# watched and only the deepest directories are left out. This is logged once, new directories
+# left out after that are counted in the summary of each write session. Copies into those
+# directories are still caught by the rsync watcher. Raise the limit with
+#   sudo sysctl fs.inotify.max_user_watches=<watches>
+class InotifyWatcher:
+    def __init__(self, root='/home/pi/RetroPie', idle_timeout=5, read_interval=0.5, rate_window=5,
+                 max_watches=None, log_queue=None, print_queue=None, clock=None):
+        self.root = root
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.idle_timeout = idle_timeout
+        self.read_interval = read_interval
+        self.rate_window = rate_window
+        self.max_watches = max_watches if max_watches else self.__watch_budget()
+        self.logger = log_queue
+        self.printer = print_queue
+        self.limited = False
+        # Directories left out once the watch limit was reached
+        self.unwatched = 0
+        self.session_start = 0
+        self.session_bytes = 0
+        self.session_files = 0
+        # Bytes written since the watcher was created, for TransferMeter
+        self.total_bytes = 0
+        self.scheduler = None
+        self.__libc = load_libc()
+        self.__fd = self.__libc.inotify_init1(os.O_NONBLOCK | IN_CLOEXEC)
+        self.__watches = {}
+        self.__sizes = {}
+        self.__modified = set()
+        self.__samples = deque()
+        self.__active = False
+        self.__on_change = None
+        self.__read_task = None
+        self.__idle_task = None
+
+        if self.__fd < 0:
+            error = libc_errno()
+            raise OSError(error, os.strerror(error))
+
+        self.__add_tree(root)
+
+    def fileno(self):
+        return self.__fd
+
+    def running(self):
+        return self.__active
+
+    # Bytes and files written per second over the last rate_window seconds
+    def rates(self):
+        now = self.clock.monotonic()
+
+        while self.__samples and now - self.__samples[0][0] > self.rate_window:
+            self.__samples.popleft()
+
+        return (sum(sample[1] for sample in self.__samples) / float(self.rate_window),
+                sum(sample[2] for sample in self.__samples) / float(self.rate_window))
+
+    # on_change() is called every time a transfer starts or ends
+    def start(self, scheduler, on_change=None):
+        self.scheduler = scheduler
+        self.__on_change = on_change
+        self.__read_task = scheduler.add_reader(self.__fd, self.__readable, 'InotifyWatcher.read')
+
+    def stop(self):
+        if self.scheduler:
+            self.scheduler.cancel(self.__read_task)
+            self.scheduler.cancel(self.__idle_task)
+            self.scheduler = None
+
+    def close(self):
+        self.stop()
+        os.close(self.__fd)
+
+    # Stop listening until read_interval seconds have passed, the events that arrive
+    # in the meantime are read in one go
+    def __readable(self):
+        self.scheduler.cancel(self.__read_task)
+        self.__read_task = self.scheduler.call_later(self.read_interval, self.__read_events,
+                                                     'InotifyWatcher.read', self.read_interval)
+
+    def __read_events(self):
+        written_bytes = 0
+        written_files = 0
+        closed = set()
+        # cookie: path a file was moved from, to pair it with where it was moved to
+        moved = {}
+
+        while True:
+            try:
+                data = os.read(self.__fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            offset = 0
+
+            while offset + 16 <= len(data):
+                wd, mask, cookie, length = struct.unpack_from('=iIII', data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+                offset += 16 + length
+                directory = self.__watches.get(wd)
+
+                if mask & IN_IGNORED:
+                    self.__watches.pop(wd, None)
+                    continue
+
+                if directory is None or mask & IN_Q_OVERFLOW:
+                    continue
+
+                if not isinstance(directory, bytes):
+                    name = os.fsdecode(name)
+
+                path = os.path.join(directory, name)
+
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        # Files copied into the new directory before its watch existed count too
+                        added_bytes, added_files = self.__add_tree(path, new=True)
+                        written_bytes += added_bytes
+                        written_files += added_files
+                elif mask & IN_MODIFY:
+                    self.__modified.add(path)
+                elif mask & IN_CLOSE_WRITE:
+                    self.__modified.add(path)
+                    closed.add(path)
+
+                    # rsync writes into a .name.XXXXXX temporary file and renames it into place,
+                    # the file is counted when it shows up under its own name
+                    if name[:1] not in (b'.', '.'):
+                        written_files += 1
+                elif mask & IN_MOVED_FROM:
+                    moved[cookie] = path
+                elif mask & IN_MOVED_TO:
+                    source = moved.pop(cookie, None)
+
+                    if source is None:
+                        # Moved in from outside the tree, all of it is new here
+                        self.__modified.add(path)
+                        written_files += 1
+                        continue
+
+                    # Renamed inside the tree, the bytes counted so far under the old name stay counted
+                    for paths in self.__modified, closed:
+                        if source in paths:
+                            paths.discard(source)
+                            paths.add(path)
+
+                    if source in self.__sizes:
+                        self.__sizes[path] = self.__sizes.pop(source)
+
+                    if os.path.basename(source)[:1] in (b'.', '.'):
+                        written_files += 1
+
+        # Bytes written since the last read, from the growth of every file written to
+        for path in self.__modified:
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                self.__sizes.pop(path, None)
+                continue
+
+            written_bytes += max(0, size - self.__sizes.get(path, 0))
+            self.__sizes[path] = size
+
+        # Only files that are still being written need their size remembered
+        for path in closed:
+            self.__sizes.pop(path, None)
+
+        self.__modified = set()
+
+        self.__read_task = self.scheduler.add_reader(self.__fd, self.__readable, 'InotifyWatcher.read')
+
+        if written_bytes or written_files:
+            self.__activity(written_bytes, written_files)
+
+    def __activity(self, written_bytes, written_files):
+        self.__samples.append((self.clock.monotonic(), written_bytes, written_files))
+        self.session_bytes += written_bytes
+        self.session_files += written_files
+        self.total_bytes += written_bytes
+
+        self.scheduler.cancel(self.__idle_task)
+        self.__idle_task = self.scheduler.call_later(self.idle_timeout, self.__idle, 'InotifyWatcher.idle', 1)
+
+        if not self.__active:
+            self.__active = True
+            self.session_start = self.clock.time()
+
+            if self.__on_change:
+                self.__on_change()
+
+    def __idle(self):
+        self.__idle_task = None
+        self.__active = False
+        self.__sizes.clear()
+        seconds = max(self.clock.time() - self.idle_timeout - self.session_start, 1)
+
+        write_log('ROM directory writes ended: {} files | {:.1f}MB | {:.2f}MB/s{}'
+                  .format(self.session_files, self.session_bytes / 1048576.0,
+                          self.session_bytes / 1048576.0 / seconds,
+                          ' | {} directories not watched (watch limit)'.format(self.unwatched)
+                          if self.unwatched else ''), self.logger, self.printer)
+
+        self.session_bytes = self.session_files = 0
+
+        if self.__on_change:
+            self.__on_change()
+
+    # Watches directory and every directory below it (breadth first). For a new directory
+    # (created or moved into the tree) returns the bytes and files already in it, files still
+    # being written remember the size they had so only their growth is counted later on. The
+    # walk of the whole tree at startup only looks for directories, it does not stat the ROMs
+    def __add_tree(self, directory, new=False):
+        found_bytes = 0
+        found_files = 0
+        pending = deque([directory])
+
+        while pending:
+            directory = pending.popleft()
+
+            if not self.__add_watch(directory):
+                # Logged when the limit is reached, new directories after that are counted for __idle
+                if self.unwatched:
+                    self.unwatched += 1 + len(pending)
+                else:
+                    self.unwatched = 1 + len(pending)
+                    write_log('inotify watch limit reached ({} directories watched), {} and the {} directories '
+                              'queued after it are not watched. Raise fs.inotify.max_user_watches to watch the '
+                              'whole tree'.format(len(self.__watches), directory, len(pending)),
+                              self.logger, self.printer, {'PRIORITY': 4})
+
+                break
+
+            try:
+                entries = self.__list(directory)
+            except OSError:
+                continue
+
+            for path, is_directory in entries:
+                if is_directory:
+                    pending.append(path)
+                    continue
+
+                if not new:
+                    continue
+
+                try:
+                    size = os.lstat(path).st_size
+                except OSError:
+                    continue
+
+                found_bytes += size
+                found_files += 1
+
+                if len(self.__sizes) < 4096:
+                    self.__sizes[path] = size
+
+        return found_bytes, found_files
+
+    # (path, is a directory) of the entries of directory. os.scandir (Python 3.5+) gets the type
+    # from the directory entry, without a stat of every file
+    @staticmethod
+    def __list(directory):
+        if hasattr(os, 'scandir'):
+            entries = []
+
+            for entry in os.scandir(directory):
+                try:
+                    entries.append((entry.path, entry.is_dir(follow_symlinks=False)))
+                except OSError:
+                    continue
+
+            return entries
+
+        entries = []
+
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+
+            try:
+                entries.append((path, S_ISDIR(os.lstat(path).st_mode)))
+            except OSError:
+                continue
+
+        return entries
+
+    def __add_watch(self, directory):
+        if self.limited:
+            return False
+
+        if len(self.__watches) >= self.max_watches:
+            wd = -1
+            error = errno.ENOSPC
+        else:
+            path = directory if isinstance(directory, bytes) else os.fsencode(directory)
+            wd = self.__libc.inotify_add_watch(self.__fd, path, INOTIFY_WATCH_MASK)
+            error = libc_errno()
+
+        if wd >= 0:
+            self.__watches[wd] = directory
+            return True
+
+        if error == errno.ENOSPC:
+            self.limited = True
+            return False
+
+        # Directory vanished or is not readable, keep going with the others
+        if error != errno.ENOENT:
+            write_log('inotify: {} is not watched: {}'.format(directory, os.strerror(error)), self.logger,
+                      self.printer, {'PRIORITY': 4})
+
+        return True
+
+    @staticmethod
+    def __watch_budget():
+        try:
+            with open('/proc/sys/fs/inotify/max_user_watches') as max_user_watches:
+                return max(1, int(max_user_watches.read()) // 2)
+        except (OSError, IOError, ValueError):
+            return 4096
+
+
+# Copy Progress Watcher class
+# Follows the progress file the setup.py copy engine writes while it moves the ROM library.
+# A copy is running while the file exists and the process writing it is alive, checked
+# with a single stat every interval seconds while it runs. Otherwise nothing is polled, an
+# inotify watch on the directory of the file wakes the watcher up when it shows up (every
+# idle_interval seconds if the directory can not be watched)
+class CopyProgressWatcher:
+    def __init__(self, path='/run/pistation2/copy-progress.json', interval=1, rate_window=5, idle_interval=30,
+                 clock=None):
+        self.path = path
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.interval = interval
+        self.rate_window = rate_window
+        self.idle_interval = idle_interval
+        self.pids = set()
+        self.expected_bytes = 0
+        # Bytes copied since the watcher was created, for TransferMeter
+        self.total_bytes = 0
+        self.progress = {}
+        self.scheduler = None
+        self.__mtime = None
+        self.__last_done = None
+        self.__samples = deque()
+        self.__on_change = None
+        self.__task = None
+        self.__task_interval = None
+        self.__fd = None
+        self.__read_task = None
+
+    def running(self):
+        return bool(self.pids)
+
+    # Bytes and files copied per second over the last rate_window seconds
+    def rates(self):
+        if len(self.__samples) < 2:
+            return 0.0, 0.0
+
+        first, last = self.__samples[0], self.__samples[-1]
+        elapsed = last[0] - first[0]
+
+        if elapsed <= 0:
+            return 0.0, 0.0
+
+        return (last[1] - first[1]) / elapsed, (last[2] - first[2]) / float(elapsed)
+
+    # on_change() is called every time a copy starts or ends
+    def start(self, scheduler, on_change=None):
+        self.scheduler = scheduler
+        self.__on_change = on_change
+        self.__fd = self.__watch_directory()
+
+        if self.__fd is not None:
+            self.__read_task = scheduler.add_reader(self.__fd, self.__read_events, 'CopyProgressWatcher.read')
+
+        self.__check()
+
+    def stop(self):
+        if self.scheduler:
+            self.scheduler.cancel(self.__task)
+            self.scheduler.cancel(self.__read_task)
+            self.scheduler = None
+
+        self.__task = self.__task_interval = self.__read_task = None
+
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    # The events only say something changed in the directory, the file is checked
+    def __read_events(self):
+        try:
+            while os.read(self.__fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        self.__check()
+
+    # inotify descriptor watching the directory of the progress file, created if it is not there
+    # yet (/run is emptied at boot), None if it can not be watched
+    def __watch_directory(self):
+        directory = os.path.dirname(self.path)
+
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            libc = load_libc()
+        except (OSError, AttributeError):
+            return None
+
+        fd = libc.inotify_init1(os.O_NONBLOCK | IN_CLOEXEC)
+
+        if fd < 0:
+            return None
+
+        path = directory if isinstance(directory, bytes) else os.fsencode(directory)
+
+        if libc.inotify_add_watch(fd, path, PROGRESS_WATCH_MASK) < 0:
+            os.close(fd)
+            return None
+
+        return fd
+
+    # Checks every interval seconds while a copy runs, otherwise only on inotify events (or
+    # every idle_interval seconds without them)
+    def __schedule(self):
+        if not self.scheduler:
+            return
+
+        interval = self.interval if self.running() else None if self.__fd is not None else self.idle_interval
+
+        if interval == self.__task_interval:
+            return
+
+        self.scheduler.cancel(self.__task)
+        self.__task = self.scheduler.call_every(interval, self.__check, 'CopyProgressWatcher.check',
+                                                interval / 2.0) if interval else None
+        self.__task_interval = interval
+
+    def __check(self):
+        was_running = self.running()
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+
+        if mtime is None:
+            self.progress = {}
+            self.__samples.clear()
+        elif mtime != self.__mtime:
+            try:
+                import json
+
+                with open(self.path) as progress_file:
+                    self.progress = json.load(progress_file)
+            except (OSError, IOError, ValueError):
+                # Caught it while being replaced, read it next time
+                mtime = self.__mtime
+
+        self.__mtime = mtime
+        pid = self.progress.get('pid')
+        self.pids = set([pid]) if pid and pid_exists(pid) else set()
+        self.expected_bytes = self.progress.get('bytes_total', 0)
+
+        if self.pids:
+            now = self.clock.monotonic()
+            done = self.progress.get('bytes_done', 0)
+            self.__samples.append((now, done, self.progress.get('files_done', 0)))
+
+            # A resumed copy starts from what was copied before, only what it copies from now on counts
+            if self.__last_done is not None:
+                self.total_bytes += max(0, done - self.__last_done)
+
+            self.__last_done = done
+
+            while now - self.__samples[0][0] > self.rate_window:
+                self.__samples.popleft()
+
+        self.__schedule()
+
+        if self.running() != was_running and self.__on_change:
+            self.__on_change()
+
+
+# Transfer Meter class
+# Measures how fast the copying processes move data from /proc/<pid>/io (bytes that
+# actually hit storage), no subprocesses. A local rsync reads in one process and writes in
+# another, so the transfer is the larger of all bytes read and all bytes written.
+# Copies without a process to measure (Samba or cp writes seen by inotify, the setup.py copy
+# engine) are measured from the byte counter of their source instead, see sample().
+# The ETA comes from the size of the sources on the command line of the first process,
+# measured once per session in the background (remote sources have no ETA)
+class TransferMeter:
+    def __init__(self, proc_dir='/proc', stall_rate=16384, clock=None):
+        self.proc_dir = proc_dir
+        self.clock = clock if clock else SYSTEM_CLOCK
+        # Below this many bytes/s the transfer counts as stalled
+        self.stall_rate = stall_rate
+        self.expected_bytes = 0
+        self.rate = 0.0
+        self.peak_rate = 0.0
+        self.stalled_seconds = 0.0
+        # Seconds the transfer has been stalled for without a break
+        self.current_stall = 0.0
+        self.__files = {}
+        self.__counters = {}
+        self.__finished = [0, 0]
+        self.__transferred = 0
+        self.__source_start = 0
+        self.__start = 0
+        self.__last_sample = 0
+
+    # source_bytes: the byte counters of the activity sources added up (see sample)
+    def start(self, pids, source_bytes=0):
+        self.expected_bytes = 0
+        self.rate = self.peak_rate = self.stalled_seconds = self.current_stall = 0.0
+        self.__finished = [0, 0]
+        self.__transferred = 0
+        self.__source_start = source_bytes
+        self.__start = self.__last_sample = self.clock.monotonic()
+        self.__add(pids)
+
+        if pids:
+            measure = threading.Thread(name='TransferMeter', target=self.__measure_sources, args=(min(pids),))
+            measure.daemon = True
+            measure.start()
+
+    # Reads the counters of every copying process, returns the current bytes/s. source_bytes
+    # is what the activity sources have counted, the transfer is the larger of the two (an
+    # rsync into the RetroPie tree is seen by both)
+    def sample(self, pids, source_bytes=0):
+        now = self.clock.monotonic()
+        self.__add(pids)
+        total_read, total_write = self.__finished
+
+        for pid in list(self.__files):
+            counters = self.__read(pid)
+
+            if counters is None or pid not in pids:
+                # Exited, its last counters stay part of the transfer
+                self.__forget(pid)
+                continue
+
+            total_read += counters[0]
+            total_write += counters[1]
+
+        transferred = max(total_read, total_write, source_bytes - self.__source_start, self.__transferred)
+        elapsed = now - self.__last_sample
+
+        if elapsed > 0:
+            self.rate = (transferred - self.__transferred) / elapsed
+            self.peak_rate = max(self.peak_rate, self.rate)
+
+            if self.rate < self.stall_rate:
+                self.stalled_seconds += elapsed
+                self.current_stall += elapsed
+            else:
+                self.current_stall = 0.0
+
+        self.__transferred = transferred
+        self.__last_sample = now
+        return self.rate
+
+    def transferred(self):
+        return self.__transferred
+
+    def average_rate(self):
+        elapsed = self.clock.monotonic() - self.__start
+        return self.__transferred / elapsed if elapsed > 0 else 0.0
+
+    # Seconds left at the average rate, None if unknown
+    def eta(self):
+        average_rate = self.average_rate()
+
+        if not self.expected_bytes or not average_rate:
+            return None
+
+        return max(0, self.expected_bytes - self.__transferred) / average_rate
+
+    def stop(self):
+        for pid in list(self.__files):
+            self.__forget(pid)
+
+    def summary(self):
+        eta = self.eta()
+
+        return '{:.1f}MB | {:.2f}MB/s now | {:.2f}MB/s average | {:.2f}MB/s peak | {}s stalled{}'.format(
+            self.__transferred / 1048576.0, self.rate / 1048576.0, self.average_rate() / 1048576.0,
+            self.peak_rate / 1048576.0, int(self.stalled_seconds),
+            ' | ETA {}s'.format(int(eta)) if eta is not None else '')
+
+    def __add(self, pids):
+        for pid in pids:
+            if pid not in self.__files:
+                try:
+                    self.__files[pid] = SysfsFile('{}/{}/io'.format(self.proc_dir, pid), 512)
+                except OSError:
+                    pass
+
+    def __read(self, pid):
+        try:
+            data = self.__files[pid].read()
+        except OSError:
+            return None
+
+        read_bytes = write_bytes = 0
+
+        for line in data.decode().splitlines():
+            if line.startswith('read_bytes:'):
+                read_bytes = int(line[11:])
+            elif line.startswith('write_bytes:'):
+                write_bytes = int(line[12:])
+
+        self.__counters[pid] = read_bytes, write_bytes
+        return read_bytes, write_bytes
+
+    def __forget(self, pid):
+        counters = self.__counters.pop(pid, None)
+
+        if counters:
+            self.__finished[0] += counters[0]
+            self.__finished[1] += counters[1]
+
+        self.__files.pop(pid).close()
+
+    # Adds up the size of every local source on the command line (everything that is
+    # not an option, except the destination)
+    def __measure_sources(self, pid):
+        try:
+            with open('{}/{}/cmdline'.format(self.proc_dir, pid), 'rb') as cmdline:
+                arguments = cmdline.read().split(b'\0')[1:]
+        except (OSError, IOError):
+            return
+
+        sources = [argument for argument in arguments if argument and not argument.startswith(b'-')][:-1]
+        expected_bytes = 0
+
+        if not sources:
+            return
+
+        for source in sources:
+            if b':' in source or not os.path.exists(source):
+                return
+
+            if not os.path.isdir(source):
+                expected_bytes += os.path.getsize(source)
+                continue
+
+            for directory, _, files in os.walk(source):
+                for name in files:
+                    try:
+                        expected_bytes += os.lstat(os.path.join(directory, name)).st_size
+                    except OSError:
+                        pass
+
+        self.expected_bytes = expected_bytes
+
+
+# libc loaded once, for the syscalls Python has no wrapper for. ctypes is only imported
+# when it is first needed (find_library runs ldconfig), see the imports at the top
+libc = None
+
+
+def load_libc():
+    global libc
+
+    if libc is None:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+    return libc
+
+
+# errno of the last libc call made through load_libc()
+def libc_errno():
+    import ctypes
+
+    return ctypes.get_errno()
+
+
+# ABI of this process for the syscall numbers. The kernel architecture (uname) is not enough: the
+# default 32-bit Raspberry Pi OS runs a 64-bit kernel on the Pi 4 and 5, its processes use the
+# arm syscall numbers
+def ioprio_abi():
+    machine = os.uname()[4]
+
+    if machine.startswith('arm') or machine == 'aarch64':
+        return 'arm' if struct.calcsize('P') == 4 else 'aarch64'
+
+    if machine == 'x86_64' or (machine.startswith('i') and machine.endswith('86')):
+        return 'i386' if struct.calcsize('P') == 4 else 'x86_64'
+
+    return machine
+
+
+# Sets the I/O scheduling class and priority of a process (0 = this process), Python has no
+# wrapper for the ioprio_set syscall. Returns False if the architecture is unknown or it failed
+def ioprio_set(pid, ioprio_class, ioprio_data=0):
+    number = IOPRIO_SET_SYSCALLS.get(ioprio_abi())
+
+    if number is None:
+        return False
+
+    return load_libc().syscall(number, IOPRIO_WHO_PROCESS, pid,
+                               (ioprio_class << IOPRIO_CLASS_SHIFT) | ioprio_data) == 0
+
+
+# Returns the raw I/O priority (class << IOPRIO_CLASS_SHIFT | data) of a process, None if unknown
+def ioprio_get(pid):
+    number = IOPRIO_GET_SYSCALLS.get(ioprio_abi())
+
+    if number is None:
+        return None
+
+    ioprio = load_libc().syscall(number, IOPRIO_WHO_PROCESS, pid)
+    return ioprio if ioprio >= 0 else None
+
+
+# Nice value of a process, os.getpriority/os.setpriority are Python 3.3+
+def get_nice(pid):
+    if hasattr(os, 'getpriority'):
+        return os.getpriority(os.PRIO_PROCESS, pid)
+
+    import ctypes
+
+    # getpriority returns -1 for a nice value of -1 too, only errno tells them apart
+    libc = load_libc()
+    ctypes.set_errno(0)
+    nice = libc.getpriority(PRIO_PROCESS, pid)
+
+    if nice == -1 and libc_errno():
+        raise OSError(libc_errno(), os.strerror(libc_errno()))
+
+    return nice
+
+
+def set_nice(pid, nice):
+    if hasattr(os, 'setpriority'):
+        return os.setpriority(os.PRIO_PROCESS, pid, nice)
+
+    if load_libc().setpriority(PRIO_PROCESS, pid, nice) != 0:
+        raise OSError(libc_errno(), os.strerror(libc_errno()))
+
+
+# Copy Priority Manager class
+# While an emulator is running, copies (rsync, the setup.py copy engine) must not take the
+# SD card, the USB bus or the CPU away from it. Every thread of the copying processes is
+# moved to the idle I/O class and nice 19 while a game is up, and put back the way it was
+# when the game ends or the copy does. Each protected window is logged.
+# Emulators are only looked for while something is being copied (update() is called by
+# RsyncMonitor once a second during a copy), an idle daemon pays nothing for it
+class CopyPriorityManager:
+    def __init__(self, names=None, nice=19, proc_dir='/proc', log_queue=None, print_queue=None, clock=None):
+        self.names = names if names else EMULATOR_PROCESSES
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.nice = nice
+        self.proc_dir = proc_dir
+        self.logger = log_queue
+        self.printer = print_queue
+        self.watcher = None
+        # tid: (nice, ioprio) before it was lowered
+        self.__saved = {}
+        self.__window_start = None
+        self.__emulator = None
+        self.__lowered = 0
+        # Threads left at their I/O priority, ioprio_set failed
+        self.__ioprio_failed = 0
+
+    def protecting(self):
+        return self.__window_start is not None
+
+    # Lowers the copy processes while an emulator runs, restores them once it is gone
+    def update(self, copy_pids):
+        if self.watcher is None:
+            self.watcher = ProcScanWatcher(self.names, self.proc_dir)
+        else:
+            self.watcher.wait(0)
+
+        if not self.watcher.running():
+            self.restore()
+            return
+
+        if self.__window_start is None:
+            self.__window_start = self.clock.monotonic()
+            self.__emulator = ', '.join(sorted(set(read_comm(pid, self.proc_dir) or str(pid)
+                                                   for pid in self.watcher.pids)))
+            self.__lowered = self.__ioprio_failed = 0
+            write_log('{} running, copies moved to idle I/O and nice {}'.format(self.__emulator, self.nice),
+                      self.logger, self.printer)
+
+        # New copy processes and threads show up while the game runs (rsync forks its receiver)
+        for pid in copy_pids:
+            for tid in self.__threads(pid):
+                if tid not in self.__saved:
+                    self.__lower(tid)
+
+    # Puts every lowered thread back and ends the protected window, if any
+    def restore(self):
+        for tid, (nice, ioprio) in list(self.__saved.items()):
+            try:
+                set_nice(tid, nice)
+
+                if ioprio is not None:
+                    ioprio_set(tid, ioprio >> IOPRIO_CLASS_SHIFT, ioprio & ((1 << IOPRIO_CLASS_SHIFT) - 1))
+            except OSError:
+                # The thread exited
+                pass
+
+        self.__saved = {}
+
+        if self.__window_start is not None:
+            write_log('{} protected for {:.0f}s: {} copy threads lowered{}'
+                      .format(self.__emulator, self.clock.monotonic() - self.__window_start, self.__lowered,
+                              ', {} only by nice (ioprio_set failed)'.format(self.__ioprio_failed)
+                              if self.__ioprio_failed else ''), self.logger, self.printer)
+            self.__window_start = None
+
+    def close(self):
+        self.restore()
+
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
+
+    def __threads(self, pid):
+        try:
+            return [int(tid) for tid in os.listdir('{}/{}/task'.format(self.proc_dir, pid))]
+        except OSError:
+            return []
+
+    def __lower(self, tid):
+        try:
+            saved = (get_nice(tid), ioprio_get(tid))
+            set_nice(tid, max(self.nice, saved[0]))
+            ioprio_set_done = ioprio_set(tid, IOPRIO_CLASS_IDLE)
+        except OSError:
+            return
+
+        self.__saved[tid] = saved
+        self.__lowered += 1
+
+        # Logged once per window, the nice value is still lowered
+        if not ioprio_set_done:
+            if not self.__ioprio_failed:
+                write_log('Copy thread {} not moved to idle I/O: ioprio_set failed ({}, {})'
+                          .format(tid, ioprio_abi(), os.strerror(libc_errno())
+                                  if ioprio_abi() in IOPRIO_SET_SYSCALLS else 'no syscall number'),
+                          self.logger, self.printer, {'PRIORITY': 4})
+
+            self.__ioprio_failed += 1
+
+
+# cpufreq Policy class
+# The cpufreq files of one policy (the cores that share a clock, all of them on a Pi)
+class CpufreqPolicy:
+    def __init__(self, path):
+        self.path = path
+        self.cur_freq = SysfsFile(path + '/scaling_cur_freq')
+        self.min_limit = self.read_int('cpuinfo_min_freq')
+        self.max_limit = self.read_int('cpuinfo_max_freq')
+
+        try:
+            self.governors = self.read('scaling_available_governors').split()
+        except (OSError, IOError):
+            self.governors = []
+
+    def read(self, name):
+        with open('{}/{}'.format(self.path, name)) as value:
+            return value.read().strip()
+
+    def read_int(self, name):
+        return int(self.read(name))
+
+    def write(self, name, value):
+        with open('{}/{}'.format(self.path, name), 'w') as setting:
+            setting.write(str(value))
+
+    # Current governor, minimum and maximum frequency
+    def settings(self):
+        return self.read('scaling_governor'), self.read_int('scaling_min_freq'), self.read_int('scaling_max_freq')
+
+    # The limits are written in the order that keeps min <= max at every step, the kernel
+    # refuses anything else
+    def apply(self, governor, min_freq, max_freq):
+        if governor and governor != self.read('scaling_governor'):
+            self.write('scaling_governor', governor)
+
+        if min_freq > self.read_int('scaling_max_freq'):
+            self.write('scaling_max_freq', max_freq)
+            self.write('scaling_min_freq', min_freq)
+        else:
+            self.write('scaling_min_freq', min_freq)
+            self.write('scaling_max_freq', max_freq)
+
+    def close(self):
+        self.cur_freq.close()
+
+
+# CPU Profile Manager class
+# Sets the cpufreq governor and frequency limits for what the Pi is doing: CPU_PROFILE_EMULATOR
+# while an emulator runs, CPU_PROFILE_COPY while ROMs are copied (is_copying) and
+# CPU_PROFILE_IDLE otherwise. Emulators are followed with a process watcher (event driven with
+# the proc connector), copies every interval seconds. When a switch raises the lowest clock the
+# governor will run at, the fan is spun up ahead of the heat (FanMonitor.pre_spin).
+# Every switch is logged with the frequency and temperature before it and response_delay
+# seconds after it. The settings found at the first switch are put back by close(). With a
+# settings_path they are also written there until then, and a daemon that crashed (or was
+# killed by the watchdog) before it could put them back picks them up from there
+class CpuProfileManager:
+    def __init__(self, cpu_dir='/sys/devices/system/cpu', watcher=None, is_copying=None, fan_monitor=None,
+                 sampler=None, interval=5, response_delay=10, emulator_profile=CPU_PROFILE_EMULATOR,
+                 copy_profile=CPU_PROFILE_COPY, idle_profile=CPU_PROFILE_IDLE, log_queue=None, print_queue=None,
+                 settings_path=None):
+        self.watcher = watcher if watcher else create_process_watcher(EMULATOR_PROCESSES)
+        self.is_copying = is_copying
+        self.fan_monitor = fan_monitor
+        self.sampler = sampler
+        self.interval = interval
+        self.response_delay = response_delay
+        self.emulator_profile = emulator_profile
+        self.copy_profile = copy_profile
+        self.idle_profile = idle_profile
+        self.logger = log_queue
+        self.printer = print_queue
+        self.profile = None
+        self.switches = 0
+        self.scheduler = None
+        self.policies = []
+        self.settings_path = settings_path
+        # policy path: (governor, min, max) before the first switch
+        self.__saved = self.__load_saved()
+        self.__tasks = []
+        self.__response_task = None
+
+        for path in self.__policy_paths(cpu_dir):
+            try:
+                self.policies.append(CpufreqPolicy(path))
+            except (OSError, IOError, ValueError):
+                # Offline core or no cpufreq driver
+                pass
+
+    def start(self, scheduler):
+        self.scheduler = scheduler
+
+        if self.watcher.event_driven:
+            self.__tasks.append(scheduler.add_reader(self.watcher, self.__read_events, 'CpuProfileManager.watch'))
+
+        self.__tasks.append(scheduler.call_every(self.interval, self.update, 'CpuProfileManager.update'))
+        self.update()
+
+    def stop(self):
+        if self.scheduler:
+            for task in self.__tasks + [self.__response_task]:
+                self.scheduler.cancel(task)
+
+            self.__tasks = []
+            self.__response_task = None
+            self.scheduler = None
+
+    # The profile for what is running now
+    def wanted_profile(self):
+        if not self.watcher.event_driven:
+            self.watcher.wait(0)
+
+        if self.watcher.running():
+            return self.emulator_profile
+
+        if self.is_copying and self.is_copying():
+            return self.copy_profile
+
+        return self.idle_profile
+
+    def update(self):
+        profile = self.wanted_profile()
+
+        if profile != self.profile and self.policies:
+            self.switch(profile)
+
+    def switch(self, profile):
+        previous = self.profile
+        self.profile = profile
+        frequency = self.frequency()
+        temperature = self.__temperature()
+        floor = 0
+        governors = []
+        saved = len(self.__saved)
+
+        for policy in self.policies:
+            governor = next((governor for governor in profile.governors if governor in policy.governors), None)
+            min_freq = max(policy.min_limit, min(profile.min_freq or policy.min_limit, policy.max_limit))
+            max_freq = max(min_freq, min(profile.max_freq or policy.max_limit, policy.max_limit))
+
+            try:
+                if policy.path not in self.__saved:
+                    self.__saved[policy.path] = policy.settings()
+
+                policy.apply(governor, min_freq, max_freq)
+                governors.append(governor if governor else policy.read('scaling_governor'))
+            except (OSError, IOError, ValueError) as e:
+                write_log('CPU profile {}: cannot set {}: {}'.format(profile.name, policy.path, e),
+                          self.logger, self.printer)
+                continue
+
+            # The lowest clock the governor will run the cores at from now on
+            floor = max(floor, max_freq if governor == 'performance' else min_freq)
+
+        if len(self.__saved) != saved:
+            self.__store_saved()
+
+        self.switches += 1
+        pre_spun = self.fan_monitor and floor > frequency and self.fan_monitor.pre_spin()
+        write_log('CPU profile {} -> {} ({}){}: CPU Temperature = {}°C | CPU Speed = {}GHz'
+                  .format(previous.name if previous else 'unmanaged', profile.name,
+                          ', '.join(sorted(set(governors))) or 'no governor', ', fan pre-spun' if pre_spun else '',
+                          temperature, frequency / 1000000.0), self.logger, self.printer,
+                  {'EVENT': 'cpu_profile', 'CPU_PROFILE': profile.name, 'TEMP': temperature,
+                   'CPU_FREQ': frequency / 1000000.0})
+
+        if self.scheduler:
+            self.scheduler.cancel(self.__response_task)
+            self.__response_task = self.scheduler.call_later(
+                self.response_delay, lambda: self.__log_response(profile, frequency, temperature),
+                'CpuProfileManager.response')
+
+    # Highest current frequency of the policies in kHz
+    def frequency(self):
+        frequencies = []
+
+        for policy in self.policies:
+            try:
+                frequencies.append(policy.cur_freq.read_int())
+            except (OSError, ValueError):
+                pass
+
+        return max(frequencies) if frequencies else 0
+
+    # Puts the governor and limits back the way they were before the first switch
+    def restore(self):
+        for policy in self.policies:
+            saved = self.__saved.get(policy.path)
+
+            if saved:
+                try:
+                    policy.apply(*saved)
+                except (OSError, IOError, ValueError):
+                    pass
+
+        self.__saved = {}
+        self.profile = None
+
+        if self.settings_path:
+            try:
+                os.remove(self.settings_path)
+            except OSError:
+                pass
+
+    def close(self):
+        self.stop()
+        self.restore()
+        self.watcher.close()
+
+        for policy in self.policies:
+            policy.close()
+
+    def __read_events(self):
+        self.watcher.read_events()
+        self.update()
+
+    def __log_response(self, profile, frequency, temperature):
+        self.__response_task = None
+        write_log('CPU profile {} after {}s: CPU Speed {} -> {}GHz | CPU Temperature {} -> {}°C'
+                  .format(profile.name, self.response_delay, frequency / 1000000.0, self.frequency() / 1000000.0,
+                          temperature, self.__temperature()), self.logger, self.printer)
+
+    def __temperature(self):
+        return self.sampler.snapshot.temperature if self.sampler else None
+
+    # The settings a previous run saved and did not put back, they are the ones to restore
+    def __load_saved(self):
+        if not self.settings_path:
+            return {}
+
+        import json
+
+        try:
+            with open(self.settings_path) as settings_file:
+                saved = dict((path, tuple(settings)) for path, settings in json.load(settings_file).items())
+        except (IOError, OSError, ValueError, TypeError, AttributeError):
+            return {}
+
+        write_log('CPU profile: the last run did not put back the settings it found ({}), they are the ones '
+                  'restored'.format(', '.join(sorted(set(str(settings[0]) for settings in saved.values())))),
+                  self.logger, self.printer)
+        return saved
+
+    def __store_saved(self):
+        if not self.settings_path:
+            return
+
+        import json
+
+        try:
+            directory = os.path.dirname(self.settings_path)
+
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            with open(self.settings_path + '.tmp', 'w') as settings_file:
+                json.dump(self.__saved, settings_file)
+
+            os.rename(self.settings_path + '.tmp', self.settings_path)
+        except (IOError, OSError) as e:
+            write_log('CPU profile: settings not saved: {}'.format(e), self.logger, self.printer)
+
+    # policyN directories (cpuN/cpufreq links to them), the cpuN/cpufreq directories on older kernels
+    @staticmethod
+    def __policy_paths(cpu_dir):
+        try:
+            entries = os.listdir(cpu_dir)
+        except OSError:
+            return []
+
+        paths = []
+
+        for core in sorted(int(entry[3:]) for entry in entries if entry.startswith('cpu') and entry[3:].isdigit()):
+            path = os.path.realpath('{}/cpu{}/cpufreq'.format(cpu_dir, core))
+
+            if os.path.isdir(path) and path not in paths:
+                paths.append(path)
+
+        return paths
+
+
+# rsync Monitor class
+# Checks the process list to see if rsync is running
+class RsyncMonitor:
+    # LedController, delay between flashes, seconds between /proc scans when the
+    # proc connector is not available
+    # Other activity sources (e.g. InotifyWatcher) flash the LED(s) the same way rsync does.
+    # The flash delay scales with the transfer rate: delay at reference_rate bytes/s, faster
+    # for faster copies, down to min_delay, and slower for slow copies, up to max_delay.
+    # A CopyPriorityManager keeps copies out of the way of a running emulator
+    def __init__(self, led, delay=0.2, log_queue=None, print_queue=None, poll_interval=0.25, watcher=None,
+                 sources=None, reference_rate=10 * 1048576, min_delay=0.05, max_delay=1.0, progress_interval=60,
+                 priority_manager=None, clock=None):
+        # User can create the class using a pin number or supply
+        # a LedController
+        self.printer = print_queue
+        self.logger = log_queue
+        self.clock = clock if clock else SYSTEM_CLOCK
+
+        if isinstance(led, int):
+            if 40 >= led >= 3:
+                led = LedController(led, clock=clock)
+
+        if not isinstance(led, LedController):
+            if self.printer or self.logger:
+                write_log('Invalid LedController', self.logger, self.printer)
+            else:
+                print(log_timestamp() + ' Invalid LedController')
+
+            raise ValueError
+
+        if not (isinstance(delay, int) or isinstance(delay, float)):
+            if self.printer or self.logger:
+                write_log('Delay must be int or float', self.logger, self.printer)
+            else:
+                print(log_timestamp() + ' Delay must be int or float')
+            raise ValueError
+
+        self.led_controller = led
+        self.delay = delay
+        self.poll_interval = poll_interval
+        # Watches for rsync starting and exiting, see create_process_watcher
+        self.watcher = watcher if watcher else create_process_watcher(['rsync'])
+        self.sources = sources if sources else []
+        self.reference_rate = reference_rate
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.progress_interval = progress_interval
+        self.meter = TransferMeter(clock=self.clock)
+        self.priority_manager = priority_manager
+        self.scheduler = None
+        self.__watch_task = None
+        self.__flash_pattern = None
+        self.__sample_task = None
+        self.__last_progress = 0
+        self.__stalled = False
+        self.__copy_timer = 0
+        # Called on the scheduler thread every time a copy ends (e.g. RomIndex.update)
+        self.copy_listeners = []
+
+    # Returns true if rsync is running or a source reports a transfer (copying)
+    def is_copying(self):
+        return self.watcher.running() or any(source.running() for source in self.sources)
+
+    # rsync processes and the processes of sources that know them (the setup.py copy engine)
+    def copy_pids(self):
+        pids = set(self.watcher.pids)
+
+        for source in self.sources:
+            pids.update(getattr(source, 'pids', ()))
+
+        return pids
+
+    # Starts watching on the scheduler. The proc connector socket wakes the scheduler up
+    # when a process starts or exits, the /proc scan is polled every poll_interval seconds
+    def start(self, scheduler):
+        self.scheduler = scheduler
+        self.led_controller.start(scheduler)
+
+        if self.watcher.event_driven:
+            self.__watch_task = scheduler.add_reader(self.watcher, self.__read_events, 'RsyncMonitor.watch')
+        else:
+            self.__watch_task = scheduler.call_every(self.poll_interval, self.__poll, 'RsyncMonitor.watch')
+
+        for source in self.sources:
+            source.start(scheduler, self.__update)
+
+        self.__update()
+
+    # Adds an activity source, started right away if the monitor is (scheduler thread only)
+    def add_source(self, source):
+        self.sources.append(source)
+
+        if self.scheduler:
+            source.start(self.scheduler, self.__update)
+            self.__update()
+
+    # Stops watching and flashing, the LED(s) go back to their default state
+    def stop(self):
+        if not self.scheduler:
+            return
+
+        self.scheduler.cancel(self.__watch_task)
+
+        for source in self.sources:
+            source.stop()
+
+        self.__stop_flashing()
+
+        if self.priority_manager:
+            self.priority_manager.restore()
+
+        self.scheduler = None
+
+    def __read_events(self):
+        self.watcher.read_events()
+        self.__update()
+
+    def __poll(self):
+        self.watcher.wait(0)
+        self.__update()
+
+    def __update(self):
+        # If rsync is running (copying)
+        if self.is_copying():
+            # Not currently flashing the LED(s)
+            if not self.__flash_pattern:
+                # Timer used to show how long the copying process lasted
+                self.__copy_timer = self.clock.time()
+                self.__flash_pattern = LedBlink(self.delay)
+                self.led_controller.show('copy', self.__flash_pattern, 1)
+                self.meter.start(self.copy_pids(), self.__source_bytes())
+                self.__last_progress = self.clock.monotonic()
+                self.__stalled = False
+                self.__sample_task = self.scheduler.call_every(1, self.__sample, 'RsyncMonitor.sample')
+
+                write_log('Copying started', self.logger, self.printer, {'EVENT': 'copy_started'})
+
+                if self.priority_manager:
+                    self.priority_manager.update(self.copy_pids())
+        # Currently flashing but rsync is no longer running
+        elif self.__flash_pattern:
+            self.__stop_flashing()
+
+            write_log('Copying ended: ' + self.__timer_to_time(self.__copy_timer) + ' | ' + self.meter.summary(),
+                      self.logger, self.printer, {'EVENT': 'copy_ended'})
+            self.meter.stop()
+
+            if self.priority_manager:
+                self.priority_manager.restore()
+
+            for listener in self.copy_listeners:
+                listener()
+
+    # Once a second while copying: transfer rate, flash delay, stall and progress logging
+    def __sample(self):
+        pids = self.copy_pids()
+        rate = self.meter.sample(pids, self.__source_bytes())
+
+        if self.priority_manager:
+            self.priority_manager.update(pids)
+
+        # Sources that know how much they are going to copy give the ETA
+        for source in self.sources:
+            if getattr(source, 'expected_bytes', 0) and source.running():
+                self.meter.expected_bytes = source.expected_bytes
+
+        if self.__flash_pattern:
+            if rate > 0:
+                self.__flash_pattern.interval = min(self.max_delay,
+                                                    max(self.min_delay, self.delay * self.reference_rate / rate))
+            else:
+                self.__flash_pattern.interval = self.max_delay
+
+        stalled = self.meter.current_stall >= 30
+
+        if stalled and not self.__stalled:
+            write_log('Copying stalled: ' + self.meter.summary(), self.logger, self.printer,
+                      {'EVENT': 'copy_stalled', 'PRIORITY': 4})
+
+        self.__stalled = stalled
+
+        if self.progress_interval and self.clock.monotonic() - self.__last_progress >= self.progress_interval:
+            self.__last_progress = self.clock.monotonic()
+            write_log('Copying: ' + self.meter.summary(), self.logger, self.printer)
+
+    # Bytes counted by the activity sources, copies without a process to measure (e.g. Samba
+    # writes seen by inotify) are measured from these
+    def __source_bytes(self):
+        return sum(getattr(source, 'total_bytes', 0) for source in self.sources)
+
+    def __stop_flashing(self):
+        self.scheduler.cancel(self.__sample_task)
+        self.__sample_task = None
+
+        if self.__flash_pattern:
+            self.__flash_pattern = None
+            # The LED goes back to its default state
+            self.led_controller.clear('copy')
+
+    def __timer_to_time(self, timer):
+        seconds = self.clock.time() - timer
+        days = int(seconds / 86400)
+        seconds %= 86400
+        hours = int(seconds / 3600)
+        seconds %= 3600
+        return '{0:02d}d {1:02d}h {2:02d}m {3:02d}s'.format(days, hours, int(seconds / 60), int(seconds % 60))
+
+
+# Pool initializer, hashing ROMs must never get in the way of a game. The worker has no log
+# queue, a failure is printed (journald)
+def lower_priority():
+    os.nice(19)
+
+    if not ioprio_set(0, IOPRIO_CLASS_IDLE):
+        print(log_timestamp() + ' ROM index worker {} not moved to idle I/O: ioprio_set failed ({})'
+              .format(os.getpid(), ioprio_abi()))
+
+
+# Returns (path, size, mtime, crc32, md5, sha1) of a ROM file, None if it could not be read.
+# The file is mapped into memory and hashed in place, there are no read copies
+def hash_rom(job):
+    import hashlib
+
+    path, relative_path, size, mtime = job
+    crc32 = 0
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+
+    try:
+        with open(path, 'rb') as rom:
+            if size:
+                mapped = mmap.mmap(rom.fileno(), 0, access=mmap.ACCESS_READ)
+                # Python 2 has no memoryview of a mapping, its slices are copies
+                view = memoryview(mapped) if sys.version_info[0] >= 3 else mapped
+
+                try:
+                    for offset in range(0, size, 4194304):
+                        block = view[offset:offset + 4194304]
+                        crc32 = zlib.crc32(block, crc32)
+                        md5.update(block)
+                        sha1.update(block)
+                        del block
+                finally:
+                    # Python 3 does not close a mapping that still has views on it
+                    if hasattr(view, 'release'):
+                        view.release()
+
+                    mapped.close()
+    except (OSError, IOError, ValueError):
+        return None
+
+    return relative_path, size, mtime, '{:08x}'.format(crc32 & 0xffffffff), md5.hexdigest(), sha1.hexdigest()
+
+
+# ROM Index class
+# Index of every file in the ROM library (path, size, mtime, CRC32, MD5, SHA1) in a SQLite
+# database. update() runs in the background and only hashes files that are new or changed
+# since the last update, on a pool of processes running at the lowest CPU and I/O priority.
+# Lookups by hash and duplicate checks are plain indexed queries
+class RomIndex:
+    def __init__(self, root='/home/pi/RetroPie/roms', path=None, workers=1, log_queue=None, print_queue=None,
+                 clock=None):
+        self.root = root
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.path = path if path else os.path.dirname(os.path.realpath(__file__)) + '/PiStation 2 ROMs.db'
+        self.workers = workers
+        self.logger = log_queue
+        self.printer = print_queue
+        self.__thread = None
+        self.__update_again = False
+        self.__lock = threading.Lock()
+
+        connection = self.__connect()
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS roms (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,
+                                             crc32 TEXT, md5 TEXT, sha1 TEXT);
+            CREATE INDEX IF NOT EXISTS roms_crc32 ON roms (crc32);
+            CREATE INDEX IF NOT EXISTS roms_md5 ON roms (md5);
+            CREATE INDEX IF NOT EXISTS roms_sha1 ON roms (sha1);
+        ''')
+        connection.close()
+
+    # Starts an update in the background, one more runs after it if one is already running
+    def update(self):
+        with self.__lock:
+            if self.__thread and self.__thread.is_alive():
+                self.__update_again = True
+                return
+
+            self.__thread = threading.Thread(name='RomIndex', target=self.__updater)
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def updating(self):
+        return bool(self.__thread and self.__thread.is_alive())
+
+    # Rows (path, size, mtime, crc32, md5, sha1) of the ROMs with the given hash
+    def find(self, crc32=None, md5=None, sha1=None):
+        for column, value in ('crc32', crc32), ('md5', md5), ('sha1', sha1):
+            if value:
+                return self.__query('SELECT * FROM roms WHERE {} = ?'.format(column), (value.lower(),))
+        return []
+
+    # Lists of paths that have the same content
+    def duplicates(self):
+        groups = {}
+
+        for sha1, path in self.__query('SELECT sha1, path FROM roms WHERE sha1 IN '
+                                       '(SELECT sha1 FROM roms GROUP BY sha1 HAVING COUNT(*) > 1) ORDER BY sha1'):
+            groups.setdefault(sha1, []).append(path)
+
+        return list(groups.values())
+
+    def count(self):
+        return self.__query('SELECT COUNT(*) FROM roms')[0][0]
+
+    def __query(self, sql, parameters=()):
+        connection = self.__connect()
+
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        finally:
+            connection.close()
+
+    def __connect(self):
+        import sqlite3
+
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def __updater(self):
+        while True:
+            try:
+                self.__update()
+            except Exception as e:
+                write_log('ROM index update failed: {}'.format(e), self.logger, self.printer)
+
+            with self.__lock:
+                if not self.__update_again:
+                    return
+
+                self.__update_again = False
+
+    def __update(self):
+        connection = self.__connect()
+
+        try:
+            self.__update_rows(connection)
+        finally:
+            connection.close()
+
+    def __update_rows(self, connection):
+        start = self.clock.time()
+        indexed = dict((row[0], (row[1], row[2])) for row in connection.execute('SELECT path, size, mtime FROM roms'))
+        jobs = []
+        seen = set()
+
+        for directory, directories, names in os.walk(self.root):
+            # Hidden directories (e.g. .Trash) are not part of the library
+            directories[:] = [name for name in directories if not name.startswith('.')]
+
+            for name in names:
+                if name.startswith('.'):
+                    continue
+
+                path = os.path.join(directory, name)
+
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                relative_path = os.path.relpath(path, self.root)
+                seen.add(relative_path)
+
+                if indexed.get(relative_path) != (stat.st_size, int(stat.st_mtime)):
+                    jobs.append((path, relative_path, stat.st_size, int(stat.st_mtime)))
+
+        removed = [(path,) for path in indexed if path not in seen]
+
+        if removed:
+            connection.executemany('DELETE FROM roms WHERE path = ?', removed)
+            connection.commit()
+
+        hashed = 0
+
+        if jobs:
+            import multiprocessing
+
+            pool = multiprocessing.Pool(self.workers, lower_priority)
+
+            try:
+                for row in pool.imap_unordered(hash_rom, jobs):
+                    if row:
+                        connection.execute('INSERT OR REPLACE INTO roms VALUES (?, ?, ?, ?, ?, ?)', row)
+                        hashed += 1
+
+                        # Commit now and then so an interrupted update keeps what it hashed
+                        if not hashed % 100:
+                            connection.commit()
+            finally:
+                pool.close()
+                pool.join()
+
+            connection.commit()
+
+        if jobs or removed:
+            write_log('ROM index updated: {} hashed | {} removed | {} ROMs | {:.1f}s'
+                      .format(hashed, len(removed), len(seen), self.clock.time() - start), self.logger, self.printer)
+
+
+# Sysfs/procfs value class
+# Keeps the file open and reads it with os.pread, the kernel regenerates the
+# contents on every read from offset 0 so there is no open/close per sample
+class SysfsFile:
+    def __init__(self, path, size=64):
+        self.path = path
+        self.size = size
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read(self):
+        if hasattr(os, 'pread'):
+            return os.pread(self.fd, self.size, 0)
+
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        return os.read(self.fd, self.size)
+
+    def read_int(self):
+        return int(self.read())
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# Sysfs Sensors class
+# CPU temperature from every thermal zone (millidegrees), the current frequency of every
+# core (kHz) and the firmware throttle flags (kernel 4.19+) read from sysfs files that
+# stay open, no subprocesses
+class SysfsSensors:
+    def __init__(self, thermal_dir='/sys/class/thermal', cpu_dir='/sys/devices/system/cpu',
+                 throttled_path='/sys/devices/platform/soc/soc:firmware/get_throttled'):
+        self.zones = []
+        self.cores = []
+        self.cpu_zone = 0
+        self.throttled_file = None
+
+        for zone in self.__numbered(thermal_dir, 'thermal_zone'):
+            try:
+                self.zones.append(SysfsFile('{}/thermal_zone{}/temp'.format(thermal_dir, zone)))
+            except OSError:
+                continue
+
+            # The Pi only has cpu-thermal, prefer the CPU zone on anything with more zones
+            try:
+                with open('{}/thermal_zone{}/type'.format(thermal_dir, zone)) as zone_type:
+                    if 'cpu' in zone_type.read().lower() and not self.cpu_zone:
+                        self.cpu_zone = len(self.zones) - 1
+            except (OSError, IOError):
+                pass
+
+        for core in self.__numbered(cpu_dir, 'cpu'):
+            try:
+                self.cores.append(SysfsFile('{}/cpu{}/cpufreq/scaling_cur_freq'.format(cpu_dir, core)))
+            except OSError:
+                # Offline core or no cpufreq driver
+                pass
+
+        try:
+            self.throttled_file = SysfsFile(throttled_path)
+        except OSError:
+            # Not a Pi or an older kernel, throttling is not reported
+            pass
+
+        if not self.zones:
+            self.close()
+            raise OSError(errno.ENOENT, 'No thermal zones in ' + thermal_dir)
+
+    # CPU temperature in °C
+    def temperature(self):
+        return self.zones[self.cpu_zone].read_int() / 1000.0
+
+    # Temperature of every thermal zone in °C
+    def temperatures(self):
+        return tuple(zone.read_int() / 1000.0 for zone in self.zones)
+
+    # Current frequency of every core in GHz
+    def frequencies(self):
+        return tuple(core.read_int() / 1000000.0 for core in self.cores)
+
+    # Throttle flags (THROTTLE_*), None if they are not available
+    def throttled(self):
+        if not self.throttled_file:
+            return None
+
+        return int(self.throttled_file.read(), 16)
+
+    def close(self):
+        for sysfs_file in self.zones + self.cores + [self.throttled_file]:
+            if sysfs_file:
+                sysfs_file.close()
+
+    @staticmethod
+    def __numbered(directory, prefix):
+        try:
+            entries = os.listdir(directory)
+        except OSError:
+            return []
+
+        return sorted(int(entry[len(prefix):]) for entry in entries
+                      if entry.startswith(prefix) and entry[len(prefix):].isdigit())
+
+
+# vcgencmd Sensors class
+# Explicit fallback for firmware without the sysfs thermal driver, every reading forks
+# vcgencmd so readings are cached for min_interval seconds
+class VcgencmdSensors:
+    def __init__(self, min_interval=5, clock=None):
+        self.min_interval = min_interval
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.__temperature = None
+        self.__frequency = None
+        self.__throttled = None
+        self.__last_read = 0
+
+    def temperature(self):
+        self.__read()
+        return self.__temperature
+
+    def temperatures(self):
+        return self.temperature(),
+
+    def frequencies(self):
+        self.__read()
+        return self.__frequency,
+
+    def throttled(self):
+        self.__read()
+        return self.__throttled
+
+    def close(self):
+        pass
+
+    def __read(self):
+        import subprocess
+
+        if self.__temperature is not None and self.clock.time() - self.__last_read < self.min_interval:
+            return
+
+        self.__last_read = self.clock.time()
+
+        try:
+            # temp=45.1'C
+            self.__temperature = float(subprocess.check_output(['vcgencmd', 'measure_temp'])
+                                       .decode().strip().replace('temp=', '').replace('\'C', ''))
+            # frequency(48)=1200000000
+            self.__frequency = int(subprocess.check_output(['vcgencmd', 'measure_clock', 'arm'])
+                                   .decode().strip().split('=')[1]) / 1000000000.0
+        except subprocess.CalledProcessError as e:
+            # Same as a sysfs read failing, the sampler keeps the last good readings
+            raise OSError(e.returncode, 'vcgencmd failed')
+
+        # throttled=0x50000, older firmware does not have it
+        try:
+            self.__throttled = int(subprocess.check_output(['vcgencmd', 'get_throttled'])
+                                   .decode().strip().split('=')[1], 16)
+        except (subprocess.CalledProcessError, ValueError, IndexError):
+            self.__throttled = None
+
+
+# Returns the sysfs sensors, vcgencmd if the kernel does not expose a thermal zone
+def create_sensor_source():
     try:
-        if printer:
-            printer.close()
-    except:
+        return SysfsSensors()
+    except OSError:
+        return VcgencmdSensors()
+
+
+# Latest telemetry values. The sampler replaces the whole snapshot at once (a single
+# reference assignment), readers never need a lock and never wait on a sample
+TelemetrySnapshot = namedtuple('TelemetrySnapshot', ['time', 'cpu_percent', 'core_percents', 'cpu_freq',
+                                                     'core_freqs', 'temperature', 'zone_temperatures',
+                                                     'throttled'])
+
+
+# Telemetry Sampler class
+# Samples the CPU usage, frequency and temperature in the background. CPU usage is
+# computed from the difference between two /proc/stat reads, so sampling never blocks.
+# Only the cpu lines at the top of /proc/stat are read, the buffer is sized for the
+# number of CPUs and grows if they ever do not fit (CPUs brought online)
+class TelemetrySampler:
+    def __init__(self, sensors, interval=1, proc_stat='/proc/stat', clock=None):
+        self.sensors = sensors
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.interval = interval
+        self.snapshot = TelemetrySnapshot(0, 0.0, (), 0.0, (), 0.0, (), None)
+        self.__proc_stat = SysfsFile(proc_stat, max(4096, 256 * (self.__cpu_count() + 1)))
+        self.__last_times = None
+        self.__stop_event = threading.Event()
+        self.__thread = None
+        self.__scheduler = None
+        self.__task = None
+
+    # Samples on the scheduler if there is one, otherwise on a thread of its own
+    def start(self, scheduler=None):
+        # Take the first sample right away so the snapshot is never empty
+        self.sample()
+
+        if scheduler:
+            self.__task = scheduler.call_every(self.interval, self.sample, 'TelemetrySampler.sample')
+            self.__scheduler = scheduler
+        else:
+            self.__thread = threading.Thread(name='TelemetrySampler', target=self.__sampler)
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+
+        if self.__scheduler:
+            self.__scheduler.cancel(self.__task)
+
+    def sample(self):
+        times = self.__read_proc_stat()
+        last_times = self.__last_times
+        self.__last_times = times
+
+        # A CPU brought online has nothing to compare against yet
+        if last_times and len(last_times) == len(times):
+            percents = [self.__usage(last_times[cpu], times[cpu]) for cpu in range(len(times))]
+        else:
+            percents = [0.0] * len(times)
+
+        snapshot = self.snapshot
+
+        try:
+            zone_temperatures = self.sensors.temperatures()
+            core_freqs = self.sensors.frequencies()
+            temperature = self.sensors.temperature()
+            throttled = self.sensors.throttled()
+        except (OSError, IOError, ValueError, IndexError):
+            # Keep the last good readings
+            zone_temperatures, core_freqs, temperature, throttled = \
+                snapshot.zone_temperatures, snapshot.core_freqs, snapshot.temperature, snapshot.throttled
+
+        self.snapshot = TelemetrySnapshot(self.clock.time(), percents[0], tuple(percents[1:]),
+                                          core_freqs[0] if core_freqs else 0.0, core_freqs,
+                                          temperature, zone_temperatures, throttled)
+        return self.snapshot
+
+    def __sampler(self):
+        while not self.__stop_event.wait(self.interval):
+            self.sample()
+
+    # Returns a list of (busy, total) jiffies, the total first and then each core
+    def __read_proc_stat(self):
+        while True:
+            data = self.__proc_stat.read()
+            lines = data.decode().split('\n')
+            cpu_lines = 0
+
+            while cpu_lines < len(lines) and lines[cpu_lines].startswith('cpu'):
+                cpu_lines += 1
+
+            # The cpu lines are whole once the start of the next line ('intr', cut or not) shows
+            # it is not a cpu line, or once the whole file was read
+            if (cpu_lines < len(lines) and len(lines[cpu_lines]) >= 3) or len(data) < self.__proc_stat.size:
+                break
+
+            self.__proc_stat.size *= 2
+
+        times = []
+
+        for line in lines[:cpu_lines]:
+            # user nice system idle iowait irq softirq steal (guest time is already in user)
+            values = [int(value) for value in line.split()[1:9]]
+            total = sum(values)
+            times.append((total - values[3] - values[4], total))
+
+        return times
+
+    # CPUs configured, online or not, the cpu lines of /proc/stat never outnumber them
+    @staticmethod
+    def __cpu_count():
+        try:
+            return os.sysconf('SC_NPROCESSORS_CONF')
+        except (AttributeError, ValueError, OSError):
+            return 4
+
+    @staticmethod
+    def __usage(last, current):
+        total = current[1] - last[1]
+
+        if total <= 0:
+            return 0.0
+
+        return round(100.0 * (current[0] - last[0]) / total, 1)
+
+
+# Block layer counters of a disk (/sys/block/<disk>/stat) at time: requests, sectors (512 bytes)
+# and milliseconds spent on them by direction, requests in flight, milliseconds busy and
+# request milliseconds (busy time weighted by the number of requests in flight)
+DiskStats = namedtuple('DiskStats', ['time', 'reads', 'read_sectors', 'read_ms', 'writes', 'write_sectors',
+                                     'write_ms', 'in_flight', 'busy_ms', 'queue_ms'])
+# I/O of a disk between two DiskStats: requests and bytes a second, seconds a request (queued
+# and serviced, iostat's await), the average number of requests in flight and the busy fraction
+DiskRates = namedtuple('DiskRates', ['seconds', 'requests', 'iops', 'read_rate', 'write_rate', 'latency',
+                                     'queue_depth', 'utilization'])
+
+
+# Whole disk (its /sys/block name) the file system holding path is on, None for file systems
+# without a block device (tmpfs, overlays)
+def block_device(path, sys_dir='/sys'):
+    device = os.stat(path).st_dev
+    disk = os.path.realpath('{}/dev/block/{}:{}'.format(sys_dir, os.major(device), os.minor(device)))
+
+    if not os.path.isdir(disk):
+        return None
+
+    # A partition's directory is in its disk's
+    if os.path.exists(disk + '/partition'):
+        disk = os.path.dirname(disk)
+
+    return os.path.basename(disk)
+
+
+def disk_rates(earlier, later):
+    seconds = later.time - earlier.time
+
+    if seconds <= 0:
+        return None
+
+    requests = later.reads - earlier.reads + later.writes - earlier.writes
+    request_ms = later.read_ms - earlier.read_ms + later.write_ms - earlier.write_ms
+    return DiskRates(seconds, requests, requests / seconds, 512 * (later.read_sectors - earlier.read_sectors) / seconds,
+                     512 * (later.write_sectors - earlier.write_sectors) / seconds,
+                     request_ms / 1000.0 / requests if requests else 0.0,
+                     (later.queue_ms - earlier.queue_ms) / 1000.0 / seconds,
+                     min(1.0, (later.busy_ms - earlier.busy_ms) / 1000.0 / seconds))
+
+
+# Block Device class
+# One monitored disk, its last two samples and how it did in the copies so far
+class BlockDevice:
+    def __init__(self, label, name, sys_dir='/sys'):
+        self.label = label
+        self.name = name
+        self.stats = None
+        # Since the sample before
+        self.rates = None
+        # Stats when the copy running now started
+        self.copy_start = None
+        self.slow_samples = 0
+        self.slow_logged = False
+        # Average seconds a request took in the copies so far (moving average)
+        self.copy_latency = None
+        self.__stat_file = SysfsFile('{}/block/{}/stat'.format(sys_dir, name), 256)
+
+    def sample(self, now):
+        values = [int(value) for value in self.__stat_file.read().split()[:11]]
+        stats = DiskStats(now, values[0], values[2], values[3], values[4], values[6], values[7], values[8],
+                          values[9], values[10])
+
+        if self.stats:
+            self.rates = disk_rates(self.stats, stats)
+
+        self.stats = stats
+
+    def close(self):
+        self.__stat_file.close()
+
+
+# Storage Monitor class
+# I/O of the SD card and the ROM drive from the block layer counters, sampled every interval
+# seconds: IOPS, MB/s read and written, seconds a request and queue depth. The daemon's own
+# writes come from /proc/self/io, write_bytes against wchar (what it wrote) is what the log
+# costs the SD card. While ROMs are copied (is_copying) a drive whose requests take longer
+# than slow_latency for slow_samples samples in a row is logged once a copy, and after the
+# copy each drive is compared with the copies before: degrading when its requests took more
+# than degrade_factor times as long as they used to
+class StorageMonitor:
+    def __init__(self, paths=(('SD card', '/'), ('ROM drive', '/home/pi/RetroPie/roms')), is_copying=None,
+                 sys_dir='/sys', proc_io='/proc/self/io', interval=10, slow_latency=0.1, slow_samples=3,
+                 degrade_factor=2.0, log_queue=None, print_queue=None, clock=None):
+        self.is_copying = is_copying
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.interval = interval
+        self.slow_latency = slow_latency
+        self.slow_samples = slow_samples
+        self.degrade_factor = degrade_factor
+        self.logger = log_queue
+        self.printer = print_queue
+        self.devices = []
+        self.copying = False
+        # /proc/self/io, {name: bytes}
+        self.process_io = {}
+        self.__io_file = None
+        self.__task = None
+        self.__scheduler = None
+        # (time, {disk: DiskStats}, process_io) at the last report
+        self.__reported = None
+
+        for label, path in paths:
+            try:
+                name = block_device(path, sys_dir)
+
+                # The ROMs are on the SD card until setup.py moved them
+                if name and name not in [device.name for device in self.devices]:
+                    self.devices.append(BlockDevice(label, name, sys_dir))
+            except OSError:
+                continue
+
+        try:
+            self.__io_file = SysfsFile(proc_io, 512)
+        except OSError:
+            # No task I/O accounting in the kernel
+            pass
+
+    def start(self, scheduler):
+        self.sample()
+        self.__reported = (self.clock.monotonic(), dict((device.name, device.stats) for device in self.devices),
+                           self.process_io)
+        self.__scheduler = scheduler
+        self.__task = scheduler.call_every(self.interval, self.sample, 'StorageMonitor.sample', self.interval / 2.0)
+
+    def stop(self):
+        if self.__scheduler:
+            self.__scheduler.cancel(self.__task)
+            self.__scheduler = None
+
+    def sample(self):
+        now = self.clock.monotonic()
+        copying = bool(self.is_copying and self.is_copying())
+
+        for device in self.devices:
+            previous = device.stats
+
+            try:
+                device.sample(now)
+            except (OSError, IOError, ValueError):
+                # Unplugged
+                continue
+
+            if copying and not self.copying:
+                # The copy started since the last sample
+                device.copy_start = previous or device.stats
+                device.slow_samples = 0
+                device.slow_logged = False
+
+            if copying and device.rates:
+                self.__check_slow(device)
+
+        if self.__io_file:
+            try:
+                self.process_io = dict((name, int(value)) for name, value in
+                                       (line.split(b':') for line in self.__io_file.read().splitlines()))
+            except (OSError, IOError, ValueError):
+                pass
+
+        if self.copying and not copying:
+            for device in self.devices:
+                self.__copy_ended(device)
+
+        self.copying = copying
+
+    # I/O of every disk and the daemon's writes since the last report
+    def report(self):
+        now = self.clock.monotonic()
+        then, stats, process_io = self.__reported
+        self.__reported = (now, dict((device.name, device.stats) for device in self.devices), self.process_io)
+        lines = ['Storage over {:.0f}s:'.format(now - then)]
+
+        for device in self.devices:
+            rates = disk_rates(stats[device.name], device.stats) if stats.get(device.name) and device.stats \
+                else None
+
+            if rates:
+                lines.append('  ' + self.__describe(device, rates))
+
+        if self.process_io and process_io:
+            written = self.process_io.get(b'wchar', 0) - process_io.get(b'wchar', 0)
+            stored = self.process_io.get(b'write_bytes', 0) - process_io.get(b'write_bytes', 0)
+            lines.append('  PiStation 2: {:.2f}MB written | {:.2f}MB to storage{}'
+                         .format(written / 1048576.0, stored / 1048576.0,
+                                 ' ({:.1f}x)'.format(stored / float(written)) if written else ''))
+
+        return '\r\n'.join(lines)
+
+    def close(self):
+        self.stop()
+
+        for device in self.devices:
+            device.close()
+
+        if self.__io_file:
+            self.__io_file.close()
+
+    def __check_slow(self, device):
+        if device.rates.requests and device.rates.latency > self.slow_latency:
+            device.slow_samples += 1
+        else:
+            device.slow_samples = 0
+
+        if device.slow_samples >= self.slow_samples and not device.slow_logged:
+            device.slow_logged = True
+            write_log('Storage slow during copy: {} for {:.0f}s'
+                      .format(self.__describe(device, device.rates), device.slow_samples * self.interval),
+                      self.logger, self.printer, self.__fields(device, device.rates, 'storage_slow'))
+
+    def __copy_ended(self, device):
+        if not device.copy_start or not device.stats:
+            return
+
+        rates = disk_rates(device.copy_start, device.stats)
+        device.copy_start = None
+
+        # Nothing to compare on a drive the copy hardly touched
+        if not rates or rates.requests < 100:
+            return
+
+        baseline = device.copy_latency
+        degrading = baseline and rates.latency > self.degrade_factor * baseline
+        device.copy_latency = rates.latency if baseline is None else 0.7 * baseline + 0.3 * rates.latency
+        text = 'Storage during copy: ' + self.__describe(device, rates)
+
+        if degrading:
+            text += ' | degrading: {:.1f}x the {:.1f}ms of earlier copies'.format(rates.latency / baseline,
+                                                                                  1000 * baseline)
+
+        write_log(text, self.logger, self.printer,
+                  self.__fields(device, rates, 'storage_degrading' if degrading else 'storage_copy'))
+
+    @staticmethod
+    def __describe(device, rates):
+        return '{} ({}) {:.1f} IOPS | {:.2f}MB/s read | {:.2f}MB/s write | {:.1f}ms a request | queue {:.2f} | ' \
+               'busy {:.0f}%'.format(device.label, device.name, rates.iops, rates.read_rate / 1048576.0,
+                                     rates.write_rate / 1048576.0, 1000 * rates.latency, rates.queue_depth,
+                                     100 * rates.utilization)
+
+    @staticmethod
+    def __fields(device, rates, event):
+        return {'EVENT': event, 'PRIORITY': 6 if event == 'storage_copy' else 4, 'DEVICE': device.name,
+                'IOPS': round(rates.iops, 1), 'LATENCY_MS': round(1000 * rates.latency, 1),
+                'QUEUE_DEPTH': round(rates.queue_depth, 2), 'WRITE_MBPS': round(rates.write_rate / 1048576.0, 2)}
+
+
+# One record of the telemetry history
+HistoryRecord = namedtuple('HistoryRecord', ['time', 'temperature', 'cpu_percent', 'cpu_freq', 'fan_state',
+                                             'copying'])
+# min, max and average of a field over one downsampling step starting at time
+HistorySummary = namedtuple('HistorySummary', ['time', 'count', 'min', 'max', 'average'])
+
+
+# Telemetry History class
+# Fixed size ring buffer of packed records in a memory mapped file, 7 days at one record
+# every 5 seconds by default (2.9 MB). The file keeps the history across restarts, a
+# record is packed straight into the mapping so appending allocates nothing. Queries read
+# the records they need from the mapping, the history is never loaded as a whole.
+# Records are in the order they were appended and looked up by time with a binary search,
+# fake-hwclock restores the clock before the daemon starts so time only moves forward
+class TelemetryHistory:
+    MAGIC = b'PS2H'
+    VERSION = 1
+    # magic, version, record size, capacity, next record, record count
+    HEADER = struct.Struct('<4sHHIQQ4x')
+    # time, temperature, CPU %, CPU frequency (GHz), fan state, copying
+    RECORD = struct.Struct('<dfffBB2x')
+
+    def __init__(self, path=None, capacity=120960):
+        self.path = path if path else os.path.dirname(os.path.realpath(__file__)) + '/PiStation 2 history.dat'
+        self.capacity = capacity
+        self.next = 0
+        self.count = 0
+        size = self.HEADER.size + self.RECORD.size * capacity
+        self.__fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            if os.fstat(self.__fd).st_size != size:
+                os.ftruncate(self.__fd, 0)
+                os.ftruncate(self.__fd, size)
+
+            self.__map = mmap.mmap(self.__fd, size)
+        except:
+            os.close(self.__fd)
+            raise
+
+        magic, version, record_size, capacity, self.next, self.count = self.HEADER.unpack_from(self.__map, 0)
+
+        # New file or a different layout, start over
+        if (magic, version, record_size, capacity) != (self.MAGIC, self.VERSION, self.RECORD.size, self.capacity) \
+                or self.next >= self.capacity or self.count > self.capacity:
+            self.next = self.count = 0
+            self.__write_header()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, temperature, cpu_percent, cpu_freq, fan_state, copying):
+        self.RECORD.pack_into(self.__map, self.HEADER.size + self.next * self.RECORD.size, timestamp,
+                              temperature, cpu_percent, cpu_freq, int(fan_state), bool(copying))
+        self.next = (self.next + 1) % self.capacity
+
+        if self.count < self.capacity:
+            self.count += 1
+
+        self.__write_header()
+
+    # The index-th oldest record
+    def record(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError('history index out of range')
+
+        return HistoryRecord._make(self.RECORD.unpack_from(self.__map, self.__offset(index)))
+
+    # Records with start <= time < end, oldest first
+    def range(self, start=None, end=None):
+        index = self.__find(start) if start is not None else 0
+
+        while index < self.count:
+            record = self.record(index)
+
+            if end is not None and record.time >= end:
+                return
+
+            yield record
+            index += 1
+
+    # HistorySummary of field for every step seconds with records in it, e.g.
+    # downsample('temperature', 3600) for the hourly min/max/average temperature
+    def downsample(self, field, step, start=None, end=None):
+        column = HistoryRecord._fields.index(field)
+        summaries = []
+        bucket = None
+
+        for record in self.range(start, end):
+            value = record[column]
+            bucket_time = record.time - record.time % step
+
+            if bucket is None or bucket[0] != bucket_time:
+                if bucket:
+                    summaries.append(HistorySummary(bucket[0], bucket[1], bucket[2], bucket[3],
+                                                    bucket[4] / bucket[1]))
+
+                bucket = [bucket_time, 0, value, value, 0.0]
+
+            bucket[1] += 1
+            bucket[2] = min(bucket[2], value)
+            bucket[3] = max(bucket[3], value)
+            bucket[4] += value
+
+        if bucket:
+            summaries.append(HistorySummary(bucket[0], bucket[1], bucket[2], bucket[3], bucket[4] / bucket[1]))
+
+        return summaries
+
+    # Writes the dirty pages out, the kernel does it on its own otherwise
+    def flush(self):
+        self.__map.flush()
+
+    def close(self):
+        if self.__map is None:
+            return
+
+        self.__map.flush()
+        self.__map.close()
+        self.__map = None
+        os.close(self.__fd)
+
+    def __write_header(self):
+        self.HEADER.pack_into(self.__map, 0, self.MAGIC, self.VERSION, self.RECORD.size, self.capacity,
+                              self.next, self.count)
+
+    def __offset(self, index):
+        return self.HEADER.size + (self.next - self.count + index) % self.capacity * self.RECORD.size
+
+    # Index of the first record at or after timestamp
+    def __find(self, timestamp):
+        low, high = 0, self.count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self.RECORD.unpack_from(self.__map, self.__offset(middle))[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+
+# One sample of a sensor trace
+TraceSample = namedtuple('TraceSample', ['time', 'temperature', 'cpu_percent', 'cpu_freq', 'fan_state'])
+
+
+# Trace Recorder class
+# Appends raw samples to a compact binary trace for offline fan policy evaluation (replay.py).
+# The header holds the start time, every sample is 10 bytes: milliseconds since the start,
+# centidegrees, half percents of CPU usage, MHz and the fan state. The trace is moved to
+# <path>.1 when it gets to max_bytes or the millisecond offset would overflow (49 days)
+class TraceRecorder:
+    MAGIC = b'PS2T'
+    VERSION = 1
+    # magic, version, start time
+    HEADER = struct.Struct('<4sHd')
+    # milliseconds since start, temperature * 100, CPU % * 2, MHz, fan state
+    RECORD = struct.Struct('<IhBHB')
+
+    def __init__(self, path, max_bytes=16 * 1024 * 1024, flush_samples=60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_samples = flush_samples
+        self.start = None
+        self.__file = None
+        self.__unflushed = 0
+        self.__open()
+
+    def append(self, timestamp, temperature, cpu_percent, cpu_freq, fan_state):
+        if self.start is None:
+            self.__start(timestamp)
+
+        offset = int(round((timestamp - self.start) * 1000))
+
+        # The clock went back (e.g. set by NTP), the offset overflows or the trace is full
+        if not 0 <= offset < 1 << 32 or self.__file.tell() >= self.max_bytes:
+            self.__file.close()
+            os.rename(self.path, self.path + '.1')
+            self.__file = open(self.path, 'ab')
+            self.__start(timestamp)
+            offset = 0
+
+        self.__file.write(self.RECORD.pack(offset, int(round(temperature * 100)),
+                                           min(255, max(0, int(round(cpu_percent * 2)))),
+                                           int(round(cpu_freq * 1000)), int(fan_state)))
+        self.__unflushed += 1
+
+        if self.__unflushed >= self.flush_samples:
+            self.flush()
+
+    def flush(self):
+        self.__file.flush()
+        self.__unflushed = 0
+
+    def close(self):
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+
+    # Appends to the trace if there is one, the header is written with the first sample otherwise
+    def __open(self):
+        self.__file = open(self.path, 'ab')
+
+        if self.__file.tell() < self.HEADER.size:
+            self.__file.truncate(0)
+            return
+
+        with open(self.path, 'rb') as trace:
+            magic, version, start = self.HEADER.unpack(trace.read(self.HEADER.size))
+
+        if (magic, version) == (self.MAGIC, self.VERSION):
+            self.start = start
+            return
+
+        # Not a trace we can append to
+        self.__file.close()
+        os.rename(self.path, self.path + '.1')
+        self.__file = open(self.path, 'ab')
+
+    def __start(self, start):
+        self.start = start
+        self.__file.write(self.HEADER.pack(self.MAGIC, self.VERSION, start))
+
+
+# Reads a trace written by TraceRecorder, yields TraceSamples oldest first
+def read_trace(path):
+    record_size = TraceRecorder.RECORD.size
+
+    with open(path, 'rb') as trace:
+        magic, version, start = TraceRecorder.HEADER.unpack(trace.read(TraceRecorder.HEADER.size))
+
+        if (magic, version) != (TraceRecorder.MAGIC, TraceRecorder.VERSION):
+            raise ValueError('{} is not a PiStation 2 trace'.format(path))
+
+        while True:
+            data = trace.read(record_size * 4096)
+
+            # A sample cut short by a power cut is dropped
+            for offset in range(0, len(data) - record_size + 1, record_size):
+                milliseconds, temperature, cpu_percent, frequency, fan_state = \
+                    TraceRecorder.RECORD.unpack_from(data, offset)
+                yield TraceSample(start + milliseconds / 1000.0, temperature / 100.0, cpu_percent / 2.0,
+                                  frequency / 1000.0, fan_state)
+
+            if len(data) < record_size * 4096:
+                return
+
+
+# Returns the names of the throttle flags that are set, e.g. 'under-voltage, throttled'
+def throttle_flag_names(flags):
+    return ', '.join(name for flag, name in THROTTLE_FLAG_NAMES if flags & flag)
+
+
+# Fan Monitor class
+# Turns the fan on at temp_fan_low (low speed) and temp_fan_high (high speed), and off
+# min_seconds_on seconds after the temperature drops to temp_fan_off.
+# In predictive mode the temperature trend over the last slope_window seconds is used to
+# switch the fan on lookahead seconds before the temperature gets there, so the SoC does
+# not reach its throttling point before the fan catches up.
+# Every throttling (and under-voltage) event is logged with its duration, and the time
+# spent throttled is kept for each policy for tuning_report(). With a tuning_path the time is
+# kept across restarts (load_tuning, save_tuning), so a run with the other policy is compared
+# against the runs before it
+class FanMonitor:
+    def __init__(self, gpio_pin_low, gpio_pin_high, temp_fan_low=55, temp_fan_high=65, temp_fan_off=45,
+                 min_seconds_on=30, log_queue=None, print_queue=None, sampler=None, predictive=False,
+                 slope_window=60, lookahead=30, tuning_path=None, gpio=None, clock=None):
+        self.fan_state = FAN_OFF
+        self.gpio = gpio if gpio else GPIO
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.fan_pin_low = gpio_pin_low
+        self.fan_pin_high = gpio_pin_high
+        self.last_temperature = 0
+        self.temp_fan_low = temp_fan_low
+        self.temp_fan_high = temp_fan_high
+        self.temp_fan_off = temp_fan_off
+        self.__fan_timer = 0
+        self.min_seconds_on = min_seconds_on
+        self.logger = log_queue
+        self.printer = print_queue
+
+        # Background CPU usage, frequency and temperature, check_temp only reads its snapshot
+        if not sampler:
+            sampler = TelemetrySampler(create_sensor_source())
+            sampler.start()
+
+        self.sampler = sampler
+        self.predictive = predictive
+        self.slope_window = slope_window
+        self.lookahead = lookahead
+        # (start time, seconds, flags) of the last throttling events
+        self.throttle_events = deque(maxlen=100)
+        self.__temperatures = deque()
+        self.__pre_spin_until = 0
+        self.__throttle_flags = 0
+        self.__throttle_start = 0
+        self.__last_check = None
+        self.__policy_seconds = {'threshold': 0.0, 'predictive': 0.0}
+        self.__throttled_seconds = {'threshold': 0.0, 'predictive': 0.0}
+        self.__throttle_counts = {'threshold': 0, 'predictive': 0}
+        self.tuning_path = tuning_path
+        # Saving before the earlier runs are loaded would overwrite them
+        self.__tuning_loaded = False
+
+        self.gpio.setup(self.fan_pin_low, self.gpio.OUT)
+        self.gpio.setup(self.fan_pin_high, self.gpio.OUT)
+        self.gpio.output(self.fan_pin_low, False)
+        self.gpio.output(self.fan_pin_high, False)
+
+    def cpu_temp(self):
+        return self.sampler.snapshot.temperature
+
+    def cpu_percent(self):
+        return self.sampler.snapshot.cpu_percent
+
+    def cpu_speed(self):
+        return self.sampler.snapshot.cpu_freq
+
+    # Temperature change in °C/s over the slope window (least squares), 0 until there are 3 samples
+    def temperature_slope(self):
+        if len(self.__temperatures) < 3:
+            return 0.0
+
+        count = len(self.__temperatures)
+        mean_time = sum(sample[0] for sample in self.__temperatures) / count
+        mean_temp = sum(sample[1] for sample in self.__temperatures) / count
+        variance = sum((sample[0] - mean_time) ** 2 for sample in self.__temperatures)
+
+        if not variance:
+            return 0.0
+
+        return sum((sample[0] - mean_time) * (sample[1] - mean_temp) for sample in self.__temperatures) / variance
+
+    # Time run and time throttled under the threshold and predictive policies
+    def tuning_report(self):
+        report = []
+
+        for policy in 'threshold', 'predictive':
+            seconds = self.__policy_seconds[policy]
+
+            if seconds:
+                report.append('{} {:.1f}h, {:.1f}% throttled ({:.0f}s, {} events)'
+                              .format(policy, seconds / 3600, 100 * self.__throttled_seconds[policy] / seconds,
+                                      self.__throttled_seconds[policy], self.__throttle_counts[policy]))
+
+        return 'Fan tuning ({} now): '.format('predictive' if self.predictive else 'threshold') + \
+            (' | '.join(report) if report else 'no data yet')
+
+    # Adds the time run, time throttled and throttling events of the earlier runs to this run's
+    def load_tuning(self):
+        if not self.tuning_path:
+            return
+
+        import json
+
+        try:
+            with open(self.tuning_path) as tuning:
+                saved = json.load(tuning)
+
+            for policy in self.__policy_seconds:
+                seconds, throttled, count = saved.get(policy, (0, 0, 0))
+                self.__policy_seconds[policy] += seconds
+                self.__throttled_seconds[policy] += throttled
+                self.__throttle_counts[policy] += count
+        except (IOError, OSError, ValueError, TypeError, AttributeError):
+            # First run, or a file from something else
+            pass
+
+        self.__tuning_loaded = True
+
+    def save_tuning(self):
+        if not self.tuning_path or not self.__tuning_loaded:
+            return
+
+        import json
+
+        state = dict((policy, [self.__policy_seconds[policy], self.__throttled_seconds[policy],
+                               self.__throttle_counts[policy]]) for policy in self.__policy_seconds)
+
+        with open(self.tuning_path + '.tmp', 'w') as tuning:
+            json.dump(state, tuning)
+
+        os.rename(self.tuning_path + '.tmp', self.tuning_path)
+
+    def check_temp(self):
+        current_temp = self.cpu_temp()
+        self.__check_throttling(current_temp)
+        # The temperature the fan is switched for, ahead of time in predictive mode
+        target_temp = self.__predict(current_temp)
+
+        if target_temp >= self.temp_fan_low:
+            if self.__fan_timer:
+                self.__fan_timer = 0
+                self.__log('Resetting timer: ', 'fan_timer_reset', current_temp)
+
+            if target_temp >= self.temp_fan_high:
+                if self.fan_state == FAN_HIGH:
+                    return
+
+                self.set_state(FAN_HIGH)
+                speed = 'high fan speed'
+                temp = self.temp_fan_high
+            else:
+                if self.fan_state == FAN_LOW:
+                    return
+                self.set_state(FAN_LOW)
+                speed = 'low fan speed'
+                temp = self.temp_fan_low
+
+            reached = 'reached' if target_temp <= current_temp else 'predicted in {}s'.format(self.lookahead)
+            self.__log('Temperature ' + reached + ' for ' + speed + ' ({}°C): '.format(temp),
+                       'fan_high' if self.fan_state == FAN_HIGH else 'fan_low', current_temp)
+
+        elif current_temp <= self.temp_fan_off and self.fan_state:
+            if self.clock.monotonic() < self.__pre_spin_until:
+                # Spun up for a load that is just starting, see pre_spin
+                return
+
+            if not self.__fan_timer:
+                self.__fan_timer = self.clock.time()
+                self.__log('Min temp reached ({}°C), Initializing countdown ({}s): '
+                           .format(self.temp_fan_off, self.min_seconds_on), 'fan_countdown_started', current_temp)
+                return
+
+            current_time = self.clock.time()
+            self.__log('{}s left: '.format(int(self.min_seconds_on - (current_time - self.__fan_timer))),
+                       'fan_countdown', current_temp)
+
+            if current_time - self.__fan_timer > self.min_seconds_on:
+                self.set_state(False)
+                self.__fan_timer = 0
+                self.__log('Min temp and time reached, turning fan off', 'fan_off')
+
+    # Logs a fan decision, followed by the readings it was made on (if current_temp is given).
+    # The readings are journal fields as well
+    def __log(self, text, event, current_temp=None):
+        if not (self.logger or self.printer):
+            return
+
+        fields = {'EVENT': event, 'FAN_STATE': int(self.fan_state)}
+
+        if current_temp is not None:
+            cpu_percent = self.cpu_percent()
+            cpu_speed = self.cpu_speed()
+            text += 'CPU Temperature = {}°C | CPU Usage = {}% | CPU Speed = {}GHz'.format(current_temp, cpu_percent,
+                                                                                          cpu_speed)
+            fields.update(TEMP=current_temp, CPU_PCT=cpu_percent, CPU_FREQ=cpu_speed)
+
+        write_log(text, self.logger, self.printer, fields)
+
+    def toggle_fan(self):
+        return self.set_state(not self.fan_state)
+
+    # Turns the fan on (at least at state) ahead of a load that is about to heat the SoC up,
+    # e.g. the clocks going up for a game. It stays on for at least seconds, then the
+    # temperature decides as usual. Returns False if the fan was already running that fast
+    def pre_spin(self, state=FAN_LOW, seconds=60):
+        self.__pre_spin_until = max(self.__pre_spin_until, self.clock.monotonic() + seconds)
+
+        if self.fan_state >= state:
+            return False
+
+        self.__fan_timer = 0
+        self.set_state(state)
+        return True
+
+    def __predict(self, current_temp):
+        now = self.clock.monotonic()
+        self.__temperatures.append((now, current_temp))
+
+        while self.__temperatures[0][0] < now - self.slope_window:
+            self.__temperatures.popleft()
+
+        if not self.predictive:
+            return current_temp
+
+        # Only a rising temperature switches the fan early
+        return max(current_temp, round(current_temp + self.temperature_slope() * self.lookahead, 1))
+
+    def __check_throttling(self, current_temp):
+        now = self.clock.monotonic()
+        policy = 'predictive' if self.predictive else 'threshold'
+        flags = self.sampler.snapshot.throttled
+
+        if self.__last_check is not None:
+            elapsed = now - self.__last_check
+            self.__policy_seconds[policy] += elapsed
+
+            if self.__throttle_flags & ~THROTTLE_UNDER_VOLTAGE:
+                self.__throttled_seconds[policy] += elapsed
+        elif flags and flags >> 16:
+            write_log('Throttled since boot: ' + throttle_flag_names(flags >> 16), self.logger, self.printer)
+
+        self.__last_check = now
+
+        if flags is None or flags & 0xf == self.__throttle_flags:
+            return
+
+        if self.__throttle_flags:
+            seconds = now - self.__throttle_start
+            self.throttle_events.append((self.clock.time() - seconds, seconds, self.__throttle_flags))
+            write_log('Throttling ended after {:.0f}s: {} | CPU Temperature = {}°C'
+                      .format(seconds, throttle_flag_names(self.__throttle_flags), current_temp),
+                      self.logger, self.printer, {'EVENT': 'throttling_ended', 'TEMP': current_temp,
+                                                  'THROTTLE_FLAGS': self.__throttle_flags,
+                                                  'THROTTLE_SECONDS': int(seconds)})
+
+        self.__throttle_flags = flags & 0xf
+
+        if self.__throttle_flags:
+            self.__throttle_start = now
+            self.__throttle_counts[policy] += 1
+            write_log('Throttling started: {} | CPU Temperature = {}°C | CPU Speed = {}GHz | Fan = {}'
+                      .format(throttle_flag_names(self.__throttle_flags), current_temp, self.cpu_speed(),
+                              ('off', 'low', 'high')[self.fan_state]), self.logger, self.printer,
+                      {'EVENT': 'throttling_started', 'PRIORITY': 4, 'TEMP': current_temp,
+                       'CPU_FREQ': self.cpu_speed(), 'FAN_STATE': int(self.fan_state),
+                       'THROTTLE_FLAGS': self.__throttle_flags})
+
+    def set_state(self, state):
+        if self.fan_state == FAN_HIGH:
+            self.gpio.output(self.fan_pin_high, False)
+        elif self.fan_state == FAN_LOW:
+            self.gpio.output(self.fan_pin_low, False)
+
+        if state == FAN_HIGH:
+            self.gpio.output(self.fan_pin_high, True)
+        elif state == FAN_LOW:
+            self.gpio.output(self.fan_pin_low, True)
+
+        self.fan_state = state
+        return self.fan_state
+
+
+# Hardware backends
+# Everything the daemon talks to outside of itself: the GPIO pins (the RPi.GPIO interface),
+# the sensors (temperature(), temperatures(), frequencies(), throttled()), the process
+# table (a process watcher, see create_process_watcher) and the clock. The classes that use
+# the pins or the clock take them as gpio and clock (RPi.GPIO and the SystemClock by default),
+# PiBackend is the real hardware, SimulatedBackend runs the same classes on any Linux machine
+# in virtual time (see benchmark.py)
+class PiBackend:
+    def __init__(self):
+        self.gpio = GPIO
+        self.clock = SYSTEM_CLOCK
+
+    def create_sensors(self):
+        return create_sensor_source()
+
+    def create_process_watcher(self, names):
+        return create_process_watcher(names)
+
+
+# System Clock class
+# monotonic(), time() and sleep() of the time module
+class SystemClock:
+    virtual = False
+
+    monotonic = staticmethod(monotonic)
+    time = staticmethod(time)
+    sleep = staticmethod(sleep)
+
+
+SYSTEM_CLOCK = SystemClock()
+
+
+# Virtual Clock class
+# Stands in for the SystemClock, time only moves when advance() is called (by the Scheduler
+# when it would otherwise sleep, or by sleep())
+class VirtualClock:
+    virtual = True
+
+    def __init__(self, start=0.0, wall_start=1500000000.0):
+        self.now = start
+        self.wall_offset = wall_start - start
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now + self.wall_offset
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        self.now += max(0, seconds)
+
+
+# Simulated GPIO class
+# The part of the RPi.GPIO interface the daemon uses. Keeps the level of every pin and every
+# output change as (virtual time, pin, level) in changes. set_input() drives an input pin
+# and calls its event callback like a button press would
+class SimulatedGPIO:
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.mode = None
+        self.levels = {}
+        self.changes = []
+        self.__callbacks = {}
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, warnings):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        if direction == self.IN:
+            self.levels[pin] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+        else:
+            self.levels[pin] = self.HIGH if initial else self.LOW
+
+    def output(self, pin, level):
+        level = self.HIGH if level else self.LOW
+
+        if self.levels.get(pin) != level:
+            self.changes.append((self.clock.monotonic(), pin, level))
+
+        self.levels[pin] = level
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.__callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        self.__callbacks.pop(pin, None)
+
+    def set_input(self, pin, level):
+        level = self.HIGH if level else self.LOW
+        previous = self.levels.get(pin, self.LOW)
+        self.levels[pin] = level
+        edge, callback = self.__callbacks.get(pin, (None, None))
+
+        if callback and level != previous and \
+                edge in (self.BOTH, self.RISING if level else self.FALLING):
+            callback(pin)
+
+    def cleanup(self, pin=None):
+        self.__callbacks = {}
+
+
+# Simulated Sensors class
+# Temperature follows a scripted curve, a list of (seconds, °C) points with straight lines
+# between them (repeated every period seconds if there is one) or any function of time
+class SimulatedSensors:
+    def __init__(self, clock, curve, period=None, zones=1, cores=4, frequency=1.2, throttle_temperature=80):
+        self.clock = clock
+        self.curve = curve
+        self.period = period
+        self.zones = zones
+        self.cores = cores
+        self.frequency = frequency
+        self.throttle_temperature = throttle_temperature
+
+    def temperature(self):
+        return round(self.temperature_at(self.clock.monotonic()), 1)
+
+    def temperature_at(self, seconds):
+        if callable(self.curve):
+            return self.curve(seconds)
+
+        if self.period:
+            seconds %= self.period
+
+        points = self.curve
+
+        if seconds <= points[0][0]:
+            return points[0][1]
+
+        for (start, start_temp), (end, end_temp) in zip(points, points[1:]):
+            if seconds <= end:
+                return start_temp + (end_temp - start_temp) * (seconds - start) / float(end - start)
+
+        return points[-1][1]
+
+    def temperatures(self):
+        return (self.temperature(),) * self.zones
+
+    def frequencies(self):
+        return (self.frequency if not self.throttled() else self.frequency / 2,) * self.cores
+
+    def throttled(self):
+        return THROTTLE_THROTTLED | (THROTTLE_THROTTLED << 16) \
+            if self.temperature() >= self.throttle_temperature else 0
+
+    def close(self):
         pass
 
+
+# Simulated Process Watcher class
+# The process table of scripted copy sessions, a list of (start seconds, duration seconds)
+# repeated every period seconds if there is one. Pids are above the kernel pid limit so
+# nothing in /proc is ever mistaken for them
+class SimulatedProcessWatcher:
+    event_driven = False
+
+    def __init__(self, clock, sessions, period=None, first_pid=5000000):
+        self.clock = clock
+        self.sessions = sessions
+        self.period = period
+        self.first_pid = first_pid
+        self.pids = set()
+        self.scan()
+
+    def running(self):
+        return bool(self.pids)
+
+    def scan(self):
+        now = self.clock.monotonic()
+        cycle, seconds = divmod(now, self.period) if self.period else (0, now)
+        self.pids = set(self.first_pid + int(cycle) * len(self.sessions) + session
+                        for session, (start, duration) in enumerate(self.sessions)
+                        if start <= seconds < start + duration)
+        return self.running()
+
+    def wait(self, timeout, stop_event=None):
+        was_running = self.running()
+        self.clock.sleep(timeout)
+        self.scan()
+        return self.running() != was_running
+
+    def close(self):
+        self.pids = set()
+
+
+class SimulatedBackend:
+    def __init__(self, temperature_curve, copy_sessions=(), period=None, clock=None):
+        self.clock = clock if clock else VirtualClock()
+        self.gpio = SimulatedGPIO(self.clock)
+        self.temperature_curve = temperature_curve
+        self.copy_sessions = list(copy_sessions)
+        self.period = period
+
+    def create_sensors(self):
+        return SimulatedSensors(self.clock, self.temperature_curve, self.period)
+
+    def create_process_watcher(self, names):
+        return SimulatedProcessWatcher(self.clock, self.copy_sessions, self.period)
+
+
+# Returns metrics in the Prometheus text format. metrics is a list of
+# (name, type, help, samples), samples a list of (labels dict, value)
+def render_metrics(metrics):
+    lines = []
+
+    for name, metric_type, help_text, samples in metrics:
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        for labels, value in samples:
+            label_text = ','.join('{}="{}"'.format(label, labels[label]) for label in sorted(labels))
+            lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', repr(float(value))))
+
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics Server class
+# Serves the daemon state in the Prometheus text format over HTTP on a TCP address or a
+# Unix socket path, e.g. curl http://127.0.0.1:9102/metrics
+# The response is rendered every interval seconds from the values the other tasks already
+# keep (collect must not read sensors or GPIO pins) and cached, a scrape only sends the
+# cached bytes. Every socket is non-blocking and served from the scheduler, a slow or
+# stuck client can never hold up the fan control
+class MetricsServer:
+    def __init__(self, collect, scheduler, address=('127.0.0.1', 9102), interval=5, timeout=5,
+                 max_connections=16, log_queue=None, print_queue=None):
+        self.collect = collect
+        self.scheduler = scheduler
+        self.address = address
+        self.interval = interval
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.logger = log_queue
+        self.printer = print_queue
+        self.renders = 0
+        self.scrapes = 0
+        self.__response = self.__http('503 Service Unavailable', b'Starting\n', 'text/plain')
+        # fd: [socket, request bytes, reader task, timeout task]
+        self.__connections = {}
+        self.__render_task = None
+        self.__accept_task = None
+
+        if isinstance(address, str):
+            # Left behind if the daemon was killed
+            if os.path.exists(address):
+                os.unlink(address)
+
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET,
+                                        socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        try:
+            self.socket.bind(address)
+            self.socket.listen(8)
+            self.socket.setblocking(False)
+        except:
+            self.socket.close()
+            raise
+
+    def start(self):
+        self.render()
+        self.__render_task = self.scheduler.call_every(self.interval, self.render, 'MetricsServer.render')
+        self.__accept_task = self.scheduler.add_reader(self.socket, self.__accept, 'MetricsServer.accept')
+
+    def stop(self):
+        self.scheduler.cancel(self.__render_task)
+        self.scheduler.cancel(self.__accept_task)
+
+        # The scheduler may be in select() on the sockets, they are closed on its own thread
+        if self.scheduler.in_scheduler_thread():
+            self.__close_all()
+        else:
+            self.scheduler.call_later(0, self.__close_all, 'MetricsServer.stop')
+
+    def __close_all(self):
+        for fd in list(self.__connections):
+            self.__close(fd)
+
+        self.socket.close()
+
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def render(self):
+        try:
+            body = render_metrics(self.collect()).encode('utf-8')
+        except Exception as e:
+            write_log('Metrics render failed: {}'.format(e), self.logger, self.printer)
+            return
+
+        self.__response = self.__http('200 OK', body, 'text/plain; version=0.0.4; charset=utf-8')
+        self.renders += 1
+
+    def __accept(self):
+        while True:
+            try:
+                connection = self.socket.accept()[0]
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                raise
+
+            if len(self.__connections) >= self.max_connections:
+                connection.close()
+                continue
+
+            connection.setblocking(False)
+            fd = connection.fileno()
+            self.__connections[fd] = [connection, b'',
+                                      self.scheduler.add_reader(fd, lambda fd=fd: self.__read(fd),
+                                                                'MetricsServer.read'),
+                                      self.scheduler.call_later(self.timeout, lambda fd=fd: self.__close(fd),
+                                                                'MetricsServer.timeout', 1)]
+
+    def __read(self, fd):
+        state = self.__connections.get(fd)
+
+        if not state:
+            return
+
+        try:
+            data = state[0].recv(4096)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+
+        state[1] += data
+
+        if not data or len(state[1]) > 8192:
+            self.__close(fd)
+            return
+
+        if b'\r\n\r\n' not in state[1] and b'\n\n' not in state[1]:
+            return
+
+        request = state[1].split(b'\n', 1)[0].split()
+
+        if len(request) < 2 or request[0] not in (b'GET', b'HEAD'):
+            response = self.__http('405 Method Not Allowed', b'', 'text/plain')
+        elif request[1].split(b'?')[0] not in (b'/metrics', b'/'):
+            response = self.__http('404 Not Found', b'Not found\n', 'text/plain')
+        else:
+            response = self.__response
+            self.scrapes += 1
+
+        if request and request[0] == b'HEAD':
+            response = response.split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n'
+
+        try:
+            # A send buffer larger than the response lets a single non-blocking send take
+            # all of it, a client too slow even for that has to scrape again
+            state[0].setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, len(response))
+            state[0].send(response)
+        except socket.error:
+            pass
+
+        self.__close(fd)
+
+    def __close(self, fd):
+        state = self.__connections.pop(fd, None)
+
+        if not state:
+            return
+
+        self.scheduler.cancel(state[2])
+        self.scheduler.cancel(state[3])
+        state[0].close()
+
+    @staticmethod
+    def __http(status, body, content_type):
+        return ('HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'
+                .format(status, content_type, len(body))).encode('ascii') + body
+
+
+# Long press of the power button
+def shutdown():
+    write_log('Shutting down PiStation 2', logger, printer, {'EVENT': 'shutdown'})
+    request_stop('shutdown')
+
+
+# Short press of the power button
+def restart():
+    write_log('Restarting PiStation 2', logger, printer, {'EVENT': 'restart'})
+    request_stop('restart')
+
+
+# Stops the scheduler, the main thread runs the shutdown once scheduler.run() returns (see the end
+# of the file). Safe from signal handlers and any thread, it takes no lock: no task runs again and
+# nothing but the main thread touches the GPIO pins, the scheduler or the files from then on
+def request_stop(reason):
+    global stop_reason
+
+    if stop_reason is None:
+        stop_reason = reason
+
+    scheduler.stop()
+
+
+# Hourly, the fan policies compared over this run and the earlier ones
+def report_tuning():
+    save_tuning()
+    write_log(fan_monitor.tuning_report(), logger, printer)
+
+
+def save_tuning():
+    try:
+        fan_monitor.save_tuning()
+    except (IOError, OSError) as e:
+        write_log('Fan tuning not saved: {}'.format(e), logger, printer, {'PRIORITY': 4})
+
+
+# Appends the latest telemetry, fan and copy state to the history (and the trace)
+def record_history():
+    if not history:
+        # Not set up yet, see start_deferred
+        return
+
+    snapshot = sampler.snapshot
+    history.append(snapshot.time, snapshot.temperature, snapshot.cpu_percent, snapshot.cpu_freq,
+                   fan_monitor.fan_state, rsync_monitor.is_copying())
+
+    if trace:
+        trace.append(snapshot.time, snapshot.temperature, snapshot.cpu_percent, snapshot.cpu_freq,
+                     fan_monitor.fan_state)
+
+
+# Values for the metrics server, all of them are kept up to date by the other tasks
+def collect_metrics():
+    snapshot = sampler.snapshot
+    copying = rsync_monitor.is_copying()
+    cpu = os.times()
+    metrics = [
+        ('pistation2_cpu_temperature_celsius', 'gauge', 'CPU temperature', [({}, snapshot.temperature)]),
+        ('pistation2_thermal_zone_temperature_celsius', 'gauge', 'Temperature of every thermal zone',
+         [({'zone': zone}, temperature) for zone, temperature in enumerate(snapshot.zone_temperatures)]),
+        ('pistation2_cpu_usage_percent', 'gauge', 'CPU usage of all cores', [({}, snapshot.cpu_percent)]),
+        ('pistation2_core_usage_percent', 'gauge', 'CPU usage of every core',
+         [({'core': core}, percent) for core, percent in enumerate(snapshot.core_percents)]),
+        ('pistation2_cpu_frequency_hertz', 'gauge', 'Current frequency of every core',
+         [({'core': core}, freq * 1000000000) for core, freq in enumerate(snapshot.core_freqs)]),
+        ('pistation2_fan_state', 'gauge', 'Fan state, 0 off, 1 low speed, 2 high speed',
+         [({}, fan_monitor.fan_state)]),
+        ('pistation2_copying', 'gauge', '1 while ROMs are being copied', [({}, copying)]),
+        ('pistation2_copy_rate_bytes_per_second', 'gauge', 'Transfer rate of the current copy',
+         [({}, rsync_monitor.meter.rate if copying else 0)]),
+        ('pistation2_copy_transferred_bytes', 'gauge', 'Bytes transferred by the current or last copy',
+         [({}, rsync_monitor.meter.transferred())]),
+        ('pistation2_log_queue_depth', 'gauge', 'Log lines waiting to be written', [({}, logger.queue.qsize())]),
+        ('pistation2_log_lines_total', 'counter', 'Log lines written', [({}, logger.lines_written)]),
+        ('pistation2_process_cpu_seconds_total', 'counter', 'CPU time used by the daemon',
+         [({}, cpu[0] + cpu[1])]),
+        ('pistation2_scheduler_wakeups_total', 'counter', 'Scheduler wakeups', [({}, scheduler.wakeups)]),
+    ]
+
+    if cpu_profile_manager and cpu_profile_manager.profile:
+        metrics.append(('pistation2_cpu_profile', 'gauge', 'CPU profile in use',
+                        [({'profile': cpu_profile_manager.profile.name}, 1)]))
+        metrics.append(('pistation2_cpu_profile_switches_total', 'counter', 'CPU profile switches',
+                        [({}, cpu_profile_manager.switches)]))
+
+    if storage_monitor:
+        sampled = [device for device in storage_monitor.devices if device.stats]
+        measured = [device for device in sampled if device.rates]
+        metrics.extend((
+            ('pistation2_storage_requests_total', 'counter', 'Requests completed by the disk',
+             [({'device': device.name, 'direction': 'read'}, device.stats.reads) for device in sampled] +
+             [({'device': device.name, 'direction': 'write'}, device.stats.writes) for device in sampled]),
+            ('pistation2_storage_bytes_total', 'counter', 'Bytes transferred by the disk',
+             [({'device': device.name, 'direction': 'read'}, 512 * device.stats.read_sectors) for device in sampled] +
+             [({'device': device.name, 'direction': 'write'}, 512 * device.stats.write_sectors)
+              for device in sampled]),
+            ('pistation2_storage_request_seconds', 'gauge',
+             'Average time a request took, queued and serviced, over the last sample',
+             [({'device': device.name}, device.rates.latency) for device in measured]),
+            ('pistation2_storage_queue_depth', 'gauge', 'Average requests in flight over the last sample',
+             [({'device': device.name}, device.rates.queue_depth) for device in measured]),
+        ))
+
+        if storage_monitor.process_io:
+            metrics.append(('pistation2_process_write_bytes_total', 'counter',
+                            'Bytes the daemon wrote (written) and caused to be written to storage (storage)',
+                            [({'layer': 'written'}, storage_monitor.process_io.get(b'wchar', 0)),
+                             ({'layer': 'storage'}, storage_monitor.process_io.get(b'write_bytes', 0))]))
+
+    if isinstance(printer, JournalSink):
+        metrics.append(('pistation2_journal_records_total', 'counter', 'Log records sent to journald or dropped',
+                        [({'result': 'sent'}, printer.sent), ({'result': 'dropped'}, printer.dropped)]))
+
+    if snapshot.throttled is not None:
+        metrics.append(('pistation2_throttled_flags', 'gauge', 'Firmware throttle flags (vcgencmd get_throttled)',
+                        [({}, snapshot.throttled)]))
+
+    return metrics
+
+
+# Shutdown phases, see ShutdownCoordinator
+def stop_producers():
+    button.stop()
+    rsync_monitor.stop()
+    sampler.stop()
+
+    if cpu_profile_manager:
+        cpu_profile_manager.close()
+
+    if storage_monitor:
+        storage_monitor.close()
+
+    if metrics_server:
+        metrics_server.stop()
+
+    profiler.stop()
+
+
+def restore_gpio():
+    led_controller.stop()
+    fan_monitor.set_state(FAN_OFF)
     GPIO.cleanup()
 
-logger = LogQueue()
-printer = None # PrintQueue()
 
-# Set the restart and shutdown pin
-# Enable the Pull Up resistor, allows us to turn the pi back on pressing
-# the reset/power button
-GPIO.setup(restart_shutdown_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+def close_files():
+    save_tuning()
 
-GPIO.add_event_detect(restart_shutdown_pin, GPIO.BOTH, callback=button_pressed)
+    if history:
+        history.close()
 
-rsync_stop = threading.Event()
-led_controller = LedController(front_led_pin)
-fan_monitor = FanMonitor(fan_pin_low, fan_pin_high, log_queue=logger)
-rsync_monitor = RsyncMonitor(led_controller, log_queue=logger)
-rsync_thread = threading.Thread(target=rsync_monitor.monitor, args=(rsync_stop,))
-rsync_thread.start()
+    if trace:
+        trace.close()
 
-try:
-    while True:
-        sleep(5)
-        fan_monitor.check_temp()
 
-except KeyboardInterrupt:
-    print(datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]') + ' Keyboard interrupt')
-    close()
+def close(reason='close'):
+    notifier.stopping()
+    shutdown_coordinator.run(reason)
+
+
+# Setup nothing needs at boot: walking the ROM tree for the directory watcher, opening the ROM
+# index and the history files, binding the metrics socket. Runs on its own thread at the lowest
+# best effort I/O priority, deferred_startup_delay seconds after systemd was told the daemon is
+# ready, so it holds up neither the boot nor the scheduler
+def start_deferred():
+    global rom_index, history, trace, storage_monitor, metrics_server
+
+    ioprio_set(0, IOPRIO_CLASS_BE, 7)
+    startup.resume()
+
+    try:
+        # Writes into the RetroPie tree from cp, Samba, SFTP, ...
+        inotify_watcher = InotifyWatcher(log_queue=logger, print_queue=printer)
+        scheduler.call_later(0, lambda: rsync_monitor.add_source(inotify_watcher), 'RsyncMonitor.add_source')
+    except OSError as e:
+        write_log('ROM directory watcher unavailable: {}'.format(e), logger, printer)
+
+    startup.mark('ROM directory watcher')
+    # Hash what changed after every copy, and once a few minutes after boot
+    rom_index = RomIndex(log_queue=logger, print_queue=printer)
+    rsync_monitor.copy_listeners.append(rom_index.update)
+    scheduler.call_later(300, rom_index.update, 'RomIndex.update', 60)
+    startup.mark('ROM index')
+    # Temperature, CPU, fan and copy history, see record_history
+    history = TelemetryHistory()
+    trace = TraceRecorder(trace_path) if trace_path else None
+    fan_monitor.load_tuning()
+    startup.mark('history')
+    # SD card and ROM drive I/O, logged hourly and after every copy
+    monitor = StorageMonitor(is_copying=rsync_monitor.is_copying, log_queue=logger, print_queue=printer)
+    scheduler.call_later(0, lambda: monitor.start(scheduler), 'StorageMonitor.start')
+    scheduler.call_every(3600, lambda: write_log(monitor.report(), logger, printer), 'StorageMonitor.report', 60)
+    storage_monitor = monitor
+    startup.mark('storage monitor')
+
+    if metrics_address:
+        try:
+            server = MetricsServer(collect_metrics, scheduler, metrics_address, log_queue=logger,
+                                   print_queue=printer)
+            server.start()
+            metrics_server = server
+        except (socket.error, OSError) as e:
+            write_log('Metrics server unavailable: {}'.format(e), logger, printer)
+
+        startup.mark('metrics server')
+
+    write_log(startup.report(), logger, printer)
+    notifier.status('Running')
+
+
+# systemctl stop, shutdown and reboot. The signal may have interrupted the main thread holding
+# the scheduler's or the log queue's lock, the shutdown runs after scheduler.run() returns
+def terminate(signum, frame):
+    request_stop('SIGTERM')
+
+
+# kill -USR1, the profile is written from a thread of its own. The signal may have interrupted
+# the main thread holding a lock the dump needs (the scheduler's, the log queue's)
+def dump_profile(signum, frame):
+    dump = threading.Thread(name='Profiler.dump', target=write_profile)
+    dump.daemon = True
+    dump.start()
+
+
+def write_profile():
+    try:
+        profiler.dump(profile_path, scheduler.report())
+        write_log('Profile dumped to {}.txt and .folded'.format(profile_path), logger, printer)
+    except (IOError, OSError) as e:
+        write_log('Profile dump failed: {}'.format(e), logger, printer, {'PRIORITY': 3})
+
+
+if __name__ == '__main__':
+    startup = StartupTimer()
+    notifier = SystemdNotifier()
+    backend = PiBackend()
+    profiler = Profiler(profile_daemon)
+    profiler.instrument(GPIO, 'output', 'GPIO.output')
+    GPIO.setmode(GPIO.BOARD)
+    GPIO.setwarnings(False)
+    startup.mark('GPIO')
+
+    # Every timed and event driven task runs on the main thread
+    scheduler = Scheduler()
+    logger = LogQueue(max_bytes=8 * 1024 * 1024, backups=4, compress=True, scheduler=scheduler,
+                      rotate_delay=deferred_startup_delay)
+    profiler.instrument(logger, '_LogQueue__write', 'LogQueue.write')
+    printer = JournalSink(scheduler) if log_to_journal and JournalSink.available() else None
+    scheduler.logger = logger
+    scheduler.printer = printer
+    shutdown_coordinator = ShutdownCoordinator(logger, printer)
+    # Why the scheduler was stopped, see request_stop
+    stop_reason = None
+    startup.mark('scheduler and log')
+
+    led_controller = LedController(front_led_pin)
+    led_controller.start(scheduler)
+
+    # Restart and shutdown button, also turns the pi back on
+    button = ButtonController(restart_shutdown_pin, scheduler, shutdown_hold_time, led_controller=led_controller,
+                              log_queue=logger, print_queue=printer)
+    button.on_press(1, restart)
+    button.on_long_press(shutdown)
+    button.start()
+    startup.mark('LED and button')
+    # Sample at the fan check interval, both tasks share one wakeup
+    sampler = TelemetrySampler(backend.create_sensors(), interval=5)
+    sampler.start(scheduler)
+    fan_monitor = FanMonitor(fan_pin_low, fan_pin_high, log_queue=logger, print_queue=printer, sampler=sampler,
+                             predictive=predictive_fan, tuning_path=tuning_path)
+
+    for method in 'check_temp', 'cpu_temp', 'cpu_speed':
+        profiler.instrument(fan_monitor, method)
+
+    scheduler.call_every(5, fan_monitor.check_temp, 'FanMonitor.check_temp')
+    startup.mark('fan')
+    # The ROM library migration in setup.py, the ROM directory watcher is added by start_deferred
+    rsync_monitor = RsyncMonitor(led_controller, log_queue=logger, print_queue=printer,
+                                 sources=[CopyProgressWatcher()], watcher=backend.create_process_watcher(['rsync']),
+                                 priority_manager=CopyPriorityManager(log_queue=logger, print_queue=printer))
+    profiler.instrument(rsync_monitor, 'is_copying')
+    rsync_monitor.start(scheduler)
+    startup.mark('copy watcher')
+    cpu_profile_manager = None
+
+    if manage_cpu_profiles:
+        cpu_profile_manager = CpuProfileManager(watcher=backend.create_process_watcher(EMULATOR_PROCESSES),
+                                                is_copying=rsync_monitor.is_copying, fan_monitor=fan_monitor,
+                                                sampler=sampler, log_queue=logger, print_queue=printer,
+                                                settings_path=cpu_settings_path)
+        cpu_profile_manager.start(scheduler)
+        startup.mark('CPU profiles')
+
+    # Set up by start_deferred
+    rom_index = None
+    history = None
+    trace = None
+    storage_monitor = None
+    metrics_server = None
+    scheduler.call_every(5, record_history, 'TelemetryHistory.append')
+
+    # Wakeups/s and time spent in each task, hourly
+    scheduler.call_every(3600, lambda: write_log(scheduler.report() + '\r\n' + led_controller.report(), logger,
+                                                 printer), 'Scheduler.report', 60)
+    scheduler.call_every(3600, report_tuning, 'FanMonitor.tuning_report', 60)
+
+    shutdown_coordinator.add('stop producers', stop_producers)
+    shutdown_coordinator.add('restore GPIO', restore_gpio)
+    shutdown_coordinator.add('close files', close_files)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGUSR1, dump_profile)
+    scheduler.wake_on_signals()
+    profiler.start()
+
+    # The fan and the LED are live, systemd can start what is ordered after us
+    startup.ready()
+    notifier.ready('Fan and LED control running')
+    notifier.start_watchdog(scheduler)
+    write_log(startup.report(), logger, printer)
+    deferred_startup = threading.Thread(name='startup', target=start_deferred)
+    deferred_startup.daemon = True
+    scheduler.call_later(deferred_startup_delay, deferred_startup.start, 'startup.deferred', 5)
+
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        print(log_timestamp() + ' Keyboard interrupt')
+        stop_reason = stop_reason or 'keyboard interrupt'
+
+    # The scheduler has stopped, no task can run while the phases stop them, reset the pins and
+    # close the files
+    close(stop_reason or 'scheduler stopped')
+
+    if stop_reason in POWER_COMMANDS:
+        import subprocess
+
+        subprocess.call(POWER_COMMANDS[stop_reason], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-sys.exit()
+    sys.exit()
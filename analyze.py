@@ -0,0 +1,597 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# PiStation 2 log analyzer
+# Reports copy sessions, fan duty cycle per speed, temperature percentiles and restarts and
+# shutdowns from PiStation 2.log (and its rotated backups, gzipped or not) in constant memory,
+# every line goes through a generator pipeline and only the reports keep state.
+# Time range queries on a plain log seek straight to the first line of the range with a sparse
+# index of (time, byte offset) every INDEX_STEP bytes kept next to the log (<log>.idx), it is
+# built by seeking, not by reading the log, and extended as the log grows
+#
+#   python analyze.py [--day yesterday] [--since '2017-01-01 12:00'] [--until 2017-01-02]
+#                     ['PiStation 2.log' 'PiStation 2.log.1.gz' ...]
+
+import argparse
+import calendar
+import gzip
+import os
+import re
+import struct
+import sys
+from collections import deque
+from datetime import date, datetime, timedelta
+
+# [2017-01-01] [12:00:00] message, the message starts at MESSAGE_START
+MESSAGE_START = 24
+INDEX_STEP = 1024 * 1024
+TEMPERATURE_MARKER = b'CPU Temperature = '
+TEMPERATURE_MARKER_LENGTH = len(TEMPERATURE_MARKER)
+# Copying ended: 00d 00h 02m 00s | 120.0MB | ...
+COPY_ENDED_PATTERN = re.compile(br'Copying ended: (\d+)d (\d+)h (\d+)m (\d+)s(?: \| ([0-9.]+)MB)?')
+# Lines that end a run of the daemon (the fan is turned off) and the ones that start one
+POWER_EVENTS = ((b'Shutting down PiStation 2', 'shutdown'), (b'Restarting PiStation 2', 'restart'),
+                (b'Shutdown (', 'stopped'), (b'Startup: ', 'started'))
+POWER_MARKERS = tuple(marker for marker, name in POWER_EVENTS)
+FAN_NAMES = ('off', 'low', 'high')
+EPOCH = datetime(1970, 1, 1)
+
+# Seconds since 1970 of the midnight of each date seen (log times are local, they are kept as
+# if they were UTC, only differences between them matter)
+day_starts = {}
+
+
+# Seconds since 1970 of the midnight of a log line date (b'2017-01-01'), None if it is not a date
+def day_start(day):
+    start = day_starts.get(day)
+
+    if start is None:
+        try:
+            start = day_starts[day] = calendar.timegm(datetime.strptime(day.decode('ascii'), '%Y-%m-%d')
+                                                      .timetuple())
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+    return start
+
+
+# Seconds of a log line time stamp, None if the line has none (a continuation line)
+def line_time(line):
+    if line[:1] != b'[' or line[11:14] != b'] [':
+        return None
+
+    start = day_start(line[1:11])
+
+    try:
+        return start + int(line[14:16]) * 3600 + int(line[17:19]) * 60 + int(line[20:22])
+    except (TypeError, ValueError):
+        return None
+
+
+def format_time(seconds):
+    return (EPOCH + timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def format_duration(seconds):
+    return '{:d}h {:02d}m {:02d}s'.format(int(seconds // 3600), int(seconds % 3600 // 60), int(seconds % 60))
+
+
+# '2017-01-01', '2017-01-01 12:00' or '2017-01-01 12:00:00' in the time of the log lines
+def parse_time(text):
+    for time_format in '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d':
+        try:
+            return calendar.timegm(datetime.strptime(text, time_format).timetuple())
+        except ValueError:
+            continue
+
+    raise argparse.ArgumentTypeError('{} is not a date (YYYY-MM-DD[ HH:MM[:SS]])'.format(text))
+
+
+# Log Index class
+# Sparse (time, byte offset) index of a plain log, one entry for the first time stamped line
+# after every step bytes. Entries are added by seeking to each step and reading one line, the
+# log itself is never read through. The index is saved to <log>.idx and reused as long as the
+# log is the same file (inode) and the last entry still points at the same line, a rotated or
+# rewritten log gets a new index
+class LogIndex:
+    MAGIC = b'PS2I'
+    VERSION = 1
+    # magic, version, step, inode
+    HEADER = struct.Struct('<4sHxxQQ')
+    # time, offset
+    ENTRY = struct.Struct('<qQ')
+
+    def __init__(self, log_path, path=None, step=INDEX_STEP):
+        self.log_path = log_path
+        self.path = path if path else log_path + '.idx'
+        self.step = step
+        self.entries = []
+        self.added = 0
+        self.__inode = os.stat(log_path).st_ino
+        self.__load()
+
+    # Byte offset to start reading at for lines at or after seconds (a line or more before them)
+    def offset(self, seconds):
+        low, high = 0, len(self.entries)
+
+        # Last entry before seconds
+        while low < high:
+            middle = (low + high) // 2
+
+            if self.entries[middle][0] < seconds:
+                low = middle + 1
+            else:
+                high = middle
+
+        return self.entries[low - 1][1] if low else 0
+
+    # Adds the entries for the part of the log written since the last update and saves them
+    def update(self):
+        size = os.path.getsize(self.log_path)
+        position = self.entries[-1][1] + self.step if self.entries else 0
+
+        with open(self.log_path, 'rb') as log:
+            while position < size:
+                entry = self.__entry_at(log, position)
+
+                if entry is None:
+                    break
+
+                self.entries.append(entry)
+                self.added += 1
+                # The next step after this line, steps without a time stamped line are skipped
+                position = max(entry[1] + 1, position + self.step)
+
+        if self.added:
+            self.__save()
+
+    # (time, offset) of the first time stamped line starting at or after position
+    @staticmethod
+    def __entry_at(log, position):
+        log.seek(max(position - 1, 0))
+
+        # Not at the start of a line, skip to the next one
+        if position and log.read(1) != b'\n':
+            log.readline()
+
+        while True:
+            offset = log.tell()
+            line = log.readline()
+
+            if not line:
+                return None
+
+            seconds = line_time(line)
+
+            if seconds is not None:
+                return seconds, offset
+
+    def __load(self):
+        try:
+            with open(self.path, 'rb') as index:
+                magic, version, step, inode = self.HEADER.unpack(index.read(self.HEADER.size))
+                data = index.read()
+        except (IOError, OSError, struct.error):
+            return
+
+        if magic != self.MAGIC or version != self.VERSION or step != self.step or inode != self.__inode:
+            return
+
+        entries = [self.ENTRY.unpack_from(data, offset)
+                   for offset in range(0, len(data) - len(data) % self.ENTRY.size, self.ENTRY.size)]
+
+        # The log was rewritten in place (or copied over) if the last entry no longer matches
+        if entries:
+            with open(self.log_path, 'rb') as log:
+                if self.__entry_at(log, entries[-1][1]) != entries[-1]:
+                    return
+
+        self.entries = entries
+
+    def __save(self):
+        try:
+            with open(self.path + '.tmp', 'wb') as index:
+                index.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.step, self.__inode))
+                index.write(b''.join(self.ENTRY.pack(*entry) for entry in self.entries))
+
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            # Read-only log directory, the index only lives as long as this run
+            pass
+
+
+# A log opened at offset, its lines are the start of the pipeline. Gzipped logs (rotated
+# backups) are read from the start
+def open_log(path, offset=0):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+
+    log = open(path, 'rb')
+    log.seek(offset)
+    return log
+
+
+# (time, message) of the time stamped lines before offset that start with one of prefixes, the
+# newest first. The log is read backwards in blocks, only as far as the caller keeps asking
+def events_before(path, offset, prefixes, block=65536):
+    with open(path, 'rb') as log:
+        end = offset
+        rest = b''
+
+        while end > 0:
+            start = max(0, end - block)
+            log.seek(start)
+            lines = (log.read(end - start) + rest).split(b'\n')
+            # The first piece is the end of a line that starts in the block before
+            rest = lines.pop(0) if start else b''
+
+            for line in reversed(lines):
+                if line[MESSAGE_START:].startswith(prefixes):
+                    seconds = line_time(line)
+
+                    if seconds is not None:
+                        yield seconds, line[MESSAGE_START:]
+
+            end = start
+
+
+# (time, message) of every time stamped line up to until, continuation lines (multi-line
+# reports) are dropped. The log is in time order, reading stops after until. Lines before
+# since are still passed on, the reports need the state the range starts in.
+# line_time() inlined, with the date of the last line kept, this runs for every line
+def parse_events(lines, until=None):
+    until = until if until is not None else float('inf')
+    last_day = None
+    start = 0
+
+    for line in lines:
+        if line[:1] != b'[' or line[11:14] != b'] [':
+            continue
+
+        day = line[1:11]
+
+        if day != last_day:
+            start = day_start(day)
+
+            if start is None:
+                continue
+
+            last_day = day
+
+        try:
+            seconds = start + int(line[14:16]) * 3600 + int(line[17:19]) * 60 + int(line[20:22])
+        except ValueError:
+            continue
+
+        if seconds > until:
+            return
+
+        yield seconds, line[MESSAGE_START:]
+
+
+# Copy Report class
+# Copy sessions (Copying started to Copying ended), the last sessions are listed
+class CopyReport:
+    PREFIXES = (b'Copying started', b'Copying ended')
+
+    def __init__(self, since, until, listed=20):
+        self.since = since
+        self.until = until
+        self.count = 0
+        self.seconds = 0
+        self.megabytes = 0.0
+        self.longest = 0
+        self.sessions = deque(maxlen=listed)
+        self.__started = None
+
+    def add(self, seconds, message):
+        if message.startswith(b'Copying started'):
+            self.__started = seconds
+        elif message.startswith(b'Copying ended'):
+            match = COPY_ENDED_PATTERN.match(message)
+            duration = (int(match.group(1)) * 86400 + int(match.group(2)) * 3600 + int(match.group(3)) * 60 +
+                        int(match.group(4))) if match else seconds - (self.__started or seconds)
+            megabytes = float(match.group(5)) if match and match.group(5) else None
+            start = seconds - duration
+            self.__started = None
+
+            if seconds < self.since or start > self.until:
+                return
+
+            self.count += 1
+            self.seconds += duration
+            self.megabytes += megabytes or 0
+            self.longest = max(self.longest, duration)
+            self.sessions.append((start, duration, megabytes))
+
+    def report(self):
+        lines = ['Copy sessions: {} | {} total | {} longest | {:.1f}MB'.format(
+            self.count, format_duration(self.seconds), format_duration(self.longest), self.megabytes)]
+
+        for start, duration, megabytes in self.sessions:
+            lines.append('  {} {}{}'.format(format_time(start), format_duration(duration),
+                                            ' {:.1f}MB'.format(megabytes) if megabytes is not None else ''))
+
+        if self.__started is not None and self.__started <= self.until:
+            lines.append('  {} copying at the end'.format(format_time(self.__started)))
+
+        return '\n'.join(lines)
+
+
+# Fan Report class
+# Time the fan spent at each speed, from the fan switches in the log. Every run of the daemon
+# starts and ends with the fan off. A log read from an index offset does not start with the
+# fan off, resume() picks up the state from the fan lines before the offset
+class FanReport:
+    PREFIXES = (b'Temperature ', b'Min temp and time reached', b'CPU profile ') + POWER_MARKERS
+
+    def __init__(self, since, until):
+        self.since = since
+        self.until = until
+        self.seconds = [0, 0, 0]
+        self.switches = 0
+        self.__state = 0
+        self.__changed = None
+        self.__end = None
+
+    def add(self, seconds, message):
+        state = self.__state_after(message, self.__state)
+
+        if state is None:
+            return
+
+        if self.__changed is None:
+            self.__changed = seconds
+
+        if state != self.__state:
+            self.__count(seconds)
+            self.__state = state
+            self.switches += seconds >= self.since
+
+    # events: (time, message) of the lines before the log offset, newest first (events_before).
+    # They are read back to the last line that sets the fan state on its own
+    def resume(self, events):
+        lines = []
+
+        for seconds, message in events:
+            if self.__state_after(message, None) is not None:
+                lines.append((seconds, message))
+                break
+
+            if self.__state_after(message, 0) is not None:
+                lines.append((seconds, message))
+
+        for seconds, message in reversed(lines):
+            self.add(seconds, message)
+
+    # Time of the last log line, the count runs up to it when the range is open ended
+    def finish(self, seconds):
+        self.__end = seconds
+
+    # Counts up to until (now at the latest, for today), or up to the last log line when the range
+    # is open ended
+    def report(self):
+        if self.until != float('inf'):
+            self.__count(min(self.until, calendar.timegm(datetime.now().timetuple())))
+        elif self.__end is not None:
+            self.__count(self.__end)
+
+        total = sum(self.seconds)
+        return 'Fan: ' + ' | '.join('{} {} ({:.1f}%)'.format(FAN_NAMES[state], format_duration(seconds),
+                                                              100.0 * seconds / total if total else 0)
+                                    for state, seconds in enumerate(self.seconds)) + \
+            ' | {} switches'.format(self.switches)
+
+    # Fan state after message, state is the one before it (None if unknown). None if the line does
+    # not tell the fan state
+    @staticmethod
+    def __state_after(message, state):
+        if message.startswith(b'Temperature '):
+            return 2 if b' high fan speed' in message else 1
+        elif message.startswith(b'Min temp and time reached'):
+            return 0
+        elif message.startswith(b'CPU profile ') and b'fan pre-spun' in message:
+            return max(state, 1) if state is not None else None
+        elif message.startswith(POWER_MARKERS):
+            return 0
+
+        return None
+
+    # Adds the time since the last change (inside the range) to the current state
+    def __count(self, seconds):
+        if self.__changed is not None:
+            start = max(self.__changed, self.since)
+            end = min(seconds, self.until)
+
+            if end > start:
+                self.seconds[self.__state] += end - start
+
+        self.__changed = seconds
+
+
+# Temperature Report class
+# Percentiles of every temperature in the log lines (CPU Temperature = ...). Readings are
+# counted by their text (45.1), the daemon logs them in 0.1°C steps so the memory does not grow
+# with the log, and they are only turned into numbers for the report
+class TemperatureReport:
+    PREFIXES = None
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, since, until):
+        self.since = since
+        self.until = until
+        # reading: lines
+        self.histogram = {}
+
+    def add(self, seconds, message):
+        start = message.find(TEMPERATURE_MARKER)
+
+        if start < 0 or seconds < self.since:
+            return
+
+        start += TEMPERATURE_MARKER_LENGTH
+        # Up to the degree sign (UTF-8)
+        reading = message[start:message.find(b'\xc2', start, start + 8)]
+        self.histogram[reading] = self.histogram.get(reading, 0) + 1
+
+    # (°C, lines) in ascending order
+    def readings(self):
+        readings = {}
+
+        for reading, count in self.histogram.items():
+            try:
+                temperature = round(float(reading), 1)
+            except ValueError:
+                continue
+
+            readings[temperature] = readings.get(temperature, 0) + count
+
+        return sorted(readings.items())
+
+    def report(self):
+        readings = self.readings()
+        count = sum(lines for temperature, lines in readings)
+
+        if not count:
+            return 'Temperature: no readings'
+
+        percentiles = []
+
+        for percent in self.PERCENTILES:
+            rank = max(1, int(round(count * percent / 100.0)))
+            seen = 0
+
+            for temperature, lines in readings:
+                seen += lines
+
+                if seen >= rank:
+                    percentiles.append('p{} {:.1f}°C'.format(percent, temperature))
+                    break
+
+        return 'Temperature: ' + ' | '.join(percentiles) + ' | min {:.1f}°C | max {:.1f}°C | {} readings'.format(
+            readings[0][0], readings[-1][0], count)
+
+
+# Power Report class
+# Restarts and shutdowns from the power button, daemon stops (SIGTERM) and starts
+class PowerReport:
+    PREFIXES = POWER_MARKERS
+
+    def __init__(self, since, until, listed=20):
+        self.since = since
+        self.until = until
+        self.counts = dict((name, 0) for marker, name in POWER_EVENTS)
+        self.events = deque(maxlen=listed)
+
+    def add(self, seconds, message):
+        if seconds < self.since or not message.startswith(POWER_MARKERS):
+            return
+
+        for marker, name in POWER_EVENTS:
+            if message.startswith(marker):
+                self.counts[name] += 1
+                self.events.append((seconds, name, message.rstrip().decode('utf-8', 'replace')))
+                return
+
+    def report(self):
+        lines = ['Power: ' + ' | '.join('{} {}'.format(self.counts[name], name) for marker, name in POWER_EVENTS)]
+        lines.extend('  {} {}'.format(format_time(seconds), text) for seconds, name, text in self.events)
+        return '\n'.join(lines)
+
+
+# Runs the events of the logs (oldest first) through the reports, a plain log is read from
+# the index offset of since (reports with resume() are given the lines before it, newest first).
+# Most lines are temperature readings, a report only sees the lines that start with one of its
+# PREFIXES (every line if it has none). Reports with finish() are given the time of the last line
+def analyze(paths, since=None, until=None, use_index=True):
+    since = since if since is not None else float('-inf')
+    until = until if until is not None else float('inf')
+    reports = [CopyReport(since, until), FanReport(since, until), TemperatureReport(since, until),
+               PowerReport(since, until)]
+    every_line = [report.add for report in reports if report.PREFIXES is None]
+    prefixed = [report.add for report in reports if report.PREFIXES is not None]
+    prefixes = tuple(set(prefix for report in reports if report.PREFIXES for prefix in report.PREFIXES))
+    last = None
+
+    for path in paths:
+        offset = 0
+
+        if use_index and not path.endswith('.gz') and since != float('-inf'):
+            index = LogIndex(path)
+            index.update()
+            offset = index.offset(since)
+
+            if offset:
+                for report in reports:
+                    if hasattr(report, 'resume'):
+                        report.resume(events_before(path, offset, report.PREFIXES))
+
+        log = open_log(path, offset)
+
+        try:
+            for seconds, message in parse_events(log, until):
+                last = seconds
+
+                for handler in every_line:
+                    handler(seconds, message)
+
+                if message.startswith(prefixes):
+                    for handler in prefixed:
+                        handler(seconds, message)
+        finally:
+            log.close()
+
+    if last is not None:
+        for report in reports:
+            if hasattr(report, 'finish'):
+                report.finish(last)
+
+    return reports
+
+
+# The log next to PiStation 2.py and its rotated backups, oldest first
+def default_logs():
+    log = os.path.dirname(os.path.realpath(__file__)) + '/PiStation 2.log'
+    backups = []
+
+    for backup in range(1, 100):
+        for suffix in '', '.gz':
+            if os.path.isfile('{}.{}{}'.format(log, backup, suffix)):
+                backups.append('{}.{}{}'.format(log, backup, suffix))
+
+    return list(reversed(backups)) + [log]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reports copies, fan duty cycle, temperatures and restarts '
+                                                 'from the PiStation 2 log')
+    parser.add_argument('logs', nargs='*', help='logs oldest first (default: PiStation 2.log and its backups)')
+    parser.add_argument('--since', type=parse_time, help="'YYYY-MM-DD[ HH:MM[:SS]]'")
+    parser.add_argument('--until', type=parse_time, help="'YYYY-MM-DD[ HH:MM[:SS]]'")
+    parser.add_argument('--day', help='YYYY-MM-DD, today or yesterday (overrides --since and --until)')
+    parser.add_argument('--no-index', action='store_true', help='read the logs from the start')
+    args = parser.parse_args()
+
+    if args.day:
+        day = {'today': date.today(), 'yesterday': date.today() - timedelta(days=1)}.get(args.day)
+        args.since = calendar.timegm(day.timetuple()) if day else parse_time(args.day)
+        args.until = args.since + 86399
+
+    paths = [path for path in (args.logs if args.logs else default_logs()) if os.path.isfile(path)]
+
+    if not paths:
+        print('No log to analyze')
+        return 1
+
+    reports = analyze(paths, args.since, args.until, not args.no_index)
+    print('{} to {}'.format(format_time(args.since) if args.since is not None else 'start',
+                            format_time(args.until) if args.until is not None else 'end'))
+
+    for report in reports:
+        print(report.report())
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# PiStation 2 benchmarks
+# Measures the classes in PiStation 2.py against the code they replaced
+#
+#   python benchmark.py rsync [--seconds 10]
+#   python benchmark.py sensors [--iterations 2000]
+#   python benchmark.py logqueue [--lines 20000]
+#   python benchmark.py simulate [--hours 24]
+#   python benchmark.py startup [--runs 5] [--directories 2000]
+#   python benchmark.py cpuprofile [--hours 24]
+#   python benchmark.py analyze [--megabytes 256]
+#   python benchmark.py journal [--records 20000]
+#   python benchmark.py profile [--hours 24]
+#   python benchmark.py storage
+
+import argparse
+import os
+import random
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime
+from time import gmtime, strftime, time
+
+from pistation2_loader import load_pistation2, pistation2_script
+
+if sys.version_info[0] < 3:
+    from Queue import Queue, Empty
+else:
+    from queue import Queue, Empty
+
+
+# Counts every process spawned through subprocess, os.system and os.popen
+class SpawnCounter:
+    def __init__(self):
+        self.count = 0
+        self.__patched = []
+
+    def __enter__(self):
+        counter = self
+        popen_init = subprocess.Popen.__init__
+
+        def counting_popen_init(popen, *args, **kwargs):
+            counter.count += 1
+            popen_init(popen, *args, **kwargs)
+
+        self.__patch(subprocess.Popen, '__init__', counting_popen_init)
+        self.__patch(os, 'system', self.__counting(os.system))
+
+        # Python 3 os.popen goes through subprocess.Popen, it is already counted
+        if sys.version_info[0] < 3:
+            self.__patch(os, 'popen', self.__counting(os.popen))
+
+        return self
+
+    def __exit__(self, *exc_info):
+        for owner, name, original in reversed(self.__patched):
+            setattr(owner, name, original)
+        self.__patched = []
+
+    def __patch(self, owner, name, replacement):
+        self.__patched.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, replacement)
+
+    def __counting(self, function):
+        def counting(*args, **kwargs):
+            self.count += 1
+            return function(*args, **kwargs)
+        return counting
+
+
+# Counts the calls to a module function (e.g. os.fsync) while in use
+class CallCounter:
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        self.count = 0
+        self.__original = None
+
+    def __enter__(self):
+        self.__original = original = getattr(self.owner, self.name)
+
+        def counting(*args, **kwargs):
+            self.count += 1
+            return original(*args, **kwargs)
+
+        setattr(self.owner, self.name, counting)
+        return self
+
+    def __exit__(self, *exc_info):
+        setattr(self.owner, self.name, self.__original)
+
+
+# CPU seconds used by this process and the children it waited for
+def cpu_seconds():
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+# Runs tick() iterations times, returns (cpu seconds, spawns) per tick
+def measure_ticks(tick, iterations):
+    with SpawnCounter() as spawns:
+        cpu = cpu_seconds()
+
+        for _ in range(iterations):
+            tick()
+
+        cpu = cpu_seconds() - cpu
+
+    return cpu / iterations, float(spawns.count) / iterations
+
+
+# Runs tick() for the given wall clock seconds, returns (cpu seconds, spawns, ticks)
+def measure_seconds(tick, seconds):
+    ticks = 0
+
+    with SpawnCounter() as spawns:
+        cpu = cpu_seconds()
+        end = time() + seconds
+
+        while time() < end:
+            tick()
+            ticks += 1
+
+        cpu = cpu_seconds() - cpu
+
+    return cpu, spawns.count, ticks
+
+
+def print_row(name, forks_per_hour, cpu_per_hour, wakeups_per_hour):
+    print('{:<28} {:>12.0f} {:>14.3f} {:>12.0f}'.format(name, forks_per_hour, cpu_per_hour, wakeups_per_hour))
+
+
+def benchmark_rsync(args):
+    pistation2 = load_pistation2()
+    poll_interval = 0.25
+    ticks_per_hour = 3600 / poll_interval
+
+    def pidof_tick():
+        try:
+            subprocess.check_output(['pidof', 'rsync'])
+        except subprocess.CalledProcessError:
+            pass
+
+    print('rsync detection, idle (rsync not running), RsyncMonitor poll interval {}s'.format(poll_interval))
+    print('{:<28} {:>12} {:>14} {:>12}'.format('backend', 'forks/h', 'cpu s/h', 'wakeups/h'))
+
+    cpu, forks = measure_ticks(pidof_tick, args.iterations)
+    print_row('pidof (old)', forks * ticks_per_hour, cpu * ticks_per_hour, ticks_per_hour)
+
+    scan = pistation2.ProcScanWatcher(['rsync'])
+    cpu, forks = measure_ticks(lambda: scan.wait(0), args.iterations)
+    scan.close()
+    print_row('/proc scan', forks * ticks_per_hour, cpu * ticks_per_hour, ticks_per_hour)
+
+    try:
+        connector = pistation2.ProcConnectorWatcher(['rsync'])
+    except (socket.error, OSError, AttributeError) as e:
+        print('{:<28} unavailable ({})'.format('proc connector', e))
+        return
+
+    # Event driven, measured in real time: RsyncMonitor reads it from the scheduler (add_reader),
+    # so it only wakes up for process events, the one timeout at the end aside
+    end = time() + args.seconds
+    cpu, forks, ticks = measure_seconds(lambda: connector.wait(max(0, end - time())), args.seconds)
+    connector.close()
+    scale = 3600.0 / args.seconds
+    print_row('proc connector', forks * scale, cpu * scale, ticks * scale)
+
+
+# Creates a sysfs tree with the thermal zones and cpufreq files of a Pi 3
+def create_fake_sysfs(root, zones=1, cores=4, temperature=47236, frequency=1200000, min_frequency=600000,
+                      max_frequency=1400000, governor='ondemand'):
+    for zone in range(zones):
+        zone_dir = '{}/class/thermal/thermal_zone{}'.format(root, zone)
+        os.makedirs(zone_dir)
+
+        with open(zone_dir + '/temp', 'w') as temp:
+            temp.write('{}\n'.format(temperature))
+
+        with open(zone_dir + '/type', 'w') as zone_type:
+            zone_type.write('cpu-thermal\n' if zone == 0 else 'zone{}\n'.format(zone))
+
+    for core in range(cores):
+        cpufreq_dir = '{}/devices/system/cpu/cpu{}/cpufreq'.format(root, core)
+        os.makedirs(cpufreq_dir)
+
+        with open(cpufreq_dir + '/scaling_cur_freq', 'w') as freq:
+            freq.write('{}\n'.format(frequency))
+
+        for name, value in (('cpuinfo_min_freq', min_frequency), ('cpuinfo_max_freq', max_frequency),
+                            ('scaling_min_freq', min_frequency), ('scaling_max_freq', max_frequency),
+                            ('scaling_governor', governor),
+                            ('scaling_available_governors', 'conservative ondemand userspace powersave '
+                                                            'performance schedutil')):
+            with open('{}/{}'.format(cpufreq_dir, name), 'w') as setting:
+                setting.write('{}\n'.format(value))
+
+
+def benchmark_sensors(args):
+    pistation2 = load_pistation2()
+    root = tempfile.mkdtemp(prefix='pistation2-sysfs-')
+
+    try:
+        create_fake_sysfs(root)
+        cpu_freq = root + '/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq'
+
+        # vcgencmd only exists on a Pi, echo the same output through the same popen path elsewhere
+        if os.path.isfile('/usr/bin/vcgencmd'):
+            measure_temp = 'vcgencmd measure_temp'
+        else:
+            measure_temp = 'echo "temp=47.2\'C"'
+
+        # FanMonitor.cpu_temp and FanMonitor.cpu_speed before the sysfs sensors
+        def old_sample():
+            temperature = float(os.popen(measure_temp).readline().replace('temp=', '').replace('\'C\n', ''))
+            current_freq = subprocess.check_output('cat ' + cpu_freq, shell=True).decode().replace('0000\n', '')
+            frequency = float('0.' + current_freq) if int(current_freq) < 100 else \
+                float('{}.{}'.format(current_freq[:1], current_freq[1:]))
+            return temperature, frequency
+
+        sensors = pistation2.SysfsSensors(root + '/class/thermal', root + '/devices/system/cpu')
+
+        def sysfs_sample():
+            return sensors.temperature(), sensors.frequencies()
+
+        print('Sensor sample latency (temperature + frequency), fake sysfs tree in ' + root)
+        print('{:<28} {:>14} {:>12}'.format('path', 'us/sample', 'spawns'))
+
+        for name, sample, iterations in (('vcgencmd + cat (old)', old_sample, max(1, args.iterations // 10)),
+                                         ('sysfs pread', sysfs_sample, args.iterations)):
+            with SpawnCounter() as spawns:
+                start = time()
+
+                for _ in range(iterations):
+                    sample()
+
+                elapsed = time() - start
+
+            print('{:<28} {:>14.1f} {:>12.1f}'.format(name, elapsed / iterations * 1000000,
+                                                      float(spawns.count) / iterations))
+
+        sensors.close()
+    finally:
+        shutil.rmtree(root)
+
+
+# LogQueue before group commit (one write, flush and fsync per line, 0.1s between lines),
+# only the log path was made configurable and the thread made a daemon so a lost
+# close() race cannot hang the benchmark
+class LegacyLogQueue:
+    def __init__(self, path):
+        self.queue = Queue()
+        self.__logging = True
+        self.__stop_event = threading.Event()
+        self.__log_file = open(path, 'a')
+
+        thread = threading.Thread(name='LegacyLogQueue', target=self.__logger)
+        thread.daemon = True
+        thread.start()
+
+    def queue_add(self, text):
+        self.queue.put_nowait(text)
+
+    def close(self):
+        self.queue.join()
+        self.__log_file.close()
+        self.__logging = False
+
+    def __logger(self):
+        while self.__logging:
+            try:
+                text = self.queue.get()
+                self.__log_file.write(text)
+                self.__log_file.flush()
+                os.fsync(self.__log_file.fileno())
+                self.queue.task_done()
+            except Empty:
+                pass
+
+            self.__stop_event.wait(0.1)
+        return
+
+
+def benchmark_logqueue(args):
+    pistation2 = load_pistation2()
+    root = tempfile.mkdtemp(prefix='pistation2-log-')
+    line = '[2017-01-01] [12:00:00] 4s left: CPU Temperature = 44.5\xb0C | CPU Usage = 3.2% | CPU Speed = 0.6GHz\r\n'
+
+    queues = (
+        ('LogQueue (old)', lambda path: LegacyLogQueue(path), args.legacy_lines),
+        ('group commit, fsync 5s', lambda path: pistation2.LogQueue(path, fsync_interval=5), args.lines),
+        ('group commit, fsync 100 lines', lambda path: pistation2.LogQueue(path, fsync_interval=0,
+                                                                           fsync_lines=100), args.lines),
+        ('group commit, fsync on close', lambda path: pistation2.LogQueue(path, fsync_interval=0), args.lines),
+        ('group commit, rotate 1MB gzip', lambda path: pistation2.LogQueue(path, max_bytes=1024 * 1024,
+                                                                           compress=True), args.lines),
+    )
+
+    print('Log writer throughput, {} in {}'.format('producer queues every line at once', root))
+    print('{:<32} {:>8} {:>12} {:>10} {:>10}'.format('writer', 'lines', 'lines/s', 'fsyncs', 'fsyncs/s'))
+
+    try:
+        for index, (name, create, lines) in enumerate(queues):
+            with CallCounter(os, 'fsync') as fsyncs:
+                log_queue = create('{}/PiStation 2.{}.log'.format(root, index))
+                start = time()
+
+                for _ in range(lines):
+                    log_queue.queue_add(line)
+
+                log_queue.close()
+                elapsed = time() - start
+
+            print('{:<32} {:>8} {:>12.0f} {:>10} {:>10.1f}'.format(name, lines, lines / elapsed,
+                                                                   fsyncs.count, fsyncs.count / elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+# One simulated hour: idle, a copy, a gaming session that heats the SoC up to 70°C while a
+# second copy runs, then cooling down
+SIMULATED_CURVE = [(0, 42), (600, 42), (1800, 70), (2400, 70), (3300, 42), (3600, 42)]
+SIMULATED_COPIES = [(307.3, 120), (2011.9, 300)]
+
+
+# Runs the daemon tasks (sampler, fan check, rsync watch, LED flashing, log) on a simulated
+# backend in virtual time, returns the backend and the measurements. The methods the daemon
+# instruments are instrumented with profiler (if given), which runs while the daemon does
+def simulate_daemon(hours, predictive, log_path, profiler=None):
+    pistation2 = load_pistation2()
+    backend = pistation2.SimulatedBackend(SIMULATED_CURVE, SIMULATED_COPIES, period=3600)
+    clock = backend.clock
+
+    profiler = profiler or pistation2.Profiler()
+    profiler.instrument(backend.gpio, 'output', 'GPIO.output')
+    scheduler = pistation2.Scheduler(clock=clock)
+    logger = pistation2.LogQueue(log_path, scheduler=scheduler, clock=clock)
+    profiler.instrument(logger, '_LogQueue__write', 'LogQueue.write')
+    scheduler.logger = logger
+    led_controller = pistation2.LedController(pistation2.front_led_pin, gpio=backend.gpio, clock=clock)
+    sampler = pistation2.TelemetrySampler(backend.create_sensors(), interval=5, clock=clock)
+    sampler.start(scheduler)
+    fan_monitor = pistation2.FanMonitor(pistation2.fan_pin_low, pistation2.fan_pin_high, log_queue=logger,
+                                        sampler=sampler, predictive=predictive, gpio=backend.gpio, clock=clock)
+
+    for method in 'check_temp', 'cpu_temp', 'cpu_speed':
+        profiler.instrument(fan_monitor, method)
+
+    scheduler.call_every(5, fan_monitor.check_temp, 'FanMonitor.check_temp')
+    rsync_monitor = pistation2.RsyncMonitor(led_controller, log_queue=logger,
+                                            watcher=backend.create_process_watcher(['rsync']), clock=clock)
+    profiler.instrument(rsync_monitor, 'is_copying')
+    profiler.start()
+    rsync_monitor.start(scheduler)
+    scheduler.call_later(hours * 3600, scheduler.stop)
+
+    with SpawnCounter() as spawns:
+        cpu = cpu_seconds()
+        start = time()
+        scheduler.run()
+        elapsed = time() - start
+        cpu = cpu_seconds() - cpu
+
+    rsync_monitor.stop()
+    logger.close()
+    profiler.stop()
+    return pistation2, backend, fan_monitor, cpu, spawns.count, scheduler.wakeups, elapsed
+
+
+# Seconds from each event to the first change of pin (to level, if given) up to an hour after it.
+# Changes up to lead seconds before the event count too (negative), the predictive fan policy
+# switches ahead of the temperature
+def reaction_latencies(changes, events, pin, level=None, lead=0):
+    latencies = []
+
+    for event in events:
+        for change_time, change_pin, change_level in changes:
+            if change_pin == pin and level in (None, change_level) and event - lead <= change_time < event + 3600:
+                latencies.append(change_time - event)
+                break
+
+    return latencies
+
+
+def benchmark_simulate(args):
+    root = tempfile.mkdtemp(prefix='pistation2-sim-')
+
+    print('Daemon tasks on the simulated backend, {} virtual hours (one gaming session and two copies '
+          'an hour)'.format(args.hours))
+    print('{:<12} {:>9} {:>10} {:>9} {:>12} {:>12} {:>12} {:>12} {:>9}'.format(
+        'fan policy', 'cpu s/h', 'wakeups/h', 'spawns/h', 'fan low s', 'fan high s', 'LED avg s', 'LED max s',
+        'speedup'))
+
+    try:
+        for predictive in False, True:
+            pistation2, backend, fan_monitor, cpu, spawns, wakeups, elapsed = \
+                simulate_daemon(args.hours, predictive, '{}/PiStation 2.{}.log'.format(root, int(predictive)))
+            sensors = backend.create_sensors()
+            hours = range(int(args.hours))
+            row = []
+
+            # Temperature crossing to fan switch
+            for threshold, pin in ((fan_monitor.temp_fan_low, pistation2.fan_pin_low),
+                                   (fan_monitor.temp_fan_high, pistation2.fan_pin_high)):
+                crossing = next(tenth / 10.0 for tenth in range(36000)
+                                if sensors.temperature_at(tenth / 10.0) >= threshold)
+                latencies = reaction_latencies(backend.gpio.changes, [hour * 3600 + crossing for hour in hours],
+                                               pin, 1, fan_monitor.slope_window)
+                row.append(sum(latencies) / len(latencies) if latencies else float('nan'))
+
+            # Copy start to the first LED flash
+            latencies = reaction_latencies(backend.gpio.changes, [hour * 3600 + start for hour in hours
+                                                                  for start, duration in SIMULATED_COPIES],
+                                           pistation2.front_led_pin)
+            latencies = latencies or [float('nan')]
+
+            print('{:<12} {:>9.3f} {:>10.0f} {:>9.1f} {:>+12.1f} {:>+12.1f} {:>12.3f} {:>12.3f} {:>8.0f}x'.format(
+                'predictive' if predictive else 'threshold', cpu / args.hours, wakeups / args.hours,
+                spawns / args.hours, row[0], row[1], sum(latencies) / len(latencies), max(latencies),
+                args.hours * 3600 / elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+# Runs the top level of PiStation 2.py the way the daemon starts, in a new interpreter (argv[1] is
+# the script). A script is compiled on every start, it has no cached bytecode. Prints the seconds
+# the compile and the imports and definitions took, and the number of modules loaded
+DAEMON_IMPORT = '''
+import sys
+from time import time
+
+with open(sys.argv[1]) as script:
+    source = script.read()
+
+modules = len(sys.modules)
+start = time()
+code = compile(source, sys.argv[1], 'exec')
+compiled = time()
+exec(code, {'__name__': 'pistation2', '__file__': sys.argv[1]})
+print('{} {} {}'.format(time() - compiled, len(sys.modules) - modules, compiled - start))
+'''
+
+# Modules PiStation 2.py imports where they are used instead of at startup
+DEFERRED_IMPORTS = ['gzip', 'shutil', 'json', 'hashlib', 'sqlite3', 'multiprocessing', 'subprocess', 'ctypes.util',
+                    'platform']
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+# Median seconds, modules loaded (and compile seconds) of running code in a new interpreter runs times
+def measure_interpreter(code, runs, *args):
+    samples = []
+
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', code] + list(args)).decode().split()
+        samples.append((float(output[0]), int(output[1]), float(output[2]) if len(output) > 2 else 0.0))
+
+    return median(samples)
+
+
+# ROM tree with directories directories under roms/<system>/ for the directory watcher
+def create_fake_roms(root, directories):
+    systems = ['nes', 'snes', 'megadrive', 'psx', 'n64', 'gba', 'mame-libretro', 'arcade']
+
+    for directory in range(directories):
+        os.makedirs('{}/roms/{}/{}'.format(root, systems[directory % len(systems)], directory))
+
+
+def benchmark_startup(args):
+    print('Import time, median of {} runs in a new interpreter'.format(args.runs))
+    print('{:<32} {:>10} {:>9}'.format('import', 'ms', 'modules'))
+    daemon_import, daemon_modules, daemon_compile = measure_interpreter(DAEMON_IMPORT, args.runs, pistation2_script)
+    print('{:<32} {:>10.1f}'.format('PiStation 2.py compile', 1000 * daemon_compile))
+    print('{:<32} {:>10.1f} {:>9}'.format('PiStation 2.py imports', 1000 * daemon_import, daemon_modules))
+    deferred = 0
+
+    for name in DEFERRED_IMPORTS:
+        seconds, modules, _ = measure_interpreter('import sys\nfrom time import time\nmodules = len(sys.modules)\n'
+                                               'start = time()\nimport {}\nprint(\'{{}} {{}}\'.format(time() - '
+                                               'start, len(sys.modules) - modules))'.format(name), args.runs)
+        deferred += seconds
+        print('{:<32} {:>10.1f} {:>9}'.format('  ' + name + ' (deferred)', 1000 * seconds, modules))
+
+    print('{:<32} {:>10.1f}'.format('  deferred imports, at most', 1000 * deferred))
+
+    pistation2 = load_pistation2()
+    root = tempfile.mkdtemp(prefix='pistation2-startup-')
+    notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    notify_socket.bind(root + '/notify')
+    notify_socket.settimeout(1)
+    os.environ['NOTIFY_SOCKET'] = root + '/notify'
+    os.environ['WATCHDOG_USEC'] = '30000000'
+    create_fake_sysfs(root + '/sys')
+    create_fake_roms(root + '/RetroPie', args.directories)
+    backend = pistation2.SimulatedBackend(SIMULATED_CURVE)
+    components = {}
+    timings = []
+
+    # Steps in the order the daemon runs them, True for the ones after READY=1
+    steps = (
+        ('systemd notifier', False, lambda: components.update(notifier=pistation2.SystemdNotifier())),
+        ('scheduler and log', False, lambda: components.update(
+            scheduler=pistation2.Scheduler(),
+            logger=pistation2.LogQueue(root + '/PiStation 2.log', max_bytes=8 * 1024 * 1024, backups=4,
+                                       compress=True, rotate_delay=30))),
+        ('LED and button', False, lambda: (
+            components.update(led_controller=pistation2.LedController(pistation2.front_led_pin, gpio=backend.gpio)),
+            components['led_controller'].start(components['scheduler']),
+            components.update(button=pistation2.ButtonController(pistation2.restart_shutdown_pin,
+                                                                 components['scheduler'], gpio=backend.gpio)),
+            components['button'].start())),
+        ('fan (sysfs sensors)', False, lambda: (
+            components.update(sampler=pistation2.TelemetrySampler(
+                pistation2.SysfsSensors(root + '/sys/class/thermal', root + '/sys/devices/system/cpu'), 5)),
+            components['sampler'].start(components['scheduler']),
+            components.update(fan_monitor=pistation2.FanMonitor(pistation2.fan_pin_low, pistation2.fan_pin_high,
+                                                                sampler=components['sampler'],
+                                                                predictive=True, gpio=backend.gpio)))),
+        ('copy watcher', False, lambda: (
+            components.update(rsync_monitor=pistation2.RsyncMonitor(
+                components['led_controller'], sources=[pistation2.CopyProgressWatcher(root + '/copy.json')],
+                watcher=pistation2.create_process_watcher(['rsync']),
+                priority_manager=pistation2.CopyPriorityManager())),
+            components['rsync_monitor'].start(components['scheduler']))),
+        ('CPU profiles', False, lambda: (
+            components.update(cpu_profile_manager=pistation2.CpuProfileManager(
+                root + '/sys/devices/system/cpu', pistation2.create_process_watcher(pistation2.EMULATOR_PROCESSES),
+                components['rsync_monitor'].is_copying, components['fan_monitor'], components['sampler'])),
+            components['cpu_profile_manager'].start(components['scheduler']))),
+        ('READY=1', False, lambda: components['notifier'].ready('Fan and LED control running')),
+        ('ROM dir watcher, {} dirs'.format(args.directories), True, lambda: components.update(
+            inotify=pistation2.InotifyWatcher(root + '/RetroPie'))),
+        ('ROM index', True, lambda: components.update(rom_index=pistation2.RomIndex(root + '/RetroPie/roms',
+                                                                                  root + '/roms.db'))),
+        ('history (new file)', True, lambda: components.update(
+            history=pistation2.TelemetryHistory(root + '/history.dat'))),
+        ('storage monitor', True, lambda: (
+            components.update(storage_monitor=pistation2.StorageMonitor(
+                is_copying=components['rsync_monitor'].is_copying)),
+            components['storage_monitor'].start(components['scheduler']))),
+        ('metrics server', True, lambda: (
+            components.update(metrics_server=pistation2.MetricsServer(lambda: [], components['scheduler'],
+                                                                      ('127.0.0.1', 0))),
+            components['metrics_server'].start())),
+    )
+
+    try:
+        for name, deferred_step, step in steps:
+            start = time()
+
+            try:
+                step()
+            except (OSError, socket.error) as e:
+                print('{} unavailable: {}'.format(name, e))
+                continue
+
+            timings.append((name, deferred_step, time() - start))
+
+        try:
+            message = notify_socket.recv(4096).decode()
+        except socket.timeout:
+            message = 'nothing'
+
+        print('')
+        print('Startup steps on the simulated backend, fake sysfs and ROM trees in ' + root)
+        print('{:<32} {:>10}'.format('step', 'ms'))
+        print('{:<32} {:>10.1f}'.format('compile and imports', 1000 * (daemon_compile + daemon_import)))
+
+        for name, deferred_step, seconds in timings:
+            print('{:<32} {:>10.1f}'.format(('  ' if deferred_step else '') + name, 1000 * seconds))
+
+        print('{:<32} {:>10.1f}'.format('ready after', 1000 * (daemon_compile + daemon_import + sum(
+            seconds for name, deferred_step, seconds in timings if not deferred_step))))
+        print('{:<32} {:>10.1f}'.format('deferred after ready', 1000 * sum(
+            seconds for name, deferred_step, seconds in timings if deferred_step)))
+        print('systemd got {!r}, watchdog every {}s'.format(message, components['notifier'].watchdog_interval / 2))
+    finally:
+        for name in 'rsync_monitor', 'button', 'sampler', 'metrics_server':
+            if name in components:
+                components[name].stop()
+
+        for name in 'cpu_profile_manager', 'inotify', 'history', 'storage_monitor', 'logger', 'notifier':
+            if name in components:
+                components[name].close()
+
+        notify_socket.close()
+        shutil.rmtree(root)
+
+
+# One game an hour, from the start of the heat up in SIMULATED_CURVE to the start of the cool down
+SIMULATED_GAMES = [(600, 2700)]
+
+
+# Stands in for the kernel on a fake cpufreq tree: moves scaling_cur_freq to where the governor
+# would put it (ondemand and schedutil go up while something is copied)
+def fake_cpufreq_kernel(cpu_dir, busy):
+    for cpufreq_dir in sorted(set(os.path.realpath('{}/{}/cpufreq'.format(cpu_dir, core))
+                                  for core in os.listdir(cpu_dir) if core.startswith('cpu'))):
+        def read(name):
+            with open('{}/{}'.format(cpufreq_dir, name)) as value:
+                return value.read().strip()
+
+        governor = read('scaling_governor')
+        high = governor == 'performance' or governor != 'powersave' and busy()
+
+        with open(cpufreq_dir + '/scaling_cur_freq', 'w') as freq:
+            freq.write(read('scaling_max_freq' if high else 'scaling_min_freq') + '\n')
+
+
+# Seconds from each event to the switch to profile right after it, events with a switch to
+# another profile first have none
+def switch_latencies(switches, events, profile):
+    latencies = []
+
+    for event in events:
+        switched = next(((switch_time, switched) for switch_time, switched in switches if switch_time >= event),
+                        None)
+
+        if switched and switched[1] == profile:
+            latencies.append(switched[0] - event)
+
+    return latencies
+
+
+def benchmark_cpuprofile(args):
+    pistation2 = load_pistation2()
+    root = tempfile.mkdtemp(prefix='pistation2-cpufreq-')
+    cpu_dir = root + '/devices/system/cpu'
+    create_fake_sysfs(root)
+    backend = pistation2.SimulatedBackend(SIMULATED_CURVE, SIMULATED_COPIES, period=3600)
+    clock = backend.clock
+
+    scheduler = pistation2.Scheduler(clock=clock)
+    logger = pistation2.LogQueue(root + '/PiStation 2.log', scheduler=scheduler, clock=clock)
+    sampler = pistation2.TelemetrySampler(backend.create_sensors(), interval=5, clock=clock)
+    sampler.start(scheduler)
+    fan_monitor = pistation2.FanMonitor(pistation2.fan_pin_low, pistation2.fan_pin_high, log_queue=logger,
+                                        sampler=sampler, predictive=True, gpio=backend.gpio, clock=clock)
+    scheduler.call_every(5, fan_monitor.check_temp, 'FanMonitor.check_temp')
+    led_controller = pistation2.LedController(pistation2.front_led_pin, gpio=backend.gpio, clock=clock)
+    rsync_monitor = pistation2.RsyncMonitor(led_controller, log_queue=logger,
+                                            watcher=backend.create_process_watcher(['rsync']), clock=clock)
+    rsync_monitor.start(scheduler)
+    games = pistation2.SimulatedProcessWatcher(clock, SIMULATED_GAMES, 3600, first_pid=6000000)
+    manager = pistation2.CpuProfileManager(cpu_dir, games, rsync_monitor.is_copying, fan_monitor, sampler,
+                                           log_queue=logger)
+    policy = manager.policies[0]
+    before = policy.settings()
+    scheduler.call_every(1, lambda: fake_cpufreq_kernel(cpu_dir, rsync_monitor.is_copying), 'kernel')
+    # (virtual time, profile) of every switch
+    switches = []
+    switch = manager.switch
+
+    def recording_switch(profile):
+        switches.append((clock.monotonic(), profile))
+        switch(profile)
+
+    manager.switch = recording_switch
+    scheduler.call_later(args.hours * 3600, scheduler.stop)
+
+    try:
+        with CallCounter(pistation2.CpufreqPolicy, 'write') as writes:
+            with CallCounter(fan_monitor, 'pre_spin') as pre_spins:
+                manager.start(scheduler)
+                start = time()
+                scheduler.run()
+                elapsed = time() - start
+                manager.close()
+
+        rsync_monitor.stop()
+        logger.close()
+        hours = range(int(args.hours))
+        seconds = {}
+
+        for (switch_time, profile), (next_time, _) in zip(switches, switches[1:] + [(clock.monotonic(), None)]):
+            seconds[profile.name] = seconds.get(profile.name, 0) + next_time - switch_time
+
+        print('CPU profiles on the simulated backend, {} virtual hours (one game and two copies an hour), fake '
+              'cpufreq tree in {}'.format(args.hours, root))
+        print('{:<12} {:>10} {:>10} {:>14} {:>14}'.format('profile', 'switches', 'hours', 'latency avg s',
+                                                          'latency max s'))
+
+        for profile, sessions in ((pistation2.CPU_PROFILE_EMULATOR, SIMULATED_GAMES),
+                                  (pistation2.CPU_PROFILE_COPY, SIMULATED_COPIES),
+                                  (pistation2.CPU_PROFILE_IDLE, ())):
+            # A copy during a game never switches to the copy profile, it has no latency
+            latencies = switch_latencies(switches, [hour * 3600 + start for hour in hours
+                                                    for start, duration in sessions], profile)
+            print('{:<12} {:>10} {:>10.2f} {:>14} {:>14}'.format(
+                profile.name, sum(1 for _, switched in switches if switched == profile),
+                seconds.get(profile.name, 0) / 3600.0,
+                '{:.1f}'.format(sum(latencies) / len(latencies)) if latencies else '-',
+                '{:.1f}'.format(max(latencies)) if latencies else '-'))
+
+        fan_latencies = reaction_latencies(backend.gpio.changes, [hour * 3600 + start for hour in hours
+                                                                  for start, duration in SIMULATED_GAMES],
+                                           pistation2.fan_pin_low, 1)
+        print('{} sysfs writes, {} fan pre-spins, game start to fan on {:.1f}s avg, settings restored: {}, '
+              '{:.0f}x speedup'.format(writes.count, pre_spins.count,
+                                       sum(fan_latencies) / len(fan_latencies) if fan_latencies else float('nan'),
+                                       'yes' if policy.settings() == before else 'no',
+                                       args.hours * 3600 / elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+# Writes a log of about megabytes MB the way the daemon writes it, a line every 5 seconds (the
+# fan countdown), with fan switches, copies, progress lines, starts and stops in between.
+# Returns the time of the first and the last line
+def write_synthetic_log(path, megabytes):
+    generator = random.Random(1)
+    start = now = 1483228800
+    written = 0
+
+    with open(path, 'wb') as log:
+        while written < megabytes * 1048576:
+            lines = []
+
+            for _ in range(2000):
+                now += 5
+                temperature = round(generator.uniform(40, 70), 1)
+                draw = generator.random()
+
+                if draw < 0.002:
+                    message = 'Temperature reached for high fan speed (65°C): CPU Temperature = {}°C | ' \
+                              'CPU Usage = 50.0% | CPU Speed = 1.2GHz'.format(temperature)
+                elif draw < 0.006:
+                    message = 'Temperature reached for low fan speed (55°C): CPU Temperature = {}°C | ' \
+                              'CPU Usage = 50.0% | CPU Speed = 1.2GHz'.format(temperature)
+                elif draw < 0.01:
+                    message = 'Min temp and time reached, turning fan off'
+                elif draw < 0.011:
+                    message = 'Copying started'
+                elif draw < 0.012:
+                    message = 'Copying ended: 00d 00h 02m 00s | 120.0MB | 0.00MB/s now | 1.00MB/s average | ' \
+                              '2.00MB/s peak | 0s stalled'
+                elif draw < 0.0121:
+                    message = 'Startup: interpreter and imports 310ms | GPIO 3ms | ready after 420ms'
+                elif draw < 0.0122:
+                    message = 'Shutdown (SIGTERM): stop producers 1ms | restore GPIO 0ms | close files 1ms'
+                elif draw < 0.03:
+                    message = 'Copying: 10.0MB | 1.00MB/s now | 1.00MB/s average | 2.00MB/s peak | 0s stalled'
+                else:
+                    message = '{}s left: CPU Temperature = {}°C | CPU Usage = 3.2% | CPU Speed = 0.6GHz'.format(
+                        generator.randint(1, 30), temperature)
+
+                lines.append(strftime('[%Y-%m-%d] [%H:%M:%S] ', gmtime(now)) + message + '\r\n')
+
+            data = ''.join(lines)
+            data = data.encode('utf-8') if not isinstance(data, bytes) else data
+            log.write(data)
+            written += len(data)
+
+    return start + 5, now
+
+
+def benchmark_analyze(args):
+    import analyze
+
+    root = tempfile.mkdtemp(prefix='pistation2-analyze-')
+    path = root + '/PiStation 2.log'
+
+    try:
+        first, last = write_synthetic_log(path, args.megabytes)
+        size = os.path.getsize(path)
+        day = first + (last - first) // 2 // 86400 * 86400
+        print('Log analyzer on a {:.0f}MB synthetic log ({:.0f} days) in {}'.format(size / 1048576.0,
+                                                                                 (last - first) / 86400.0, root))
+        print('{:<36} {:>10} {:>10}'.format('query', 's', 'log MB/s'))
+        runs = (
+            ('full scan', lambda: analyze.analyze([path], use_index=False)),
+            ('one day, index built', lambda: analyze.analyze([path], day, day + 86399)),
+            ('one day, index reused', lambda: analyze.analyze([path], day + 86400, day + 2 * 86400 - 1)),
+            ('one hour, index reused', lambda: analyze.analyze([path], day + 43200, day + 46799)),
+        )
+
+        for name, run in runs:
+            start = time()
+            run()
+            elapsed = time() - start
+            print('{:<36} {:>10.3f} {:>10.0f}'.format(name, elapsed, size / 1048576.0 / elapsed))
+
+        index = analyze.LogIndex(path)
+        print('Index: {} entries, {} bytes'.format(len(index.entries), os.path.getsize(index.path)))
+    finally:
+        shutil.rmtree(root)
+
+
+# Fields of a journald native protocol datagram, {name: value bytes}
+def parse_journal_entry(data):
+    fields = {}
+    position = 0
+
+    while position < len(data):
+        end = data.index(b'\n', position)
+        line = data[position:end]
+
+        if b'=' in line:
+            name, value = line.split(b'=', 1)
+            position = end + 1
+        else:
+            # NAME, a newline, the value length (64 bit little endian), the value and a newline
+            name = line
+            length = struct.unpack('<Q', data[end + 1:end + 9])[0]
+            value = data[end + 9:end + 9 + length]
+            position = end + 10 + length
+
+            if data[position - 1:position] != b'\n':
+                raise ValueError('{} is not followed by a newline'.format(name))
+
+        fields[name.decode('ascii')] = value
+
+    return fields
+
+
+# Receives datagrams on a Unix socket in place of journald, until a zero length datagram
+class JournalStandIn:
+    def __init__(self, path):
+        self.entries = []
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(path)
+        self.thread = threading.Thread(target=self.__receive)
+        self.thread.start()
+
+    def __receive(self):
+        while True:
+            data = self.socket.recv(65536)
+
+            if not data:
+                return
+
+            self.entries.append(data)
+
+    def stop(self, path):
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.sendto(b'', path)
+        sender.close()
+        self.thread.join()
+        self.socket.close()
+
+
+def benchmark_journal(args):
+    pistation2 = load_pistation2()
+    root = tempfile.mkdtemp(prefix='pistation2-journal-')
+    path = root + '/socket'
+    text = '4s left: CPU Temperature = 44.5\xb0C | CPU Usage = 3.2% | CPU Speed = 0.6GHz'
+    fields = {'EVENT': 'fan_countdown', 'TEMP': 44.5, 'FAN_STATE': 1, 'CPU_PCT': 3.2, 'CPU_FREQ': 0.6}
+    report = 'Scheduler: 1 wakeups/s\r\nLED: 0 steps'
+    stand_in = JournalStandIn(path)
+
+    try:
+        print('journald native protocol sink, {} records to a stand-in socket in {}'.format(args.records, root))
+        print('{:<40} {:>12}'.format('per record', 'us'))
+        timings = (
+            ('time stamp, strftime (old)', lambda: datetime.strftime(datetime.now(), '[%Y-%m-%d] [%H:%M:%S]')),
+            ('time stamp, cached', pistation2.log_timestamp),
+            ('encode', lambda: sink.encode(text, fields)),
+        )
+        sink = pistation2.JournalSink(pistation2.Scheduler(), path)
+
+        for name, call in timings:
+            start = time()
+
+            for _ in range(args.records):
+                call()
+
+            print('{:<40} {:>12.2f}'.format(name, (time() - start) / args.records * 1000000))
+
+        # write_log as the daemon runs it: queued by the tasks, sent by the drain scheduled after a batch
+        queued = sent = 0
+
+        for batch in range(0, args.records, 100):
+            start = time()
+
+            for _ in range(min(100, args.records - batch)):
+                pistation2.write_log(text, print_queue=sink, fields=fields)
+
+            queued += time() - start
+            start = time()
+
+            while sink.records:
+                sink.drain()
+
+            sent += time() - start
+
+        sink.record(report, {'PRIORITY': 3})
+        sink.close()
+        print('{:<40} {:>12.2f}'.format('write_log, queued', queued / args.records * 1000000))
+        print('{:<40} {:>12.2f}'.format('drain, sent', sent / args.records * 1000000))
+    finally:
+        stand_in.stop(path)
+        shutil.rmtree(root)
+
+    # Every record arrived as one datagram with its fields intact
+    entries = [parse_journal_entry(entry) for entry in stand_in.entries]
+    expected = dict((name, str(value).encode('ascii')) for name, value in fields.items())
+    expected.update(MESSAGE=text.encode('utf-8') if not isinstance(text, bytes) else text, PRIORITY=b'6',
+                    SYSLOG_IDENTIFIER=b'pistation2')
+    framed = sum(1 for entry in entries[:-1] if entry == expected)
+    last = entries[-1] if entries else {}
+    multi_line = last.get('MESSAGE') == report.encode('ascii') and last.get('PRIORITY') == b'3'
+    print('{} datagrams, {} framed as sent, multi-line message {}, {} sent, {} dropped'
+          .format(len(entries), framed, 'intact' if multi_line else 'BROKEN', sink.sent, sink.dropped))
+
+
+def benchmark_profile(args):
+    pistation2 = load_pistation2()
+    root = tempfile.mkdtemp(prefix='pistation2-profile-')
+    modes = (
+        ('profiler off', lambda: pistation2.Profiler(False)),
+        ('timers', lambda: pistation2.Profiler(True, interval=3600)),
+        ('timers and stack sampler', lambda: pistation2.Profiler(True)),
+    )
+
+    print('Daemon tasks on the simulated backend with the profiler, {} virtual hours, median of {} runs'
+          .format(args.hours, args.runs))
+    print('{:<36} {:>12} {:>10}'.format('mode', 'cpu s/h', 'overhead'))
+
+    try:
+        baseline = None
+
+        for name, create in modes:
+            cpu_per_hour = []
+
+            for run in range(args.runs):
+                profiler = create()
+                cpu = simulate_daemon(args.hours, True, '{}/PiStation 2.log'.format(root), profiler)[3]
+                cpu_per_hour.append(cpu / args.hours)
+
+            cpu = median(cpu_per_hour)
+            baseline = baseline or cpu
+            print('{:<36} {:>12.3f} {:>9.1f}%'.format(name, cpu, 100 * (cpu - baseline) / baseline))
+
+        # kill -USR1 as the daemon handles it, the dump runs on a thread of its own
+        path = root + '/PiStation 2.profile'
+        dumps = []
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dumps.append(
+            threading.Thread(target=lambda: profiler.dump(path, 'Scheduler: simulated'))) or dumps[-1].start())
+        os.kill(os.getpid(), signal.SIGUSR1)
+
+        while not dumps:
+            pass
+
+        dumps[0].join()
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        start = time()
+        profiler.sample()
+        sample_time = time() - start
+
+        with open(path + '.txt') as report:
+            print('\nSIGUSR1 dump, {}.txt:'.format(path))
+            print(report.read().rstrip())
+
+        with open(path + '.folded') as folded:
+            stacks = [line.rsplit(' ', 1) for line in folded]
+
+        print('{}.folded: {} stacks, {} samples, {:.0f}us a sample'.format(
+            path, len(stacks), sum(int(samples) for _, samples in stacks), 1000000 * sample_time))
+    finally:
+        shutil.rmtree(root)
+
+
+# Creates /sys/block/<disk>/stat for each (disk, path) with one partition, and the
+# /sys/dev/block/<major>:<minor> link from the device path is on to the partition
+def create_fake_block_devices(root, disks):
+    os.makedirs(root + '/block')
+    os.makedirs(root + '/dev/block')
+
+    for disk, path in disks:
+        disk_dir = '{}/devices/platform/{}'.format(root, disk)
+        partition_dir = '{}/{}1'.format(disk_dir, disk)
+        os.makedirs(partition_dir)
+
+        with open(partition_dir + '/partition', 'w') as partition:
+            partition.write('1\n')
+
+        os.symlink(disk_dir, '{}/block/{}'.format(root, disk))
+        write_disk_stats(root, disk, [0] * 11)
+        device = os.stat(path).st_dev
+        os.symlink(partition_dir, '{}/dev/block/{}:{}'.format(root, os.major(device), os.minor(device)))
+
+
+def write_disk_stats(root, disk, counters):
+    with open('{}/block/{}/stat'.format(root, disk), 'w') as stat:
+        stat.write(' '.join('{:>8}'.format(counter) for counter in counters + [0, 0, 0, 0]) + '\n')
+
+
+# Collects what is logged in place of a print queue
+class RecordCollector:
+    def __init__(self):
+        self.records = []
+
+    def record(self, text, fields=None):
+        self.records.append((text, fields))
+
+
+# A copy to the ROM drive every hour from 10 minutes past for 10 minutes, with the seconds a
+# request takes: a drive that is fine for two copies, then degrades and then is slow
+STORAGE_COPY_LATENCIES = [0.008, 0.009, 0.03, 0.25]
+
+
+def benchmark_storage(args):
+    pistation2 = load_pistation2()
+    root = tempfile.mkdtemp(prefix='pistation2-storage-')
+    clock = pistation2.VirtualClock()
+    # reads, merges, read sectors, read ms, writes, merges, write sectors, write ms, in flight, busy ms, queue ms
+    sd_card = [0] * 11
+    rom_drive = [0] * 11
+    process_io = {'rchar': 0, 'wchar': 0, 'syscr': 0, 'syscw': 0, 'read_bytes': 0, 'write_bytes': 0,
+                  'cancelled_write_bytes': 0}
+
+    def copy_latency():
+        hour, second = divmod(int(clock.monotonic()), 3600)
+        return STORAGE_COPY_LATENCIES[hour] if 600 <= second < 1200 and hour < len(STORAGE_COPY_LATENCIES) else None
+
+    # One second of I/O: the log on the SD card, and 200 64KB writes a second to the ROM drive during a copy
+    def kernel():
+        for counters, writes, sectors, latency in ((sd_card, 1, 8, 0.002), (rom_drive, 200, 128, copy_latency())):
+            if latency is None:
+                continue
+
+            counters[4] += writes
+            counters[6] += writes * sectors
+            counters[7] += int(writes * latency * 1000)
+            counters[9] += min(1000, int(writes * latency * 1000))
+            counters[10] += int(writes * latency * 1000)
+
+        process_io['wchar'] += 100
+        process_io['write_bytes'] += 4096 if int(clock.monotonic()) % 5 == 0 else 0
+        write_disk_stats(root, 'mmcblk0', sd_card)
+        write_disk_stats(root, 'sda', rom_drive)
+
+        with open(root + '/io', 'w') as io:
+            io.write(''.join('{}: {}\n'.format(name, value) for name, value in sorted(process_io.items())))
+
+    try:
+        create_fake_block_devices(root, [('mmcblk0', '/proc'), ('sda', root)])
+        kernel()
+        scheduler = pistation2.Scheduler(clock=clock)
+        collector = RecordCollector()
+        monitor = pistation2.StorageMonitor((('SD card', '/proc'), ('ROM drive', root)),
+                                            is_copying=lambda: copy_latency() is not None, sys_dir=root,
+                                            proc_io=root + '/io', print_queue=collector, clock=clock)
+        scheduler.call_every(1, kernel, 'kernel')
+        monitor.start(scheduler)
+        scheduler.call_every(3600, lambda: pistation2.write_log(monitor.report(), print_queue=collector),
+                             'StorageMonitor.report')
+        scheduler.call_later(3600 * len(STORAGE_COPY_LATENCIES), scheduler.stop)
+        scheduler.run()
+
+        print('Storage monitor on a fake sysfs tree, {} hourly copies to the ROM drive ({}ms a request)'
+              .format(len(STORAGE_COPY_LATENCIES), '/'.join('{:g}'.format(1000 * latency)
+                                                          for latency in STORAGE_COPY_LATENCIES)))
+
+        for text, fields in collector.records:
+            print(text.replace('\r\n', '\n'))
+
+        events = [fields['EVENT'] for _, fields in collector.records if fields]
+        print('\nflagged: {} slow, {} degrading (expected 1 and 2)'.format(events.count('storage_slow'),
+                                                                         events.count('storage_degrading')))
+        start = time()
+
+        for _ in range(args.iterations):
+            monitor.sample()
+
+        print('{:.0f}us a sample ({} disks and /proc/self/io)'.format(
+            (time() - start) / args.iterations * 1000000, len(monitor.devices)))
+        monitor.close()
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PiStation 2 benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    rsync_parser = subparsers.add_parser('rsync', help='rsync detection: pidof vs /proc scan vs proc connector')
+    rsync_parser.add_argument('--iterations', type=int, default=2000)
+    rsync_parser.add_argument('--seconds', type=float, default=10)
+    rsync_parser.set_defaults(run=benchmark_rsync)
+
+    sensors_parser = subparsers.add_parser('sensors', help='sensor sample latency: vcgencmd/cat vs sysfs')
+    sensors_parser.add_argument('--iterations', type=int, default=2000)
+    sensors_parser.set_defaults(run=benchmark_sensors)
+
+    logqueue_parser = subparsers.add_parser('logqueue', help='log writer throughput: old LogQueue vs group commit')
+    logqueue_parser.add_argument('--lines', type=int, default=20000)
+    logqueue_parser.add_argument('--legacy-lines', type=int, default=30,
+                                 help='lines for the old LogQueue, it writes about 10 lines/s')
+    logqueue_parser.set_defaults(run=benchmark_logqueue)
+
+    simulate_parser = subparsers.add_parser('simulate', help='daemon CPU, wakeups, spawns and reaction latency '
+                                                             'on the simulated backend')
+    simulate_parser.add_argument('--hours', type=float, default=24, help='virtual hours to simulate')
+    simulate_parser.set_defaults(run=benchmark_simulate)
+
+    startup_parser = subparsers.add_parser('startup', help='import and init time of every startup step')
+    startup_parser.add_argument('--runs', type=int, default=5, help='new interpreters per import measurement')
+    startup_parser.add_argument('--directories', type=int, default=2000,
+                                help='directories in the fake ROM tree for the directory watcher')
+    startup_parser.set_defaults(run=benchmark_startup)
+
+    cpuprofile_parser = subparsers.add_parser('cpuprofile', help='CPU profile switches, latency and fan pre-spins '
+                                                                 'on the simulated backend and a fake cpufreq tree')
+    cpuprofile_parser.add_argument('--hours', type=float, default=24, help='virtual hours to simulate')
+    cpuprofile_parser.set_defaults(run=benchmark_cpuprofile)
+
+    analyze_parser = subparsers.add_parser('analyze', help='log analyzer: full scan vs indexed time range queries')
+    analyze_parser.add_argument('--megabytes', type=float, default=256, help='size of the synthetic log')
+    analyze_parser.set_defaults(run=benchmark_analyze)
+
+    journal_parser = subparsers.add_parser('journal', help='journald sink: framing and per record cost against a '
+                                                           'local stand-in socket')
+    journal_parser.add_argument('--records', type=int, default=20000)
+    journal_parser.set_defaults(run=benchmark_journal)
+
+    profile_parser = subparsers.add_parser('profile', help='profiler overhead, off vs timers vs stack sampler, '
+                                                           'and a SIGUSR1 dump on the simulated backend')
+    profile_parser.add_argument('--hours', type=float, default=24, help='virtual hours to simulate')
+    profile_parser.add_argument('--runs', type=int, default=5)
+    profile_parser.set_defaults(run=benchmark_profile)
+
+    storage_parser = subparsers.add_parser('storage', help='storage monitor on a fake sysfs tree: copies to a '
+                                                           'degrading ROM drive')
+    storage_parser.add_argument('--iterations', type=int, default=2000, help='samples for the cost per sample')
+    storage_parser.set_defaults(run=benchmark_storage)
+
+    args = parser.parse_args()
+
+    if not hasattr(args, 'run'):
+        parser.print_help()
+        return 1
+
+    args.run(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
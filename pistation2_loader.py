@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Loads PiStation 2.py as a module for the tools next to it (replay.py, benchmark.py), the file
+# name has a space in it so it can not be imported
+
+import os
+import sys
+
+if sys.version_info[0] < 3:
+    import imp
+else:
+    import importlib.util
+
+pistation2_script = os.path.dirname(os.path.realpath(__file__)) + '/PiStation 2.py'
+
+
+def load_pistation2():
+    if sys.version_info[0] < 3:
+        return imp.load_source('pistation2', pistation2_script)
+
+    spec = importlib.util.spec_from_file_location('pistation2', pistation2_script)
+    module = importlib.util.module_from_spec(spec)
+    # Registered like imp.load_source does, multiprocessing pickles functions by module name
+    sys.modules['pistation2'] = module
+    spec.loader.exec_module(module)
+    return module
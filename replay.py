@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# PiStation 2 trace replay
+# Feeds a sensor trace recorded by the daemon (trace_path in PiStation 2.py) through FanMonitor
+# with every combination of the given settings, in virtual time (a day of samples takes
+# seconds). The temperature is replayed as it was recorded, it was shaped by the fan that
+# actually ran, so each policy is compared against the recorded row
+#
+#   python replay.py 'PiStation 2.trace' [--temp-fan-low 50 55] [--temp-fan-high 60 65]
+#                    [--temp-fan-off 45] [--min-seconds-on 30 120] [--predictive]
+
+import argparse
+import itertools
+import sys
+
+from pistation2_loader import load_pistation2
+
+# Samples further apart than this are a gap in the trace (the daemon was not running)
+MAX_SAMPLE_GAP = 60
+
+
+# Replay Sampler class
+# Stands in for TelemetrySampler, FanMonitor only reads its snapshot
+class ReplaySampler:
+    def __init__(self, pistation2):
+        self.pistation2 = pistation2
+        self.snapshot = pistation2.TelemetrySnapshot(0, 0.0, (), 0.0, (), 0.0, (), None)
+
+    def replay(self, sample):
+        self.snapshot = self.pistation2.TelemetrySnapshot(sample.time, sample.cpu_percent, (), sample.cpu_freq,
+                                                          (sample.cpu_freq,), sample.temperature,
+                                                          (sample.temperature,), None)
+
+
+# Returns the fan state after each sample with FanMonitor checking once per sample
+def replay(pistation2, samples, temp_fan_low, temp_fan_high, temp_fan_off, min_seconds_on, predictive):
+    clock = pistation2.VirtualClock(0, samples[0].time)
+    backend = pistation2.SimulatedBackend(None, clock=clock)
+    sampler = ReplaySampler(pistation2)
+    fan_monitor = pistation2.FanMonitor(pistation2.fan_pin_low, pistation2.fan_pin_high, temp_fan_low,
+                                        temp_fan_high, temp_fan_off, min_seconds_on, sampler=sampler,
+                                        predictive=predictive, gpio=backend.gpio, clock=clock)
+    fan_states = []
+
+    for sample in samples:
+        clock.now = sample.time - clock.wall_offset
+        sampler.replay(sample)
+        fan_monitor.check_temp()
+        fan_states.append(int(fan_monitor.fan_state))
+
+    return fan_states
+
+
+# Seconds each sample stands for, 0 for the last one and the ones before a gap
+def sample_durations(samples):
+    durations = [later.time - sample.time for sample, later in zip(samples, samples[1:])] + [0]
+    return [duration if 0 < duration <= MAX_SAMPLE_GAP else 0 for duration in durations]
+
+
+# Seconds with the temperature at or above threshold
+def time_above(samples, durations, threshold):
+    return sum(duration for sample, duration in zip(samples, durations) if sample.temperature >= threshold)
+
+
+def print_policy(name, samples, durations, fan_states, temp_fan_low):
+    low = sum(duration for state, duration in zip(fan_states, durations) if state == 1)
+    high = sum(duration for state, duration in zip(fan_states, durations) if state == 2)
+    switches = sum(1 for state, previous in zip(fan_states[1:], fan_states) if state != previous)
+    # Time the SoC was at the low speed threshold or above and the fan was off
+    late = sum(duration for sample, state, duration in zip(samples, fan_states, durations)
+               if sample.temperature >= temp_fan_low and not state)
+    total = max(sum(durations), 1)
+
+    print('{:<34} {:>8.1f} {:>8.2f} {:>8.2f} {:>9} {:>10.1f}'.format(
+        name, 100.0 * (low + high) / total, low / 3600.0, high / 3600.0, switches, late / 60.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a PiStation 2 sensor trace through fan policies')
+    parser.add_argument('trace')
+    parser.add_argument('--temp-fan-low', type=float, nargs='+', default=[55])
+    parser.add_argument('--temp-fan-high', type=float, nargs='+', default=[65])
+    parser.add_argument('--temp-fan-off', type=float, nargs='+', default=[45])
+    parser.add_argument('--min-seconds-on', type=float, nargs='+', default=[30])
+    parser.add_argument('--predictive', action='store_true', help='replay the predictive policy as well')
+    args = parser.parse_args()
+
+    pistation2 = load_pistation2()
+    samples = list(pistation2.read_trace(args.trace))
+
+    if len(samples) < 2:
+        print('{} has no samples to replay'.format(args.trace))
+        return 1
+
+    durations = sample_durations(samples)
+    thresholds = sorted(set(args.temp_fan_off + args.temp_fan_low + args.temp_fan_high))
+
+    print('{}: {} samples, {:.1f}h, peak {:.1f}°C'.format(args.trace, len(samples), sum(durations) / 3600.0,
+                                                          max(sample.temperature for sample in samples)))
+    print('Time above: ' + ' | '.join('{:g}°C {:.1f}m'.format(threshold, time_above(samples, durations, threshold)
+                                                              / 60.0) for threshold in thresholds))
+    print('{:<34} {:>8} {:>8} {:>8} {:>9} {:>10}'.format('policy (low/high/off/min on)', 'fan on %', 'low h',
+                                                       'high h', 'switches', 'hot, off m'))
+
+    print_policy('recorded', samples, durations, [sample.fan_state for sample in samples], min(args.temp_fan_low))
+
+    for predictive in (False, True) if args.predictive else (False,):
+        for temp_fan_low, temp_fan_high, temp_fan_off, min_seconds_on in itertools.product(
+                args.temp_fan_low, args.temp_fan_high, args.temp_fan_off, args.min_seconds_on):
+            fan_states = replay(pistation2, samples, temp_fan_low, temp_fan_high, temp_fan_off, min_seconds_on,
+                                predictive)
+            print_policy('{}{:g}/{:g}/{:g}/{:g}s'.format('predictive ' if predictive else '', temp_fan_low,
+                                                         temp_fan_high, temp_fan_off, min_seconds_on),
+                         samples, durations, fan_states, temp_fan_low)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
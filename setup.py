@@ -2,14 +2,23 @@
 
 import os
 import sys
-import re
-import subprocess
 import importlib
+import threading
+import hashlib
+import json
+import errno
+import time
+import ctypes
+import ctypes.util
+from collections import namedtuple
+from stat import S_ISLNK, S_ISREG
 
 if sys.version_info[0] < 3:
     prompt = raw_input
+    from Queue import Queue, Empty
 else:
     prompt = input
+    from queue import Queue, Empty
 
 reboot_required = False
 splash_dir = '/home/pi/RetroPie/splashscreens/videos/'
@@ -18,6 +27,532 @@ pistation2_service = os.path.dirname(os.path.realpath(__file__)) + '/pistation2.
 pistation2_splashscreen = os.path.dirname(os.path.realpath(__file__)) + '/PiStation 2 Splashscreen.mp4'
 current_splashscreen = ''
 
+
+# A partition found by discover_storage. capacity and free are in bytes (0 when not mounted),
+# write_speed and read_speed in bytes/s once probe_throughput has measured them
+StoragePartition = namedtuple('StoragePartition', ['device', 'disk', 'mountpoint', 'fstype', 'uuid', 'label',
+                                                   'capacity', 'free', 'removable', 'write_speed', 'read_speed'])
+
+
+# /proc/mounts as {device: (mountpoint, fstype)}, the first mount of a device wins
+def read_mounts(mounts_file='/proc/mounts'):
+    mounts = {}
+
+    with open(mounts_file) as mounts_data:
+        for line in mounts_data:
+            fields = line.split()
+
+            if len(fields) >= 3 and fields[0].startswith('/dev/'):
+                # Spaces in mount points are escaped as \040
+                mounts.setdefault(fields[0], (fields[1].replace('\\040', ' '), fields[2]))
+
+    return mounts
+
+
+# {device: name} from the /dev/disk/by-uuid or /dev/disk/by-label symlinks
+def read_disk_links(links_dir):
+    links = {}
+
+    try:
+        names = os.listdir(links_dir)
+    except OSError:
+        return links
+
+    for name in names:
+        device = os.path.realpath(os.path.join(links_dir, name))
+        # Labels escape spaces as \x20
+        links[device] = name.replace('\\x20', ' ')
+
+    return links
+
+
+# Name of the block device (e.g. mmcblk0p2) that holds the path
+def device_of(path, sys_class_block='/sys/class/block'):
+    st_dev = os.stat(path).st_dev
+    wanted = '{}:{}'.format(os.major(st_dev), os.minor(st_dev))
+
+    for name in os.listdir(sys_class_block):
+        try:
+            with open(os.path.join(sys_class_block, name, 'dev')) as dev:
+                if dev.read().strip() == wanted:
+                    return name
+        except (OSError, IOError):
+            pass
+
+    return None
+
+
+# Every partition (or whole disk without partitions) in /sys/block, with the mount point,
+# filesystem, UUID and label of the partition and the sizes from os.statvfs
+def discover_storage(sys_block='/sys/block', mounts_file='/proc/mounts', disk_dir='/dev/disk'):
+    mounts = read_mounts(mounts_file)
+    uuids = read_disk_links(disk_dir + '/by-uuid')
+    labels = read_disk_links(disk_dir + '/by-label')
+    root_device = device_of('/')
+    partitions = []
+
+    for disk in sorted(os.listdir(sys_block)):
+        # RAM disks, loop devices and compressed swap are not storage
+        if disk.startswith(('ram', 'loop', 'zram')):
+            continue
+
+        try:
+            with open(os.path.join(sys_block, disk, 'removable')) as removable_file:
+                removable = removable_file.read().strip() == '1'
+        except (OSError, IOError):
+            removable = False
+
+        names = [name for name in os.listdir(os.path.join(sys_block, disk))
+                 if name.startswith(disk) and os.path.isfile(os.path.join(sys_block, disk, name, 'partition'))]
+
+        for name in sorted(names) if names else [disk]:
+            device = '/dev/' + name
+            mountpoint, fstype = mounts.get(device, (None, None))
+
+            # The root filesystem shows up as /dev/root in /proc/mounts
+            if mountpoint is None and name == root_device:
+                mountpoint, fstype = mounts.get('/dev/root', ('/', None))
+
+            capacity = free = 0
+
+            if mountpoint:
+                try:
+                    statvfs = os.statvfs(mountpoint)
+                except OSError:
+                    # Stale or hung mount (EIO, ENOTCONN), nothing to store ROMs on
+                    continue
+
+                capacity = statvfs.f_blocks * statvfs.f_frsize
+                free = statvfs.f_bavail * statvfs.f_frsize
+
+            partitions.append(StoragePartition(device, disk, mountpoint, fstype, uuids.get(device),
+                                               labels.get(device), capacity, free, removable, 0, 0))
+
+    return partitions
+
+
+# Drops the cached pages of a file so the next read comes from the drive (Python 2 has no os.posix_fadvise)
+def drop_cache(fd):
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    else:
+        # POSIX_FADV_DONTNEED = 4
+        ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6').posix_fadvise(
+            fd, ctypes.c_long(0), ctypes.c_long(0), 4)
+
+
+# Sequential write (with fsync) and read speed of the drive mounted at mountpoint in bytes/s,
+# measured with a size byte file that is removed afterwards. (0, 0) if it is not writable
+def probe_throughput(mountpoint, size=32 * 1048576, block_size=1048576):
+    path = os.path.join(mountpoint, '.pistation2-probe')
+    block = os.urandom(block_size)
+
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        try:
+            start = time.time()
+
+            for _ in range(size // block_size):
+                os.write(fd, block)
+
+            os.fsync(fd)
+            write_speed = size / max(time.time() - start, 0.000001)
+            drop_cache(fd)
+        finally:
+            os.close(fd)
+
+        fd = os.open(path, os.O_RDONLY)
+
+        try:
+            start = time.time()
+
+            while os.read(fd, block_size):
+                pass
+
+            read_speed = size / max(time.time() - start, 0.000001)
+        finally:
+            os.close(fd)
+    except OSError:
+        return 0, 0
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    return write_speed, read_speed
+
+
+# UUIDs of the filesystems in /etc/fstab
+def fstab_uuids(fstab='/etc/fstab'):
+    uuids = set()
+
+    try:
+        with open(fstab) as fstab_file:
+            for entry in fstab_file.read().splitlines():
+                fields = entry.split()
+
+                if fields and fields[0].startswith('UUID='):
+                    uuids.add(fields[0][5:])
+    except (OSError, IOError):
+        pass
+
+    return uuids
+
+
+# Mounted partitions off the SD card that are larger than the root filesystem, nothing is
+# written to them (see rank_rom_drives)
+def rom_drive_candidates(partitions):
+    root = [partition for partition in partitions if partition.mountpoint == '/']
+    root_disk = root[0].disk if root else None
+    root_capacity = root[0].capacity if root else 0
+    candidates = []
+
+    for partition in partitions:
+        if not partition.mountpoint or partition.disk == root_disk or partition.capacity <= root_capacity:
+            continue
+
+        # Already set up as the RetroPie drive
+        if os.path.isdir(partition.mountpoint + '/retropie-mount'):
+            continue
+
+        candidates.append(partition)
+
+    return candidates
+
+
+# Probes the candidates and sorts them fastest first (the slower of the read and write speeds),
+# then largest first. Writes a 32MB file to each, only run once the user agreed to use one
+def rank_rom_drives(candidates):
+    probed = []
+
+    for partition in candidates:
+        write_speed, read_speed = probe_throughput(partition.mountpoint)
+        probed.append(partition._replace(write_speed=write_speed, read_speed=read_speed))
+
+    return sorted(probed, key=lambda partition: (min(partition.write_speed, partition.read_speed),
+                                                 partition.capacity), reverse=True)
+
+
+# Where the copy engine publishes its progress, PiStation 2.py (CopyProgressWatcher)
+# flashes the front LEDs while the file is being updated
+copy_progress_file = '/run/pistation2/copy-progress.json'
+copy_journal_name = '.pistation2-copy-journal'
+
+
+# Flushes every filesystem, Python 2 has no os.sync
+def sync_filesystems():
+    if hasattr(os, 'sync'):
+        os.sync()
+    else:
+        ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6').sync()
+
+
+# Copy Engine class
+# Copies a directory tree with a small pool of worker threads, using copy_file_range or
+# sendfile where the kernel supports them (the data never goes through Python) and large
+# buffers otherwise. Every file copied is recorded in a journal in the destination once it
+# is on disk, so an interrupted copy resumes and skips everything already copied.
+# With verify, the source and the copy are checksummed (SHA1) and compared
+class CopyEngine:
+    def __init__(self, source, destination, workers=3, verify=False, buffer_size=1048576,
+                 sync_every=256, progress_file=copy_progress_file):
+        self.source = source
+        self.destination = destination
+        self.workers = workers
+        self.verify = verify
+        self.buffer_size = buffer_size
+        # Files copied between two syncs (and journal writes)
+        self.sync_every = sync_every
+        self.progress_file = progress_file
+        self.journal_file = os.path.join(destination, copy_journal_name)
+        self.files_total = 0
+        self.bytes_total = 0
+        self.files_done = 0
+        self.bytes_done = 0
+        self.files_skipped = 0
+        self.failed = []
+        self.__journal = {}
+        self.__unsynced = []
+        self.__unsupported = set()
+        self.__lock = threading.Lock()
+        self.__last_progress = 0
+        self.__started = 0
+
+    # Copies everything, returns True if every file made it
+    def run(self):
+        self.__started = time.time()
+        self.__load_journal()
+        files = self.__walk()
+        jobs = Queue()
+
+        # Largest first so the workers finish at about the same time
+        for job in sorted(files, key=lambda job: -job[1]):
+            jobs.put(job)
+
+        threads = []
+
+        for _ in range(max(1, self.workers)):
+            thread = threading.Thread(target=self.__worker, args=(jobs,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # Join with a timeout so CTRL+C still works on Python 2
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+                self.__progress()
+
+        with self.__lock:
+            self.__commit()
+
+        self.__progress(True)
+        self.__remove_progress()
+
+        if not self.failed and os.path.isfile(self.journal_file):
+            os.remove(self.journal_file)
+
+        return not self.failed
+
+    # Creates every directory in the destination and returns the files still to copy
+    # as (relative path, size, mtime)
+    def __walk(self):
+        files = []
+
+        for directory, directories, names in os.walk(self.source):
+            relative_directory = os.path.relpath(directory, self.source)
+            target_directory = os.path.normpath(os.path.join(self.destination, relative_directory))
+
+            if not os.path.isdir(target_directory):
+                os.makedirs(target_directory)
+
+            for name in names:
+                path = os.path.join(directory, name)
+                relative = os.path.normpath(os.path.join(relative_directory, name))
+
+                try:
+                    stat = os.lstat(path)
+                except OSError:
+                    continue
+
+                # Links are copied as links where the drive supports them (not on FAT)
+                if S_ISLNK(stat.st_mode):
+                    self.__copy_link(path, os.path.join(self.destination, relative))
+                    continue
+
+                # Sockets, fifos and devices are left alone
+                if not S_ISREG(stat.st_mode):
+                    continue
+
+                self.files_total += 1
+                self.bytes_total += stat.st_size
+
+                if self.__already_copied(relative, stat):
+                    self.files_skipped += 1
+                    self.files_done += 1
+                    self.bytes_done += stat.st_size
+                    continue
+
+                files.append((relative, stat.st_size, int(stat.st_mtime)))
+
+        return files
+
+    @staticmethod
+    def __copy_link(path, target_path):
+        try:
+            if os.path.lexists(target_path):
+                os.remove(target_path)
+
+            os.symlink(os.readlink(path), target_path)
+        except OSError:
+            pass
+
+    def __already_copied(self, relative, stat):
+        entry = self.__journal.get(relative)
+
+        if not entry or entry != (stat.st_size, int(stat.st_mtime)):
+            return False
+
+        try:
+            return os.path.getsize(os.path.join(self.destination, relative)) == stat.st_size
+        except OSError:
+            return False
+
+    def __worker(self, jobs):
+        while True:
+            try:
+                relative, size, mtime = jobs.get_nowait()
+            except Empty:
+                return
+
+            try:
+                checksum = self.__copy(relative, size)
+            except (OSError, IOError) as e:
+                with self.__lock:
+                    self.failed.append((relative, str(e)))
+                continue
+
+            with self.__lock:
+                self.files_done += 1
+                self.__unsynced.append('{}\t{}\t{}\t{}\n'.format(size, mtime, checksum or '-', relative))
+
+                if len(self.__unsynced) >= self.sync_every:
+                    self.__commit()
+
+    def __copy(self, relative, size):
+        source_path = os.path.join(self.source, relative)
+        target_path = os.path.join(self.destination, relative)
+
+        with open(source_path, 'rb') as source:
+            with open(target_path, 'wb') as target:
+                copied = self.__copy_data(source.fileno(), target.fileno(), size)
+
+        if copied != size:
+            raise IOError('{}: copied {} of {} bytes'.format(relative, copied, size))
+
+        if not self.verify:
+            return None
+
+        checksum = self.__checksum(source_path)
+
+        if checksum != self.__checksum(target_path):
+            raise IOError('{}: checksum mismatch'.format(relative))
+
+        return checksum
+
+    # Kernel side copies first, read/write with large buffers when the kernel refuses
+    def __copy_data(self, source_fd, target_fd, size):
+        copied = 0
+
+        for copy in self.__kernel_copies():
+            try:
+                while copied < size:
+                    count = copy(source_fd, target_fd, copied, min(size - copied, 1 << 30))
+
+                    if not count:
+                        break
+
+                    copied += count
+                    self.__add_bytes(count)
+
+                return copied
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF) \
+                        or copied:
+                    raise
+
+                # Not supported between these filesystems, do not try it again
+                self.__unsupported.add(copy.__name__)
+
+        while True:
+            data = os.read(source_fd, self.buffer_size)
+
+            if not data:
+                return copied
+
+            view = memoryview(data)
+
+            while view:
+                written = os.write(target_fd, view)
+                view = view[written:]
+
+            copied += len(data)
+            self.__add_bytes(len(data))
+
+    def __kernel_copies(self):
+        copies = []
+
+        if hasattr(os, 'copy_file_range') and 'copy_file_range' not in self.__unsupported:
+            def copy_file_range(source_fd, target_fd, offset, count):
+                return os.copy_file_range(source_fd, target_fd, count, offset, offset)
+            copies.append(copy_file_range)
+
+        if hasattr(os, 'sendfile') and 'sendfile' not in self.__unsupported:
+            # sendfile writes at the current position of the target, which follows offset
+            def sendfile(source_fd, target_fd, offset, count):
+                return os.sendfile(target_fd, source_fd, offset, count)
+            copies.append(sendfile)
+
+        return copies
+
+    def __checksum(self, path):
+        sha1 = hashlib.sha1()
+
+        with open(path, 'rb') as data:
+            for block in iter(lambda: data.read(self.buffer_size), b''):
+                sha1.update(block)
+
+        return sha1.hexdigest()
+
+    def __add_bytes(self, count):
+        with self.__lock:
+            self.bytes_done += count
+
+    # Syncs the copied files to the drive, then records them in the journal
+    def __commit(self):
+        if not self.__unsynced:
+            return
+
+        sync_filesystems()
+
+        with open(self.journal_file, 'a') as journal:
+            journal.write(''.join(self.__unsynced))
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        self.__unsynced = []
+
+    def __load_journal(self):
+        try:
+            with open(self.journal_file) as journal:
+                for line in journal:
+                    fields = line.rstrip('\n').split('\t', 3)
+
+                    if len(fields) == 4:
+                        self.__journal[fields[3]] = (int(fields[0]), int(fields[1]))
+        except (OSError, IOError, ValueError):
+            pass
+
+    # Progress line on the terminal and progress file for the LED monitor, twice a second
+    def __progress(self, final=False):
+        now = time.time()
+
+        if not final and now - self.__last_progress < 0.5:
+            return
+
+        self.__last_progress = now
+        elapsed = max(now - self.__started, 0.001)
+        percent = 100.0 * self.bytes_done / self.bytes_total if self.bytes_total else 100.0
+
+        sys.stdout.write('\r{:5.1f}% {}/{} files {:.1f}/{:.1f}MB {:.1f}MB/s{}'.format(
+            percent, self.files_done, self.files_total, self.bytes_done / 1048576.0, self.bytes_total / 1048576.0,
+            self.bytes_done / 1048576.0 / elapsed, '\n' if final else ''))
+        sys.stdout.flush()
+
+        progress = {'pid': os.getpid(), 'started': self.__started, 'updated': now,
+                    'bytes_done': self.bytes_done, 'bytes_total': self.bytes_total,
+                    'files_done': self.files_done, 'files_total': self.files_total}
+
+        try:
+            if not os.path.isdir(os.path.dirname(self.progress_file)):
+                os.makedirs(os.path.dirname(self.progress_file))
+
+            with open(self.progress_file + '.tmp', 'w') as progress_file:
+                json.dump(progress, progress_file)
+
+            os.rename(self.progress_file + '.tmp', self.progress_file)
+        except (OSError, IOError):
+            pass
+
+    def __remove_progress(self):
+        try:
+            os.remove(self.progress_file)
+        except OSError:
+            pass
+
+
 try:
     __import__('psutil')
 except ImportError:
@@ -31,58 +566,56 @@ except ImportError:
         print('Getting psutil library')
         os.system('sudo pip install psutil')
 
-drives = str(subprocess.check_output('df', shell=True))
-
-if drives.find('/dev/sda1'):
-    root = re.search('/dev/root {0,}(\d+) ', drives)
-    flash = re.search('/dev/sda1 {0,}(\d+) ', drives)
-    flash_drive_dir = re.search('/dev/sda1.*% (.*)', drives)
+rom_drives = rom_drive_candidates(discover_storage())
 
-    if flash and root and flash_drive_dir and flash.group(1) > root.group(1) and \
-            not os.path.isdir(flash_drive_dir.group(1) + '/retropie-mount'):
-        flash_drive_dir = flash_drive_dir.group(1)
+# A drive set up by an earlier run is in /etc/fstab already, nothing to offer (or probe)
+if rom_drives and not set(rom_drive.uuid for rom_drive in rom_drives) & fstab_uuids():
+    user_input = prompt('Larger USB storage device detected ({}), would you like to use it for ROM storage? '
+                        'The fastest one is used, each is tested with a 32MB file first [Y/n] '
+                        .format(', '.join('{} {:.1f}GB'.format(rom_drive.device, rom_drive.capacity / 1e9)
+                                          for rom_drive in rom_drives)))
 
-        uuid_type = re.search('/dev/sda1: LABEL=".*" UUID="(.*)" TYPE="(.*)" PARTUUID',
-                              str(subprocess.check_output('blkid', shell=True)))
-        mounted = False
+    if not user_input or user_input.lower()[0] == 'y':
+        print('Testing the speed of the USB storage')
+        rom_drive = rank_rom_drives(rom_drives)[0]
+        flash_drive_dir = rom_drive.mountpoint
         fstab_entry = ''
+        print('Using {} (writes {:.1f}MB/s, reads {:.1f}MB/s)'.format(
+            rom_drive.device, rom_drive.write_speed / 1048576.0, rom_drive.read_speed / 1048576.0))
 
-        if uuid_type.lastindex == 2:
+        if rom_drive.uuid and rom_drive.fstype:
             fstab_entry = 'UUID={}\t/home/pi/RetroPie\t{}\tnofail,user,uid=pi,gid=pi\t0\t2\r\n'.format(
-                uuid_type.group(1), uuid_type.group(2))
-
-            with open('/etc/fstab', 'r') as fstab_file:
-                entries = fstab_file.read().splitlines()
-
-                for entry in entries:
-                    if entry and entry.find(fstab_entry) and entry.replace(' ', '')[0] != '#':
-                        mounted = True
-                    else:
-                        mounted = False
-
-        if not mounted:
-            user_input = \
-                prompt('Larger USB storage device detected ({}gb), would you like to use this for ROM storage? [Y/n] '.format(flash.group(1)))
-
-            if not user_input or user_input.lower()[0] == 'y':
-                print('Copying current RetroPie directories and files to flash drive')
-                os.system('cp -v -r /home/pi/RetroPie/* ' + flash_drive_dir + '/')
-
-                splash_dir = flash_drive_dir + '/splashscreens/videos/'
-
-                if uuid_type.lastindex == 2:
-                    with open('/etc/fstab', 'a') as fstab_file:
-                        fstab_file.write(fstab_entry)
-                        reboot_required = True
-                else:
-                    print('Could not get the UUID or format type for the external drive\r\n'
-                          'To make this your ROM storage device use this command:\r\n\t'
-                          'sudo blkid\r\n'
-                          'Copy the UUID and TYPE. Next use\r\n\t'
-                          'sudo nano /etc/fstab\r\n'
-                          'To edit the fstab file. At the bottom put this (replace YOUR_UUID and YOUR_TYPE with the UUID and TYPE from blkid\r\n\t'
-                          'UUID=YOUR_UUID\t/home/pi/RetroPie\tYOUR_TYPE\tnofail,user,uid=pi,gid=pi\t0\t2\r\n'
-                          'Then hit CTRL+X, Y (keyboard key Y), then enter. Reboot your system')
+                rom_drive.uuid, rom_drive.fstype)
+
+        user_input = prompt('Verify every copied file (slower)? [y/N] ')
+        print('Copying current RetroPie directories and files to flash drive')
+        copy_engine = CopyEngine('/home/pi/RetroPie', flash_drive_dir,
+                                 verify=bool(user_input) and user_input.lower()[0] == 'y')
+
+        if not copy_engine.run():
+            print('{} files could not be copied, run setup again to retry them:'.format(
+                len(copy_engine.failed)))
+
+            for path, error in copy_engine.failed:
+                print('\t' + error)
+
+            sys.exit(1)
+
+        splash_dir = flash_drive_dir + '/splashscreens/videos/'
+
+        if fstab_entry:
+            with open('/etc/fstab', 'a') as fstab_file:
+                fstab_file.write(fstab_entry)
+                reboot_required = True
+        else:
+            print('Could not get the UUID or format type for the external drive\r\n'
+                  'To make this your ROM storage device use this command:\r\n\t'
+                  'sudo blkid\r\n'
+                  'Copy the UUID and TYPE. Next use\r\n\t'
+                  'sudo nano /etc/fstab\r\n'
+                  'To edit the fstab file. At the bottom put this (replace YOUR_UUID and YOUR_TYPE with the UUID and TYPE from blkid\r\n\t'
+                  'UUID=YOUR_UUID\t/home/pi/RetroPie\tYOUR_TYPE\tnofail,user,uid=pi,gid=pi\t0\t2\r\n'
+                  'Then hit CTRL+X, Y (keyboard key Y), then enter. Reboot your system')
 
 if os.path.isfile(pistation2_service):
     print('Setting up the service to start the PiStation 2 monitoring script. '